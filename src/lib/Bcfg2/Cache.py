@@ -0,0 +1,113 @@
+""" Bounded caches for memoizing expensive results """
+
+import threading
+
+# indexes into the linked list nodes of LRUCache
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """ A dict-like cache that holds at most ``size`` items, discarding
+    the least recently used item when it is full.  All operations are
+    thread-safe and take constant time. """
+
+    def __init__(self, size):
+        self.size = size
+        # maps each key to its node in a circular doubly linked list
+        # of [prev, next, key, value] lists, ordered from least to
+        # most recently used.  root is a sentinel node.
+        self.data = dict()
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+
+    def _append(self, node):
+        """ add a node to the most recently used end of the list """
+        last = self.root[PREV]
+        node[PREV] = last
+        node[NEXT] = self.root
+        last[NEXT] = node
+        self.root[PREV] = node
+
+    def _touch(self, node):
+        self._unlink(node)
+        self._append(node)
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.data:
+                return default
+            node = self.data[key]
+            self._touch(node)
+            return node[VALUE]
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, key):
+        self.lock.acquire()
+        try:
+            node = self.data[key]
+            self._touch(node)
+            return node[VALUE]
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                node = self.data[key]
+                node[VALUE] = value
+                self._touch(node)
+                return
+            if self.size < 1:
+                return
+            if len(self.data) >= self.size:
+                oldest = self.root[NEXT]
+                self._unlink(oldest)
+                del self.data[oldest[KEY]]
+            node = [None, None, key, value]
+            self._append(node)
+            self.data[key] = node
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            self._unlink(self.data.pop(key))
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        """ get the keys in the cache, from least to most recently
+        used """
+        self.lock.acquire()
+        try:
+            rv = []
+            node = self.root[NEXT]
+            while node is not self.root:
+                rv.append(node[KEY])
+                node = node[NEXT]
+            return rv
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+            self.root[:] = [self.root, self.root, None, None]
+        finally:
+            self.lock.release()
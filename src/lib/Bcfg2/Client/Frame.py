@@ -47,11 +47,19 @@ def passes_black_list(entry, blacklist):
 
 class Frame(object):
     """Frame is the container for all Tool objects and state information."""
-    def __init__(self, config, setup, times, drivers, dryrun):
+    def __init__(self, config, setup, times, drivers, dryrun,
+                 fetch_content=None):
         self.config = config
         self.times = times
         self.dryrun = dryrun
+        # callable that takes a list of Path names and returns the
+        # content withheld by the server as a Content element
+        self.fetch_content = fetch_content
         self.times['initialization'] = time.time()
+        # how long each tool's inventory took, by tool name.  these
+        # are durations, so they're kept apart from the timestamps in
+        # self.times, which are reported to the server
+        self.inventory_times = dict()
         self.setup = setup
         self.tools = []
         self.states = {}
@@ -97,10 +105,25 @@ class Frame(object):
         self.logger.info("Loaded tool drivers:")
         self.logger.info([tool.name for tool in self.tools])
 
+        # index the configuration once: which tools handle each
+        # entry, and which structure (Bundle or Independent) each
+        # entry belongs to.  all of the bookkeeping below uses these
+        # instead of re-scanning the configuration for every tool
+        self.entry_tools = dict()
+        self.entry_structs = dict()
+        for struct in config:
+            for entry in struct:
+                self.entry_tools[entry] = []
+                self.entry_structs[entry] = struct
+        for tool in self.tools:
+            for entry in tool.handled:
+                if entry in self.entry_tools:
+                    self.entry_tools[entry].append(tool)
+
         # find entries not handled by any tools
         self.unhandled = [entry for struct in config
-                     for entry in struct
-                     if entry not in self.handled]
+                          for entry in struct
+                          if not self.entry_tools[entry]]
 
         if self.unhandled:
             self.logger.error("The following entries are not handled by any tool:")
@@ -124,25 +147,32 @@ class Frame(object):
         entries = dict()
         for struct in config:
             for entry in struct:
-                for tool in self.tools:
-                    if tool.handlesEntry(entry):
-                        pkey = tool.primarykey(entry)
-                        if pkey in entries:
-                            entries[pkey] += 1
-                        else:
-                            entries[pkey] = 1
+                for tool in self.handling_tools(entry):
+                    pkey = tool.primarykey(entry)
+                    if pkey in entries:
+                        entries[pkey] += 1
+                    else:
+                        entries[pkey] = 1
         multi = [e for e, c in entries.items() if c > 1]
         if multi:
             self.logger.debug("The following entries are included multiple times:")
             for entry in multi:
                 self.logger.debug(entry)
 
+    def handling_tools(self, entry):
+        """Return the list of tools that handle the given entry."""
+        try:
+            return self.entry_tools[entry]
+        except KeyError:
+            # not part of the configuration (e.g., an extra entry)
+            return [tool for tool in self.tools if tool.handlesEntry(entry)]
+
     def promptFilter(self, prompt, entries):
         """Filter a supplied list based on user input."""
         ret = []
         entries.sort(cmpent)
         for entry in entries[:]:
-            if entry in self.unhandled:
+            if not self.handling_tools(entry):
                 # don't prompt for entries that can't be installed
                 continue
             if 'qtext' in entry.attrib:
@@ -206,10 +236,12 @@ class Frame(object):
 
         # take care of important entries first
         if not self.dryrun:
+            important = set(self.__important__)
+            candidates = set(self.whitelist)
             for cfile in self.config.findall(".//Path"):
-                if (cfile.get('name') not in self.__important__ or
+                if (cfile.get('name') not in important or
                     cfile.get('type') != 'file' or
-                    cfile not in self.whitelist):
+                    cfile not in candidates):
                     continue
                 parent = cfile.getparent()
                 if ((parent.tag == "Bundle" and
@@ -220,8 +252,8 @@ class Frame(object):
                     (parent.tag == "Independent" and
                      (self.setup['bundle'] or self.setup['skipindep']))):
                     continue
-                tl = [t for t in self.tools
-                      if t.handlesEntry(cfile) and t.canVerify(cfile)]
+                tl = [t for t in self.handling_tools(cfile)
+                      if t.canVerify(cfile)]
                 if tl:
                     if self.setup['interactive'] and not \
                            self.promptFilter("Install %s: %s? (y/N):", [cfile]):
@@ -249,11 +281,82 @@ class Frame(object):
         for struct in self.config.getchildren():
             for entry in struct.getchildren():
                 self.states[entry] = False
-        for tool in self.tools:
-            try:
-                tool.Inventory(self.states)
-            except:
-                self.logger.error("%s.Inventory() call failed:" % tool.name, exc_info=1)
+        threads = int(self.setup.get('inventory_threads', 1))
+        if threads > 1:
+            self.logger.debug("Running inventory with %s threads" % threads)
+            for (tool, states, err) in \
+                    Bcfg2.Client.Tools.parallel_map(self._inventory_tool,
+                                                    self.tools, threads):
+                if err:
+                    self.logger.error("%s.Inventory() call failed:" %
+                                      tool.name, exc_info=err)
+                else:
+                    self.states.update(states)
+        else:
+            for tool in self.tools:
+                try:
+                    self._inventory_tool(tool, self.states)
+                except:
+                    self.logger.error("%s.Inventory() call failed:" % tool.name, exc_info=1)
+
+    def _inventory_tool(self, tool, states=None):
+        """Run inventory for a single tool, possibly in a worker
+        thread.  If no states dict is given, the tool's entry states
+        are collected in a private dict, which is merged into
+        self.states by the calling thread.  The time the tool's
+        inventory took is recorded in self.inventory_times."""
+        if states is None:
+            states = dict()
+        start = time.time()
+        try:
+            tool.Inventory(states)
+        finally:
+            self.inventory_times[tool.name] = time.time() - start
+            self.logger.debug("%s.Inventory() took %.2fs" %
+                              (tool.name, self.inventory_times[tool.name]))
+        return states
+
+    def FetchContent(self):
+        """Fetch the content of Path entries whose content was
+        withheld by the server and that failed verification, and
+        verify them again."""
+        deferred = [entry for entry in self.states
+                    if (not self.states[entry] and
+                        entry.get('deferred', 'false') == 'true')]
+        if not deferred or self.fetch_content is None:
+            return
+        self.logger.info("Fetching content of %d entries" % len(deferred))
+        try:
+            content = self.fetch_content([e.get('name') for e in deferred])
+        except:
+            self.logger.error("Failed to fetch file content", exc_info=1)
+            return
+        self.times['content_download'] = time.time()
+        bodies = dict([(body.get('name'), body)
+                       for body in content.findall('Path')])
+        modlists = dict()
+        for entry in deferred:
+            body = bodies.get(entry.get('name'))
+            if body is None:
+                self.logger.error("Server did not send content of %s" %
+                                  entry.get('name'))
+                continue
+            if body.get('encoding'):
+                entry.set('encoding', body.get('encoding'))
+            entry.text = body.text
+            del entry.attrib['deferred']
+            for tool in self.handling_tools(entry):
+                if not tool.canVerify(entry):
+                    continue
+                if tool not in modlists:
+                    modlists[tool] = tool.buildModlist()
+                try:
+                    func = getattr(tool, "Verify%s" % entry.tag)
+                    self.states[entry] = func(entry, modlists[tool])
+                except:
+                    self.logger.error("%s: Unexpected failure verifying %s" %
+                                      (tool.name, entry.get('name')),
+                                      exc_info=1)
 
     def Decide(self):
         """Set self.whitelist based on user interaction."""
@@ -311,14 +414,16 @@ class Frame(object):
         if self.setup['skipindep']:
             bundles = filter(lambda b: b.tag == 'Bundle', bundles)
 
+        bundle_set = set(bundles)
         self.whitelist = [e for e in self.whitelist
-                          if True in [e in b for b in bundles]]
+                          if self.entry_structs.get(e) in bundle_set]
+        whitelist = set(self.whitelist)
 
         # first process prereq actions
         for bundle in bundles[:]:
             if bundle.tag != 'Bundle':
                 continue
-            bmodified = len([item for item in bundle if item in self.whitelist])
+            bmodified = len([item for item in bundle if item in whitelist])
             actions = [a for a in bundle.findall('./Action')
                        if (a.get('timing') != 'post' and
                            (bmodified or a.get('when') == 'always'))]
@@ -333,26 +438,35 @@ class Frame(object):
                 self.logger.info("Bundle %s failed prerequisite action" %
                                  (bundle.get('name')))
                 bundles.remove(bundle)
-                b_to_remv = [ent for ent in self.whitelist if ent in bundle]
+                b_to_remv = [ent for ent in self.whitelist
+                             if self.entry_structs.get(ent) is bundle]
                 if b_to_remv:
                     self.logger.info("Not installing entries from Bundle %s" %
                                      (bundle.get('name')))
                     self.logger.info(["%s:%s" % (e.tag, e.get('name'))
                                       for e in b_to_remv])
-                    [self.whitelist.remove(ent) for ent in b_to_remv]
+                    whitelist.difference_update(b_to_remv)
+                    self.whitelist = [ent for ent in self.whitelist
+                                      if ent in whitelist]
 
         if self.setup['interactive']:
             self.whitelist = self.promptFilter(prompt, self.whitelist)
             self.removal = self.promptFilter(rprompt, self.removal)
+            whitelist = set(self.whitelist)
 
         for entry in candidates:
-            if entry not in self.whitelist:
+            if entry not in whitelist:
                 self.blacklist.append(entry)
 
     def DispatchInstallCalls(self, entries):
         """Dispatch install calls to underlying tools."""
+        todo = dict([(tool, []) for tool in self.tools])
+        for entry in entries:
+            for tool in self.handling_tools(entry):
+                if tool.canInstall(entry):
+                    todo[tool].append(entry)
         for tool in self.tools:
-            handled = [entry for entry in entries if tool.canInstall(entry)]
+            handled = todo[tool]
             if not handled:
                 continue
             try:
@@ -364,8 +478,9 @@ class Frame(object):
         """Install all entries."""
         self.DispatchInstallCalls(self.whitelist)
         mods = self.modified
-        mbundles = [struct for struct in self.config.findall('Bundle') if \
-                    [mod for mod in mods if mod in struct]]
+        mstructs = set([self.entry_structs.get(mod) for mod in mods])
+        mbundles = [struct for struct in self.config.findall('Bundle')
+                    if struct in mstructs]
 
         if self.modified:
             # Handle Bundle interdeps
@@ -378,8 +493,9 @@ class Frame(object):
                     tool.Inventory(self.states, [bundle])
                 except:
                     self.logger.error("%s.Inventory() call failed:" % tool.name, exc_info=1)
+            blacklist = set(self.blacklist)
             clobbered = [entry for bundle in mbundles for entry in bundle \
-                         if not self.states[entry] and entry not in self.blacklist]
+                         if not self.states[entry] and entry not in blacklist]
             if clobbered:
                 self.logger.debug("Found clobbered entries:")
                 self.logger.debug(["%s:%s" % (entry.tag, entry.get('name')) \
@@ -404,8 +520,12 @@ class Frame(object):
 
     def Remove(self):
         """Remove extra entries."""
+        todo = dict([(tool, []) for tool in self.tools])
+        for entry in self.removal:
+            for tool in self.handling_tools(entry):
+                todo[tool].append(entry)
         for tool in self.tools:
-            extras = [entry for entry in self.removal if tool.handlesEntry(entry)]
+            extras = todo[tool]
             if extras:
                 try:
                     tool.Remove(extras)
@@ -455,6 +575,7 @@ class Frame(object):
         """Run all methods."""
         self.Inventory()
         self.times['inventory'] = time.time()
+        self.FetchContent()
         self.CondDisplayState('initial')
         self.InstallImportant()
         self.Decide()
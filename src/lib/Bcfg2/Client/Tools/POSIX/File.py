@@ -9,13 +9,108 @@ try:
 except ImportError:
     # py3k, incompatible syntax with py2.4
     exec("from .base import POSIXTool")
-from Bcfg2.Compat import unicode, b64encode, b64decode
+from Bcfg2.Compat import unicode, b64encode, b64decode, cPickle
+
+try:
+    from hashlib import sha256
+except ImportError:
+    # python 2.4; no digest verification
+    sha256 = None
+
+
+class DigestCache(object):
+    """ persistent cache of the digests of files on disk, keyed by
+    the stat information of each file, so that unchanged files do not
+    have to be read and hashed on every run """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.cache = dict()
+        self.dirty = False
+        try:
+            self.cache = cPickle.load(open(self.path, 'rb'))
+        except (IOError, OSError):
+            pass
+        except:
+            self.logger.warning("POSIX: Failed to load digest cache %s: %s" %
+                                (self.path, sys.exc_info()[1]))
+
+    def _key(self, ondisk):
+        return (ondisk[stat.ST_DEV], ondisk[stat.ST_INO],
+                ondisk[stat.ST_SIZE], ondisk.st_mtime, ondisk.st_ctime)
+
+    def get(self, fname, ondisk):
+        """ get the cached digest of fname, or None if it is not
+        cached or if the file has changed since it was cached """
+        try:
+            key, digest = self.cache[fname]
+        except KeyError:
+            return None
+        if key == self._key(ondisk):
+            return digest
+        return None
+
+    def set(self, fname, ondisk, digest):
+        """ cache the digest of fname """
+        self.cache[fname] = (self._key(ondisk), digest)
+        self.dirty = True
+
+    def save(self):
+        """ write the cache to disk if it has changed """
+        if not self.dirty:
+            return
+        tmpfile = None
+        try:
+            # write to a temp file in the same directory and rename
+            # it into place, so the cache is never left truncated
+            (fd, tmpfile) = \
+                tempfile.mkstemp(dir=os.path.dirname(self.path) or '.',
+                                 prefix=os.path.basename(self.path))
+            cachefile = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(self.cache, cachefile, 2)
+            finally:
+                cachefile.close()
+            os.rename(tmpfile, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            self.logger.warning("POSIX: Failed to save digest cache %s: %s" %
+                                (self.path, sys.exc_info()[1]))
+            if tmpfile is not None and os.path.exists(tmpfile):
+                try:
+                    os.unlink(tmpfile)
+                except OSError:
+                    pass
+
 
 class POSIXFile(POSIXTool):
     __req__ = ['name', 'perms', 'owner', 'group']
+    __digest_attr__ = 'sha256'
+    __digest_blocksize__ = 65536
+
+    def __init__(self, logger, setup, config):
+        POSIXTool.__init__(self, logger, setup, config)
+        self.digest_cache = None
+        if (sha256 is not None and 'posix_digest_cache' in setup and
+            setup['posix_digest_cache']):
+            self.digest_cache = DigestCache(setup['posix_digest_cache'],
+                                            logger)
+
+    def inventory_done(self):
+        if self.digest_cache is not None:
+            self.digest_cache.save()
 
     def fully_specified(self, entry):
-        return entry.text is not None or entry.get('empty', 'false') == 'true'
+        return (entry.text is not None or
+                entry.get('empty', 'false') == 'true' or
+                self._is_deferred(entry))
+
+    def _is_deferred(self, entry):
+        """ return True if the server withheld the content of the
+        entry, and only sent its digest """
+        return (entry.get('deferred', 'false') == 'true' and
+                entry.get(self.__digest_attr__) is not None)
 
     def _is_string(self, strng, encoding):
         """ Returns true if the string contains no ASCII control
@@ -51,43 +146,117 @@ class POSIXFile(POSIXTool):
                                       (entry.get('name'), err))
         return (tempdata, is_binary)
 
+    def _digest(self, data):
+        """ get the hex digest of the given string """
+        if isinstance(data, unicode):
+            try:
+                data = data.encode(self.setup['encoding'])
+            except UnicodeEncodeError:
+                return None
+        return sha256(data).hexdigest()
+
+    def _file_digest(self, entry, ondisk):
+        """ get the hex digest of the file on disk, reading it in
+        chunks so that large files are not read into memory.  Raises
+        IOError if the file cannot be read. """
+        fname = entry.get('name')
+        if self.digest_cache is not None:
+            digest = self.digest_cache.get(fname, ondisk)
+            if digest is not None:
+                return digest
+        digest = sha256()
+        fd = open(fname, 'rb')
+        try:
+            while True:
+                block = fd.read(self.__digest_blocksize__)
+                if not block:
+                    break
+                digest.update(block)
+        finally:
+            fd.close()
+        digest = digest.hexdigest()
+        if self.digest_cache is not None:
+            self.digest_cache.set(fname, ondisk, digest)
+        return digest
+
     def verify(self, entry, modlist):
         ondisk = self._exists(entry)
-        tempdata, is_binary = self._get_data(entry)
+        is_binary = entry.get('encoding', 'ascii') == 'base64'
+        expected = entry.get(self.__digest_attr__)
 
         different = False
         content = None
+        ondisk_digest = None
+        if ondisk and sha256 is not None and expected:
+            # the server sent a digest of the file content; if it
+            # matches the file on disk, we don't even need to decode
+            # the entry content
+            ondisk_digest = self._safe_file_digest(entry, ondisk)
         if not ondisk:
             # first, see if the target file exists at all; if not,
             # they're clearly different
             different = True
             content = ""
-        elif len(tempdata) != ondisk[stat.ST_SIZE]:
-            # next, see if the size of the target file is different
-            # from the size of the desired content
+        elif ondisk_digest is not None and ondisk_digest == expected:
+            pass
+        elif self._is_deferred(entry):
+            different = True
+        elif is_binary and ondisk_digest is not None:
+            # the digest of binary content doesn't depend on the
+            # encoding, so the server's digest is authoritative
             different = True
         else:
-            # finally, read in the target file and compare them
-            # directly. comparison could be done with a checksum,
-            # which might be faster for big binary files, but slower
-            # for everything else
-            try:
-                content = open(entry.get('name')).read()
-            except IOError:
-                self.logger.error("POSIX: Failed to read %s: %s" %
-                                  (entry.get("name"), sys.exc_info()[1]))
-                return False
-            different = content != tempdata
+            tempdata, is_binary = self._get_data(entry)
+            if len(tempdata) != ondisk[stat.ST_SIZE]:
+                # next, see if the size of the target file is
+                # different from the size of the desired content
+                different = True
+            elif sha256 is not None:
+                # finally, compare the digest of the desired content
+                # with the digest of the target file, which is read in
+                # chunks rather than all at once.  the file is only
+                # read once, even if it was already compared with the
+                # server's digest.
+                try:
+                    if ondisk_digest is None:
+                        ondisk_digest = self._file_digest(entry, ondisk)
+                    different = ondisk_digest != self._digest(tempdata)
+                except IOError:
+                    self.logger.error("POSIX: Failed to read %s: %s" %
+                                      (entry.get("name"), sys.exc_info()[1]))
+                    return False
+            else:
+                # no hashlib; read in the target file and compare them
+                # directly
+                try:
+                    content = open(entry.get('name')).read()
+                except IOError:
+                    self.logger.error("POSIX: Failed to read %s: %s" %
+                                      (entry.get("name"), sys.exc_info()[1]))
+                    return False
+                different = content != tempdata
 
         if different:
             self.logger.debug("POSIX: %s has incorrect contents" %
                               entry.get("name"))
+        if different and not self._is_deferred(entry):
+            # if we don't have the content yet, we can't say how it
+            # differs.  the client will fetch the content and verify
+            # the entry again.
             self._get_diffs(
                 entry, interactive=self.setup['interactive'],
                 sensitive=entry.get('sensitive', 'false').lower() == 'true',
                 is_binary=is_binary, content=content)
         return POSIXTool.verify(self, entry, modlist) and not different
 
+    def _safe_file_digest(self, entry, ondisk):
+        """ get the digest of the file on disk, or None if it cannot
+        be read """
+        try:
+            return self._file_digest(entry, ondisk)
+        except IOError:
+            return None
+
     def _write_tmpfile(self, entry):
         filedata, _ = self._get_data(entry)
         # get a temp file to write to that is in the same directory as
@@ -132,6 +301,10 @@ class POSIXFile(POSIXTool):
 
     def install(self, entry):
         """Install device entries."""
+        if self._is_deferred(entry):
+            self.logger.error("POSIX: Content of %s was not received from "
+                              "the server" % entry.get("name"))
+            return False
         if not os.path.exists(os.path.dirname(entry.get('name'))):
             if not self._makedirs(entry,
                                   path=os.path.dirname(entry.get('name'))):
@@ -172,8 +345,9 @@ class POSIXFile(POSIXTool):
             prompt.append('Binary file, no printable diff')
             attrs['current_bfile'] = b64encode(content)
         else:
+            tempdata = self._get_data(entry)[0]
             if interactive:
-                diff = self._diff(content, self._get_data(entry)[0],
+                diff = self._diff(content, tempdata,
                                   difflib.unified_diff,
                                   filename=entry.get("name"))
                 if diff:
@@ -188,7 +362,7 @@ class POSIXFile(POSIXTool):
                     prompt.append("Diff took too long to compute, no "
                                   "printable diff")
             if not sensitive:
-                diff = self._diff(content, self._get_data(entry)[0],
+                diff = self._diff(content, tempdata,
                                   difflib.ndiff, filename=entry.get("name"))
                 if diff:
                     attrs["current_bdiff"] = b64encode("\n".join(diff))
@@ -36,9 +36,10 @@ class POSIX(Bcfg2.Client.Tools.Tool):
         # set it, because self.handled has some really crazy
         # semi-global thing going that, frankly, scares the crap out
         # of me.
+        handled = set(self.handled)
         for struct in config:
             self.handled.extend([e for e in struct
-                                 if (e not in self.handled and
+                                 if (e not in handled and
                                      self.handlesEntry(e))])
 
     def _load_handlers(self):
@@ -79,6 +80,54 @@ class POSIX(Bcfg2.Client.Tools.Tool):
             return False
         return True
 
+    def Inventory(self, states, structures=[]):
+        """Verify entries, optionally in batches on a pool of worker
+        threads if both inventory_threads and the POSIX
+        inventory_batch size are set."""
+        batch_size = int(self.setup.get('posix_inventory_batch', 0))
+        threads = int(self.setup.get('inventory_threads', 1))
+        if batch_size < 1 or threads < 2:
+            Bcfg2.Client.Tools.Tool.Inventory(self, states, structures)
+        else:
+            self._batch_inventory(states, structures, batch_size, threads)
+        for hdlr in self._handlers.values():
+            hdlr.inventory_done()
+
+    def _batch_inventory(self, states, structures, batch_size, threads):
+        """Verify entries in batches of batch_size on a pool of
+        worker threads"""
+        if not structures:
+            structures = self.config.getchildren()
+        mods = self.buildModlist()
+        entries = [entry for struct in structures
+                   for entry in struct.getchildren()
+                   if self.canVerify(entry)]
+        batches = [entries[i:i + batch_size]
+                   for i in range(0, len(entries), batch_size)]
+        self.logger.debug("POSIX: Verifying %d entries in %d batches" %
+                          (len(entries), len(batches)))
+        for batch, result, exc_info in Bcfg2.Client.Tools.parallel_map(
+            lambda b: self._verify_batch(b, mods), batches, threads):
+            if exc_info is None:
+                states.update(result)
+            else:
+                self.logger.error("POSIX: Unexpected failure verifying a "
+                                  "batch of %d entries" % len(batch),
+                                  exc_info=exc_info)
+        self.extra = self.FindExtra()
+
+    def _verify_batch(self, entries, modlist):
+        """Verify a list of entries, returning a dict of entry
+        states"""
+        states = dict()
+        for entry in entries:
+            try:
+                states[entry] = self.VerifyPath(entry, modlist)
+            except:
+                self.logger.error("POSIX: Unexpected failure verifying %s" %
+                                  entry.get("name"), exc_info=1)
+        return states
+
     def InstallPath(self, entry):
         """Dispatch install to the proper method according to type"""
         self.logger.debug("POSIX: Installing entry %s:%s:%s" %
@@ -36,6 +36,11 @@ class POSIXTool(Bcfg2.Client.Tools.Tool):
         # checking is done by __req__
         return True
 
+    def inventory_done(self):
+        """ called by the POSIX tool after it has verified all
+        entries """
+        pass
+
     def verify(self, entry, modlist):
         if not self._verify_metadata(entry):
             return False
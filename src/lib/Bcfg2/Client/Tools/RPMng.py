@@ -87,7 +87,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
                 self.logger.error('Pre-emptive prelink failed: %s' % output)
 
 
-    def RefreshPackages(self):
+    def RefreshPackages(self, names=None):
         """
             Creates self.installed{} which is a dict of installed packages.
 
@@ -102,22 +102,51 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
                                       {'name':'foo', 'epoch':None,
                                        'version':'1', 'release':2,
                                        'arch':'x86_64'} ]
+
+            self.installed is built from a snapshot of the rpmdb that is
+            shared for the whole run.  If names is given, only those
+            packages are re-read from the rpmdb.
         """
-        self.installed = {}
-        refresh_ts = rpmtools.rpmtransactionset()
-        # Don't bother with signature checks at this stage. The GPG keys might
-        # not be installed.
-        refresh_ts.setVSFlags(rpm._RPMVSF_NODIGESTS|rpm._RPMVSF_NOSIGNATURES)
-        for nevra in rpmtools.rpmpackagelist(refresh_ts):
-            self.installed.setdefault(nevra['name'], []).append(nevra)
+        rpmtools.rpmdb_snapshot().refresh(names)
+        self.installed = rpmtools.rpmdb_snapshot().installed()
         if self.setup['debug']:
             print("The following package instances are installed:")
             for name, instances in list(self.installed.items()):
                 self.logger.debug("    " + name)
                 for inst in instances:
                     self.logger.debug("        %s" %self.str_evra(inst))
-        refresh_ts.closeDB()
-        del refresh_ts
+
+    def Inventory(self, states, structures=[]):
+        """
+           Verify packages, using up to inventory_threads threads for
+           the rpm --verify checks.  Each VerifyPackage() call uses its
+           own transaction set and only touches the instance_status of
+           its own entry's instances.
+        """
+        threads = int(self.setup.get('inventory_threads', 1))
+        if threads <= 1:
+            return Bcfg2.Client.Tools.PkgTool.Inventory(self, states,
+                                                        structures)
+
+        if not structures:
+            structures = self.config.getchildren()
+        mods = self.buildModlist()
+        entries = [entry for struct in structures
+                   for entry in struct.getchildren()
+                   if self.canVerify(entry)]
+
+        def verify(entry):
+            return getattr(self, "Verify%s" % entry.tag)(entry, mods)
+
+        for entry, result, exc_info in \
+                Bcfg2.Client.Tools.parallel_map(verify, entries, threads):
+            if exc_info is None:
+                states[entry] = result
+            else:
+                self.logger.error("Unexpected failure of verification "
+                                  "method for entry type %s" % entry.tag,
+                                  exc_info=exc_info)
+        self.extra = self.FindExtra()
 
     def VerifyPackage(self, entry, modlist, pinned_version=None):
         """
@@ -476,7 +505,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
                 if pkg_modified == True:
                     self.modified.append(pkg)
 
-        self.RefreshPackages()
+        self.RefreshPackages([pkg.get('name') for pkg in packages])
         self.extra = self.FindExtraPackages()
 
     def FixInstance(self, instance, inst_status):
@@ -601,7 +630,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
             if cmdrc == 0:
                 # The rpm command succeeded.  All packages installed.
                 self.logger.info("Single Pass for InstallOnlyPkgs Succeded")
-                self.RefreshPackages()
+                self.RefreshPackages(self._instance_names(install_only_pkgs))
 
             else:
                 # The rpm command failed.  No packages installed.
@@ -623,7 +652,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
 
                 install_pkg_set = set([self.instance_status[inst].get('pkg') \
                                                       for inst in install_only_pkgs])
-                self.RefreshPackages()
+                self.RefreshPackages(self._instance_names(install_only_pkgs))
 
         # Install GPG keys.
         if len(gpg_keys) > 0:
@@ -640,7 +669,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
                     self.logger.debug("Installed %s-%s-%s" % \
                                               (self.instance_status[inst].get('pkg').get('name'), \
                                                inst.get('version'), inst.get('release')))
-            self.RefreshPackages()
+            self.RefreshPackages(['gpg-pubkey'])
             self.gpg_keyids = self.getinstalledgpg()
             pkg = self.instance_status[gpg_keys[0]].get('pkg')
             states[pkg] = self.VerifyPackage(pkg, [])
@@ -658,7 +687,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
                 self.logger.info("Single Pass for Upgraded Packages Succeded")
                 upgrade_pkg_set = set([self.instance_status[inst].get('pkg') \
                                                       for inst in upgrade_pkgs])
-                self.RefreshPackages()
+                self.RefreshPackages(self._instance_names(upgrade_pkgs))
             else:
                 # The rpm command failed.  No packages upgraded.
                 # Try upgrading instances individually.
@@ -679,7 +708,7 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
 
                 upgrade_pkg_set = set([self.instance_status[inst].get('pkg') \
                                                       for inst in upgrade_pkgs])
-                self.RefreshPackages()
+                self.RefreshPackages(self._instance_names(upgrade_pkgs))
 
         if not self.setup['kevlar']:
             for pkg_entry in packages:
@@ -690,6 +719,11 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
         for entry in [ent for ent in packages if states[ent]]:
             self.modified.append(entry)
 
+    def _instance_names(self, instances):
+        """Return the names of the packages the given instances belong to."""
+        return set([self.instance_status[inst].get('pkg').get('name')
+                    for inst in instances])
+
     def canInstall(self, entry):
         """Test if entry has enough information to be installed."""
         if not self.handlesEntry(entry):
@@ -970,13 +1004,9 @@ class RPMng(Bcfg2.Client.Tools.PkgTool):
            (big-endian) of the key ID which is good enough for our purposes.
 
         """
-        init_ts = rpmtools.rpmtransactionset()
-        init_ts.setVSFlags(rpm._RPMVSF_NODIGESTS|rpm._RPMVSF_NOSIGNATURES)
-        gpg_hdrs = rpmtools.getheadersbykeyword(init_ts, **{'name':'gpg-pubkey'})
-        keyids = [ header[rpm.RPMTAG_VERSION] for header in gpg_hdrs]
+        keyids = [inst['version']
+                  for inst in self.installed.get('gpg-pubkey', [])]
         keyids.append('None')
-        init_ts.closeDB()
-        del init_ts
         return keyids
 
     def VerifyPath(self, entry, _):
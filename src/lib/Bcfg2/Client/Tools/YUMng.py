@@ -333,7 +333,7 @@ class YUMng(Bcfg2.Client.Tools.PkgTool):
 
         return results
 
-    def RefreshPackages(self):
+    def RefreshPackages(self, names=None):
         """
             Creates self.installed{} which is a dict of installed packages.
 
@@ -348,11 +348,24 @@ class YUMng(Bcfg2.Client.Tools.PkgTool):
                                       {'name':'foo', 'epoch':None,
                                        'version':'1', 'release':2,
                                        'arch':'x86_64'} ]
+
+            If names is given, only those packages are re-read from the
+            rpmdb and the rest of self.installed is left alone.
         """
 
-        self.installed = {}
-        packages = self._getGPGKeysAsPackages() + \
-                   self.yb.rpmdb.returnPackages()
+        if names is None:
+            self.installed = {}
+            packages = self._getGPGKeysAsPackages() + \
+                       self.yb.rpmdb.returnPackages()
+        else:
+            packages = []
+            for name in names:
+                if name in self.installed:
+                    del self.installed[name]
+                if name == 'gpg-pubkey':
+                    packages.extend(self._getGPGKeysAsPackages())
+                else:
+                    packages.extend(self.yb.rpmdb.searchNevra(name=name))
         for po in packages:
             d = {}
             for i in ['name', 'epoch', 'version', 'release', 'arch']:
@@ -720,15 +733,30 @@ class YUMng(Bcfg2.Client.Tools.PkgTool):
             return True
 
     def _runYumTransaction(self):
+        # names of all packages the transaction may touch, including
+        # dependencies and obsoleted packages, so that only those need
+        # to be re-read afterwards
+        touched = set()
+
+        def note_members():
+            touched.update([txmbr.name
+                            for txmbr in self.yb.tsInfo.getMembers()])
+
         def cleanup():
+            note_members()
             self.yb.closeRpmDB()
-            self.RefreshPackages()
+            if touched:
+                self.RefreshPackages(touched)
+            else:
+                self.RefreshPackages()
 
         rDisplay = RPMDisplay(self.logger)
         yDisplay = YumDisplay(self.logger)
         # Run the Yum Transaction
+        note_members()
         try:
             rescode, restring = self.yb.buildTransaction()
+            note_members()
         except yum.Errors.YumBaseError:
             e = sys.exc_info()[1]
             self.logger.error("Yum transaction error: %s" % str(e))
@@ -758,6 +786,7 @@ class YUMng(Bcfg2.Client.Tools.PkgTool):
             self.yb.conf.skip_broken = True
             try:
                 rescode, restring = self.yb.buildTransaction()
+                note_members()
                 if rescode != 1:
                     self.yb.processTransaction(callback=yDisplay,
                                                rpmDisplay=rDisplay)
@@ -862,7 +891,7 @@ class YUMng(Bcfg2.Client.Tools.PkgTool):
                                                      inst.get('simplefile'))
                 self._installGPGKey(inst, key_file)
 
-            self.RefreshPackages()
+            self.RefreshPackages(['gpg-pubkey'])
             pkg = self.instance_status[gpg_keys[0]].get('pkg')
             states[pkg] = self.VerifyPackage(pkg, [])
 
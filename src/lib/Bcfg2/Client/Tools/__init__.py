@@ -3,9 +3,10 @@ import os
 import sys
 import stat
 import time
+import threading
 from subprocess import Popen, PIPE
 import Bcfg2.Client.XML
-from Bcfg2.Compat import input, walk_packages
+from Bcfg2.Compat import input, walk_packages, Queue, Empty
 
 __all__ = [m[1] for m in walk_packages(path=__path__)]
 drivers = [item for item in __all__ if item not in ['rpmtools']]
@@ -17,6 +18,39 @@ class toolInstantiationError(Exception):
     pass
 
 
+def parallel_map(func, items, threads):
+    """Call func on each of items using at most threads worker
+    threads.  Returns a list of (item, result, exc_info) tuples in
+    the same order as items; exc_info is None unless func raised an
+    exception, in which case result is None."""
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for idx in range(len(items)):
+        queue.put(idx)
+
+    def worker():
+        while True:
+            try:
+                idx = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[idx] = (items[idx], func(items[idx]), None)
+            except:
+                results[idx] = (items[idx], None, sys.exc_info())
+
+    workers = []
+    for i in range(max(1, min(threads, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+    return results
+
+
 class executor:
     """This class runs stuff for us"""
 
@@ -170,13 +170,125 @@ def rpmpackagelist(rts):
                {'name':'bar', 'epoch':'10', 'version':'5.2', 'release':'2', 'arch':'x86_64' } ]
 
     """
-    return [{'name':header[rpm.RPMTAG_NAME],
-             'epoch':header[rpm.RPMTAG_EPOCH],
-             'version':header[rpm.RPMTAG_VERSION],
-             'release':header[rpm.RPMTAG_RELEASE],
-             'arch':header[rpm.RPMTAG_ARCH],
-             'gpgkeyid':header.sprintf("%|SIGGPG?{%{SIGGPG:pgpsig}}:{None}|").split()[-1]}
-             for header in rts.dbMatch()]
+    return [header_pkgspec(header) for header in rts.dbMatch()]
+
+def header_pkgspec(header):
+    """
+        Return the pkgspec dict for an rpm header, as used by
+        rpmpackagelist().
+
+    """
+    return {'name':header[rpm.RPMTAG_NAME],
+            'epoch':header[rpm.RPMTAG_EPOCH],
+            'version':header[rpm.RPMTAG_VERSION],
+            'release':header[rpm.RPMTAG_RELEASE],
+            'arch':header[rpm.RPMTAG_ARCH],
+            'gpgkeyid':header.sprintf("%|SIGGPG?{%{SIGGPG:pgpsig}}:{None}|").split()[-1]}
+
+def rpmdb_stamp():
+    """
+        Return a value that changes whenever the rpmdb is modified, or
+        None if the rpmdb directory can't be read.  The Berkeley DB
+        environment files (__db.*) are skipped since they change on
+        every read.
+
+    """
+    dbpath = rpm.expandMacro('%_dbpath')
+    stamp = []
+    try:
+        for fname in sorted(os.listdir(dbpath)):
+            if fname.startswith('__db'):
+                continue
+            fstat = os.stat(os.path.join(dbpath, fname))
+            stamp.append((fname, fstat.st_mtime, fstat.st_size))
+    except OSError:
+        return None
+    return tuple(stamp)
+
+class RPMDBSnapshot(object):
+    """
+        An indexed snapshot of the installed packages, so that the
+        rpmdb only has to be walked once per run.
+
+        packages maps each package name to a list of pkgspec dicts as
+        returned by rpmpackagelist().  refresh() rescans the whole
+        rpmdb only when it has changed since the last full scan; after
+        a transaction, refresh(names) re-reads just the packages that
+        were touched (and anything they obsolete).
+
+    """
+    def __init__(self):
+        self.packages = {}
+        self.stamp = None
+
+    def refresh(self, names=None):
+        """
+            Bring the snapshot up to date.  If names is given, only
+            those packages are re-read from the rpmdb.  Returns True if
+            the snapshot changed.
+
+        """
+        stamp = rpmdb_stamp()
+        if names is None and stamp is not None and stamp == self.stamp:
+            return False
+        refresh_ts = rpmtransactionset()
+        # Don't bother with signature checks at this stage. The GPG keys
+        # might not be installed.
+        refresh_ts.setVSFlags(rpm._RPMVSF_NODIGESTS|rpm._RPMVSF_NOSIGNATURES)
+        if names is None:
+            packages = {}
+            for header in refresh_ts.dbMatch():
+                nevra = header_pkgspec(header)
+                packages.setdefault(nevra['name'], []).append(nevra)
+            self.packages = packages
+        else:
+            names = list(names)
+            seen = set()
+            while names:
+                name = names.pop()
+                if name in seen:
+                    continue
+                seen.add(name)
+                instances = []
+                for header in refresh_ts.dbMatch(rpm.RPMTAG_NAME, name):
+                    instances.append(header_pkgspec(header))
+                    # packages can be removed by being obsoleted, so
+                    # re-read anything the new package obsoletes too
+                    names.extend(header[rpm.RPMTAG_OBSOLETENAME] or [])
+                if instances:
+                    self.packages[name] = instances
+                elif name in self.packages:
+                    del self.packages[name]
+        refresh_ts.closeDB()
+        del refresh_ts
+        if names is None:
+            # only a full scan brings the whole snapshot up to date;
+            # packages not in names (e.g., dependencies pulled in by
+            # a transaction) may still have changed
+            self.stamp = stamp
+        return True
+
+    def installed(self):
+        """
+            Return a copy of the snapshot in the format used by the
+            RPM drivers' self.installed.
+
+        """
+        return dict([(name, list(instances))
+                     for name, instances in self.packages.items()])
+
+_snapshot = None
+
+def rpmdb_snapshot():
+    """
+        Return the RPMDBSnapshot shared by all of the RPM drivers in
+        this process.
+
+    """
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = RPMDBSnapshot()
+    return _snapshot
 
 def getindexbykeyword(index_ts, **kwargs):
     """
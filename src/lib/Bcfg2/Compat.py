@@ -114,6 +114,11 @@ try:
 except ImportError:
     from UserDict import DictMixin as MutableMapping
 
+try:
+    from collections import Mapping
+except ImportError:
+    from UserDict import DictMixin as Mapping
+
 
 # in py3k __cmp__ is no longer magical, so we define a mixin that can
 # be used to define the rich comparison operators from __cmp__
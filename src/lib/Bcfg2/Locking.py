@@ -0,0 +1,101 @@
+""" Locks for sharing server state between threads """
+
+import threading
+
+
+class ReadWriteLock(object):
+    """ A lock that can be held by any number of readers at once, or
+    by a single writer.  Writers are preferred: once a writer is
+    waiting, new readers wait until it has released the lock, so a
+    steady stream of readers can't starve writers.  Both read and
+    write locks are reentrant, and a thread that holds the write lock
+    can also acquire the read lock.
+
+    Each time the write lock is fully released, the generation is
+    incremented, so readers can tell which set of changes the state
+    they read reflects.
+
+    acquire() and release() acquire and release the write lock, so a
+    ReadWriteLock can be used anywhere a threading.Lock is used. """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        # thread -> number of times it holds the read lock
+        self.readers = dict()
+        self.writer = None
+        self.writes = 0
+        self.writers_waiting = 0
+        self.generation = 0
+
+    def acquire_read(self):
+        """ acquire the read lock, blocking while another thread
+        holds or is waiting for the write lock """
+        me = threading.currentThread()
+        self.cond.acquire()
+        try:
+            if me in self.readers:
+                self.readers[me] += 1
+                return
+            while (self.writer is not me and
+                   (self.writer is not None or self.writers_waiting)):
+                self.cond.wait()
+            self.readers[me] = 1
+        finally:
+            self.cond.release()
+
+    def release_read(self):
+        """ release the read lock """
+        me = threading.currentThread()
+        self.cond.acquire()
+        try:
+            if me not in self.readers:
+                raise RuntimeError("Cannot release un-acquired read lock")
+            self.readers[me] -= 1
+            if not self.readers[me]:
+                del self.readers[me]
+                if not self.readers:
+                    self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def acquire_write(self):
+        """ acquire the write lock, blocking while any other thread
+        holds the read or write lock """
+        me = threading.currentThread()
+        self.cond.acquire()
+        try:
+            if self.writer is me:
+                self.writes += 1
+                return
+            if me in self.readers:
+                # upgrading would deadlock with any other reader that
+                # tried to do the same
+                raise RuntimeError("Cannot acquire write lock while "
+                                   "holding read lock")
+            self.writers_waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = me
+            self.writes = 1
+        finally:
+            self.cond.release()
+
+    def release_write(self):
+        """ release the write lock """
+        self.cond.acquire()
+        try:
+            if self.writer is not threading.currentThread():
+                raise RuntimeError("Cannot release un-acquired write lock")
+            self.writes -= 1
+            if not self.writes:
+                self.writer = None
+                self.generation += 1
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    acquire = acquire_write
+    release = release_write
@@ -441,6 +441,40 @@ SERVER_FAM_IGNORE = \
                     '4913', '.gitignore',],
            cf=('server', 'ignore_files'),
            cook=list_split)
+SERVER_FAM_COALESCE = \
+    Option('Seconds to wait for more file monitor events to coalesce',
+           default=0.1,
+           cf=('server', 'coalesce_window'),
+           cook=float)
+SERVER_LOAD_THREADS = \
+    Option('Number of threads used to read the repository at startup',
+           default=0,
+           cf=('server', 'load_threads'),
+           cook=int)
+SERVER_REPOSITORY_CACHE = \
+    Option('Directory to cache parsed XMLSrc (Rules, Pkgmgr, Deps) data '
+           'in across restarts',
+           default=None,
+           cf=('server', 'repository_cache'))
+SERVER_ADMIN_ADDRESSES = \
+    Option('Addresses allowed to query traces and run profiling',
+           default=[],
+           cf=('server', 'admin_addresses'),
+           cook=list_split)
+SERVER_TRACE_BUFFER = \
+    Option('Number of request traces to keep in memory (0 disables tracing)',
+           default=100,
+           cf=('server', 'trace_buffer'),
+           cook=int)
+SERVER_TRACE_THRESHOLD = \
+    Option('Requests that take at least this many seconds keep full traces',
+           default=5.0,
+           cf=('server', 'trace_threshold'),
+           cook=float)
+SERVER_TRACE_FILE = \
+    Option('File to append request traces to, as lines of JSON',
+           default=None,
+           cf=('server', 'trace_file'))
 SERVER_LISTEN_ALL = \
     Option('Listen on all interfaces',
            default=False,
@@ -683,6 +717,21 @@ CLIENT_DLIST = \
            cmd='-l',
            odesc='<whitelist|blacklist|none>',
            cf=('client', 'decision'))
+CLIENT_INVENTORY_THREADS = \
+    Option('Number of threads to use for tool inventory',
+           default=1,
+           cmd='--inventory-threads',
+           odesc='<threads>',
+           cf=('client', 'inventory_threads'),
+           cook=int,
+           long_arg=True)
+CLIENT_LAZY_CONTENT = \
+    Option('Only download the content of files that need to be changed',
+           default=False,
+           cmd='--lazy-content',
+           cf=('client', 'lazy_content'),
+           cook=get_bool,
+           long_arg=True)
 CLIENT_DECISION_LIST = \
     Option('Decision List',
            default=False,
@@ -725,6 +774,15 @@ LINT_FILES_ON_STDIN = \
            long_arg=True)
 
 # individual client tool options
+CLIENT_POSIX_INVENTORY_BATCH = \
+    Option('Number of POSIX entries to verify per inventory thread',
+           default=0,
+           cf=('POSIX', 'inventory_batch'),
+           cook=int)
+CLIENT_POSIX_DIGEST_CACHE = \
+    Option('Path to the cache of POSIX file digests',
+           default=None,
+           cf=('POSIX', 'digest_cache'))
 CLIENT_APT_TOOLS_INSTALL_PATH = \
     Option('Apt tools install path',
            default='/usr',
@@ -890,6 +948,10 @@ CFG_VALIDATION = \
            cf=('cfg', 'validation'),
            long_arg=True,
            cook=get_bool)
+CFG_CHEETAH_CACHE = \
+    Option('Directory to cache compiled Cheetah templates in',
+           default=None,
+           cf=('cfg', 'cheetah_cache'))
 
 # bcfg2-crypt options
 ENCRYPT = \
@@ -929,6 +991,39 @@ CRYPT_REMOVE = \
            cmd="--remove",
            long_arg=True)
 
+# bcfg2-admin perf options
+PERF_PROFILE = \
+    Option('Profile the requests the server handles',
+           default=False,
+           cmd='--profile',
+           long_arg=True)
+PERF_PROFILE_SECONDS = \
+    Option('Number of seconds to profile requests for',
+           default=0,
+           cmd='--seconds',
+           odesc='<seconds>',
+           long_arg=True,
+           cook=int)
+PERF_PROFILE_REQUESTS = \
+    Option('Number of requests to profile',
+           default=0,
+           cmd='--requests',
+           odesc='<requests>',
+           long_arg=True,
+           cook=int)
+PERF_PROFILE_CPROFILE = \
+    Option('Profile requests with cProfile instead of sampling them',
+           default=False,
+           cmd='--cprofile',
+           long_arg=True)
+PERF_PROFILE_LIMIT = \
+    Option('Number of functions to show profiling results for',
+           default=30,
+           cmd='--limit',
+           odesc='<count>',
+           long_arg=True,
+           cook=int)
+
 # Option groups
 CLI_COMMON_OPTIONS = dict(configfile=CFILE,
                           debug=DEBUG,
@@ -947,6 +1042,13 @@ SERVER_COMMON_OPTIONS = dict(repo=SERVER_REPOSITORY,
                              password=SERVER_PASSWORD,
                              filemonitor=SERVER_FILEMONITOR,
                              ignore=SERVER_FAM_IGNORE,
+                             coalesce_window=SERVER_FAM_COALESCE,
+                             load_threads=SERVER_LOAD_THREADS,
+                             repository_cache=SERVER_REPOSITORY_CACHE,
+                             admin_addresses=SERVER_ADMIN_ADDRESSES,
+                             trace_buffer=SERVER_TRACE_BUFFER,
+                             trace_threshold=SERVER_TRACE_THRESHOLD,
+                             trace_file=SERVER_TRACE_FILE,
                              location=SERVER_LOCATION,
                              static=SERVER_STATIC,
                              key=SERVER_KEY,
@@ -965,7 +1067,9 @@ CRYPT_OPTIONS = dict(encrypt=ENCRYPT,
                      remove=CRYPT_REMOVE)
 
 DRIVER_OPTIONS = \
-    dict(apt_install_path=CLIENT_APT_TOOLS_INSTALL_PATH,
+    dict(posix_inventory_batch=CLIENT_POSIX_INVENTORY_BATCH,
+         posix_digest_cache=CLIENT_POSIX_DIGEST_CACHE,
+         apt_install_path=CLIENT_APT_TOOLS_INSTALL_PATH,
          apt_var_path=CLIENT_APT_TOOLS_VAR_PATH,
          apt_etc_path=CLIENT_SYSTEM_ETC_PATH,
          portage_binpkgonly=CLIENT_PORTAGE_BINPKGONLY,
@@ -1026,6 +1130,8 @@ CLIENT_COMMON_OPTIONS = \
          ca=CLIENT_CA,
          serverCN=CLIENT_SCNS,
          timeout=CLIENT_TIMEOUT,
+         inventory_threads=CLIENT_INVENTORY_THREADS,
+         lazy_content=CLIENT_LAZY_CONTENT,
          decision_list=CLIENT_DECISION_LIST)
 CLIENT_COMMON_OPTIONS.update(DRIVER_OPTIONS)
 CLIENT_COMMON_OPTIONS.update(CLI_COMMON_OPTIONS)
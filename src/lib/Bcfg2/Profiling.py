@@ -0,0 +1,250 @@
+""" Time-bounded profiling of the requests handled by a running
+server """
+
+import os
+import sys
+import time
+import logging
+import threading
+
+try:
+    from thread import get_ident
+except ImportError:
+    from _thread import get_ident
+
+try:
+    try:
+        import cProfile as profile
+    except ImportError:
+        import profile
+    import pstats
+    has_profile = True
+except ImportError:
+    has_profile = False
+
+logger = logging.getLogger(__name__)
+
+#: the modes the profiler can run in
+MODES = ['sample', 'cprofile']
+
+
+def bcfg2_function(filename, lineno, funcname):
+    """ get a short name for a function if it is in a Bcfg2 module,
+    or None if it isn't """
+    idx = filename.rfind(os.sep + "Bcfg2" + os.sep)
+    if idx == -1:
+        return None
+    return "%s:%d(%s)" % (filename[idx + 1:], lineno, funcname)
+
+
+class Profiler(object):
+    """ Profiles the requests that a server handles for a limited
+    number of seconds or requests, whichever comes first.  In
+    'sample' mode, the stacks of the threads that are handling
+    requests are sampled every interval seconds, which has little
+    overhead; in 'cprofile' mode, each request is run under cProfile,
+    which counts calls exactly but slows requests down.  Either way,
+    the results are aggregated per function, limited to functions in
+    Bcfg2 modules. """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.mode = None
+        self.running = False
+        self.start_time = None
+        self.end_time = None
+        self.seconds = None
+        self.max_requests = None
+        self.requests = 0
+        # thread id -> number of requests it is handling
+        self.active = dict()
+        # sampling results: number of samples taken, and function ->
+        # number of samples in which it was on the stack, and in
+        # which it was the innermost Bcfg2 function
+        self.samples = 0
+        self.cumulative = dict()
+        self.own = dict()
+        # cProfile results
+        self.stats = None
+
+    def start(self, mode='sample', seconds=None, requests=None):
+        """ start profiling.  profiling stops after the given number
+        of seconds or requests, whichever comes first; at least one
+        of them must be given. """
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode %s" % mode)
+        if mode == 'cprofile' and not has_profile:
+            raise ValueError("Profiling modules not available")
+        if mode == 'sample' and not hasattr(sys, "_current_frames"):
+            raise ValueError("Sampling not available on this Python")
+        if not seconds and not requests:
+            raise ValueError("A number of seconds or requests to profile "
+                             "must be given")
+        self.lock.acquire()
+        try:
+            if self.running:
+                raise ValueError("Profiling is already running")
+            self.mode = mode
+            self.seconds = seconds
+            self.max_requests = requests
+            self.requests = 0
+            self.samples = 0
+            self.cumulative = dict()
+            self.own = dict()
+            self.stats = None
+            self.start_time = time.time()
+            self.end_time = None
+            self.running = True
+        finally:
+            self.lock.release()
+        logger.info("Started %s profiling for %s seconds, %s requests" %
+                    (mode, seconds, requests))
+        if mode == 'sample':
+            sampler = threading.Thread(name="ProfileSampler",
+                                       target=self._sample)
+            sampler.setDaemon(True)
+            sampler.start()
+
+    def stop(self):
+        """ stop profiling """
+        self.lock.acquire()
+        try:
+            self._stop()
+        finally:
+            self.lock.release()
+
+    def _stop(self):
+        """ stop profiling.  the caller must hold the lock. """
+        if self.running:
+            self.running = False
+            self.end_time = time.time()
+            logger.info("Stopped %s profiling after %.03fs, %d requests" %
+                        (self.mode, self.end_time - self.start_time,
+                         self.requests))
+
+    def _check_limits(self):
+        """ stop profiling if the time or request limit has been
+        reached.  the caller must hold the lock. """
+        if not self.running:
+            return
+        if ((self.seconds and
+             time.time() - self.start_time >= self.seconds) or
+            (self.max_requests and self.requests >= self.max_requests)):
+            self._stop()
+
+    def run_request(self, func, *args, **kwargs):
+        """ call func to handle a request, profiling it if profiling
+        is running """
+        if not self.running:
+            return func(*args, **kwargs)
+        ident = get_ident()
+        self.lock.acquire()
+        self.active[ident] = self.active.get(ident, 0) + 1
+        mode = self.mode
+        self.lock.release()
+        prof = None
+        try:
+            if mode == 'cprofile':
+                prof = profile.Profile()
+                return prof.runcall(func, *args, **kwargs)
+            else:
+                return func(*args, **kwargs)
+        finally:
+            self.lock.acquire()
+            try:
+                self.active[ident] -= 1
+                if not self.active[ident]:
+                    del self.active[ident]
+                if self.running and self.mode == mode:
+                    self.requests += 1
+                    if prof is not None:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(prof)
+                        else:
+                            self.stats.add(prof)
+                    self._check_limits()
+            finally:
+                self.lock.release()
+
+    def _sample(self):
+        """ the main loop of the sampling thread """
+        while True:
+            time.sleep(self.interval)
+            self.lock.acquire()
+            try:
+                self._check_limits()
+                if not self.running or self.mode != 'sample':
+                    return
+                frames = sys._current_frames()
+                for ident in self.active:
+                    if ident in frames:
+                        self._add_sample(frames[ident])
+            finally:
+                self.lock.release()
+
+    def _add_sample(self, frame):
+        """ add the stack of a thread to the samples.  the caller must
+        hold the lock. """
+        self.samples += 1
+        seen = set()
+        innermost = True
+        while frame is not None:
+            code = frame.f_code
+            name = bcfg2_function(code.co_filename, code.co_firstlineno,
+                                  code.co_name)
+            if name is not None and name not in seen:
+                seen.add(name)
+                self.cumulative[name] = self.cumulative.get(name, 0) + 1
+                if innermost:
+                    self.own[name] = self.own.get(name, 0) + 1
+                    innermost = False
+            frame = frame.f_back
+
+    def get_results(self, limit=None):
+        """ get the profiling results so far.  Returns a dict with
+        the mode, whether profiling is still running, the number of
+        seconds and requests profiled, the number of samples taken (in
+        sample mode), and a list of functions, slowest first.  Each
+        function is a dict with its name, the number of calls (0 in
+        sample mode), and the time spent in it, excluding ('own') and
+        including ('cumulative') the time spent in the functions it
+        calls.  In sample mode, the times are estimated from the
+        number of samples; own time includes time spent in non-Bcfg2
+        functions it calls. """
+        self.lock.acquire()
+        try:
+            self._check_limits()
+            funcs = []
+            if self.mode == 'sample':
+                for name, count in self.cumulative.items():
+                    funcs.append(dict(function=name,
+                                      calls=0,
+                                      own=self.own.get(name, 0) *
+                                      self.interval,
+                                      cumulative=count * self.interval))
+            elif self.stats is not None:
+                for key, data in self.stats.stats.items():
+                    name = bcfg2_function(*key)
+                    if name is not None:
+                        funcs.append(dict(function=name,
+                                          calls=data[1],
+                                          own=data[2],
+                                          cumulative=data[3]))
+            funcs.sort(key=lambda f: f['cumulative'], reverse=True)
+            if limit:
+                funcs = funcs[:limit]
+            if self.start_time is None:
+                elapsed = 0.0
+            elif self.end_time is None:
+                elapsed = time.time() - self.start_time
+            else:
+                elapsed = self.end_time - self.start_time
+            return dict(mode=self.mode or '',
+                        running=self.running,
+                        seconds=elapsed,
+                        requests=self.requests,
+                        samples=self.samples,
+                        functions=funcs)
+        finally:
+            self.lock.release()
@@ -1,14 +1,23 @@
 import sys
+import time
 
 import Bcfg2.Options
 import Bcfg2.Proxy
 import Bcfg2.Server.Admin
 
+# Compatibility import
+from Bcfg2.Compat import xmlrpclib
+
 
 class Perf(Bcfg2.Server.Admin.Mode):
     __shorthelp__ = ("Query server for performance data")
-    __longhelp__ = (__shorthelp__ + "\n\nbcfg2-admin perf\n")
-    __usage__ = ("bcfg2-admin perf")
+    __longhelp__ = (__shorthelp__ + "\n\nbcfg2-admin perf"
+                                    "\nbcfg2-admin perf --profile "
+                                    "[--seconds=<seconds>] "
+                                    "[--requests=<requests>] [--cprofile] "
+                                    "[--limit=<count>]\n")
+    __usage__ = ("bcfg2-admin perf [--profile [--seconds=<seconds>] "
+                 "[--requests=<requests>] [--cprofile] [--limit=<count>]]")
 
     def __call__(self, args):
         output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
@@ -20,6 +29,11 @@ class Perf(Bcfg2.Server.Admin.Mode):
             'server': Bcfg2.Options.SERVER_LOCATION,
             'user': Bcfg2.Options.CLIENT_USER,
             'timeout': Bcfg2.Options.CLIENT_TIMEOUT,
+            'profile': Bcfg2.Options.PERF_PROFILE,
+            'seconds': Bcfg2.Options.PERF_PROFILE_SECONDS,
+            'requests': Bcfg2.Options.PERF_PROFILE_REQUESTS,
+            'cprofile': Bcfg2.Options.PERF_PROFILE_CPROFILE,
+            'limit': Bcfg2.Options.PERF_PROFILE_LIMIT,
             }
         setup = Bcfg2.Options.OptionParser(optinfo)
         setup.parse(sys.argv[1:])
@@ -30,9 +44,59 @@ class Perf(Bcfg2.Server.Admin.Mode):
                                            cert=setup['certificate'],
                                            ca=setup['ca'],
                                            timeout=setup['timeout'])
+        if setup['profile']:
+            self.profile(proxy, setup)
+            return
         data = proxy.get_statistics()
         for key in sorted(data.keys()):
             output.append((key, ) +
                           tuple(["%.06f" % item
                                  for item in data[key][:-1]] + [data[key][-1]]))
         self.print_table(output)
+
+    def profile(self, proxy, setup):
+        """ profile the requests the server handles, and print the
+        functions that the most time was spent in """
+        seconds = setup['seconds']
+        requests = setup['requests']
+        if not seconds and not requests:
+            seconds = 30
+        if setup['cprofile']:
+            mode = 'cprofile'
+        else:
+            mode = 'sample'
+        try:
+            proxy.start_profiling(seconds, requests, mode)
+        except xmlrpclib.Fault:
+            self.errExit(sys.exc_info()[1].faultString)
+        msg = []
+        if seconds:
+            msg.append("%s seconds" % seconds)
+        if requests:
+            msg.append("%s requests" % requests)
+        print("Profiling for %s (%s mode); press Ctrl-C to stop early" %
+              (" or ".join(msg), mode))
+        try:
+            while proxy.get_profile(1)['running']:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            proxy.stop_profiling()
+
+        results = proxy.get_profile(setup['limit'])
+        summary = "Profiled %d requests in %.03fs" % (results['requests'],
+                                                     results['seconds'])
+        if results['mode'] == 'sample':
+            summary += " (%d samples)" % results['samples']
+        print(summary)
+        if not results['functions']:
+            return
+        output = [('Function', 'Calls', 'Own', 'Cumulative')]
+        for func in results['functions']:
+            if results['mode'] == 'sample':
+                calls = '-'
+            else:
+                calls = str(func['calls'])
+            output.append((func['function'], calls,
+                           "%.03f" % func['own'],
+                           "%.03f" % func['cumulative']))
+        self.print_table(output)
@@ -0,0 +1,104 @@
+import sys
+import time
+
+import Bcfg2.Options
+import Bcfg2.Proxy
+import Bcfg2.Server.Admin
+
+# Compatibility import
+from Bcfg2.Compat import xmlrpclib
+
+
+class Trace(Bcfg2.Server.Admin.Mode):
+    __shorthelp__ = ("Query server for traces of recent requests")
+    __longhelp__ = (__shorthelp__ + "\n\nbcfg2-admin trace list [<client>]"
+                                    "\nbcfg2-admin trace slow [<client>]"
+                                    "\nbcfg2-admin trace show <trace id>\n")
+    __usage__ = ("bcfg2-admin trace [options] [list|slow|show] "
+                 "[<client>|<trace id>]")
+
+    def __call__(self, args):
+        optinfo = {
+            'ca': Bcfg2.Options.CLIENT_CA,
+            'certificate': Bcfg2.Options.CLIENT_CERT,
+            'key': Bcfg2.Options.SERVER_KEY,
+            'password': Bcfg2.Options.SERVER_PASSWORD,
+            'server': Bcfg2.Options.SERVER_LOCATION,
+            'user': Bcfg2.Options.CLIENT_USER,
+            'timeout': Bcfg2.Options.CLIENT_TIMEOUT,
+            }
+        setup = Bcfg2.Options.OptionParser(optinfo)
+        setup.parse(args)
+        args = setup['args']
+        if not args:
+            args = ['list']
+        if args[0] not in ['list', 'slow', 'show']:
+            self.errExit("Unknown command %s\nUsage: %s" %
+                         (args[0], self.__usage__))
+        if args[0] == 'show' and len(args) != 2:
+            self.errExit("Usage: bcfg2-admin trace show <trace id>")
+
+        proxy = Bcfg2.Proxy.ComponentProxy(setup['server'],
+                                           setup['user'],
+                                           setup['password'],
+                                           key=setup['key'],
+                                           cert=setup['certificate'],
+                                           ca=setup['ca'],
+                                           timeout=setup['timeout'])
+        try:
+            if args[0] == 'show':
+                self.show_trace(proxy.get_trace(args[1]))
+            else:
+                if len(args) > 1:
+                    client = args[1]
+                else:
+                    client = ''
+                self.list_traces(proxy.get_traces(client, args[0] == 'slow'))
+        except xmlrpclib.Fault:
+            self.errExit("Failed to get traces: %s" %
+                         sys.exc_info()[1].faultString)
+        except Bcfg2.Proxy.ProxyError:
+            self.errExit("Proxy Error: %s" % sys.exc_info()[1])
+
+    def list_traces(self, traces):
+        """ print a table of trace summaries """
+        output = [('ID', 'Time', 'Request', 'Client', 'Duration',
+                   'Slowest step')]
+        for trace in traces:
+            if trace['steps']:
+                step = sorted(trace['steps'], key=lambda s: s[1])[-1]
+                slowest = "%s (%.03fs)" % tuple(step)
+            else:
+                slowest = ''
+            if trace['slow']:
+                duration = "%.03fs *" % trace['duration']
+            else:
+                duration = "%.03fs" % trace['duration']
+            output.append((str(trace['id']),
+                           time.strftime("%Y-%m-%d %H:%M:%S",
+                                         time.localtime(trace['start'])),
+                           trace['name'], trace['client'], duration,
+                           slowest))
+        self.print_table(output)
+
+    def show_trace(self, trace):
+        """ print the spans of a trace as a tree """
+        print("Trace %s: %s for %s at %s took %.03fs" %
+              (trace['id'], trace['name'], trace['client'],
+               time.strftime("%Y-%m-%d %H:%M:%S",
+                             time.localtime(trace['start'])),
+               trace['duration']))
+        if not trace['slow']:
+            print("Only the steps of requests faster than the slow request "
+                  "threshold are kept")
+        self._show_span(trace['spans'], 0)
+
+    def _show_span(self, span, depth):
+        """ print a span and its children """
+        attrs = " ".join(["%s=%s" % (k, v)
+                          for k, v in sorted(span['attrs'].items())])
+        print("%8.03fs %8.03fs  %s%s %s" % (span['start'], span['duration'],
+                                           "  " * depth, span['name'],
+                                           attrs))
+        for child in span['children']:
+            self._show_span(child, depth + 1)
@@ -13,6 +13,7 @@ __all__ = [
         'Snapshots',
         'Syncdb',
         'Tidy',
+        'Trace',
         'Viz',
         'Xcmd'
         ]
@@ -122,7 +123,7 @@ class MetadataCore(Mode):
         except Bcfg2.Server.Core.CoreInitError:
             msg = sys.exc_info()[1]
             self.errExit("Core load failed: %s" % msg)
-        self.bcore.fam.handle_events_in_interval(5)
+        self.bcore.block_for_initial_load()
         self.metadata = self.bcore.metadata
 
 
@@ -68,6 +68,7 @@ class Core(BaseCore):
     def run(self):
         if self.setup['daemon']:
             self._daemonize()
+        self.block_for_initial_load()
 
         hostname, port = urlparse(self.setup['location'])[1].split(':')
         server_address = socket.getaddrinfo(hostname,
@@ -87,6 +87,7 @@ class Core(BaseCore):
         return cherrypy.serving.response.body
 
     def run(self):
+        self.block_for_initial_load()
         hostname, port = urlparse(self.setup['location'])[1].split(':')
         if self.setup['listen_all']:
             hostname = '0.0.0.0'
@@ -1,12 +1,14 @@
 """Bcfg2.Server.Core provides the runtime support for Bcfg2 modules."""
 
 import os
+import copy
 import atexit
 import logging
 import select
 import sys
 import threading
 import time
+import base64
 import inspect
 import lxml.etree
 from traceback import format_exc
@@ -14,10 +16,20 @@ import Bcfg2.settings
 import Bcfg2.Server
 import Bcfg2.Logger
 import Bcfg2.Server.FileMonitor
+import Bcfg2.Server.Dependencies
+from Bcfg2.Locking import ReadWriteLock
+from Bcfg2.Cache import LRUCache
 from Bcfg2.Statistics import Statistics
-from Bcfg2.Compat import xmlrpclib, reduce
+from Bcfg2.Tracing import Tracer
+from Bcfg2.Profiling import Profiler
+from Bcfg2.Compat import xmlrpclib, unicode
 from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError
 
+try:
+    from hashlib import sha256
+except ImportError:
+    sha256 = None
+
 try:
     import psyco
     psyco.full()
@@ -30,9 +42,41 @@ def exposed(func):
     func.exposed = True
     return func
 
+def traced(func):
+    """ decorator that traces each call of an XML-RPC method as a
+    request, and profiles it if profiling is running """
+    def inner(obj, address, *args, **kwargs):
+        span = obj.tracer.start_span(func.__name__, root=True,
+                                     address=address[0])
+        try:
+            return obj.profiler.run_request(func, obj, address, *args,
+                                            **kwargs)
+        finally:
+            obj.tracer.end_span(span)
+    inner.__name__ = func.__name__
+    inner.__doc__ = func.__doc__
+    return inner
+
+def admin_only(func):
+    """ decorator for XML-RPC methods that can only be called from
+    the addresses listed in the admin_addresses option, because they
+    expose other clients' data or change how the server runs """
+    def inner(obj, address, *args, **kwargs):
+        if address[0] not in obj.admin_addresses:
+            obj.logger.warning("Refused %s call from %s, which is not in "
+                               "admin_addresses" % (func.__name__,
+                                                    address[0]))
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "%s may only be called from "
+                                  "admin_addresses" % func.__name__)
+        return func(obj, address, *args, **kwargs)
+    inner.__name__ = func.__name__
+    inner.__doc__ = func.__doc__
+    return inner
+
 class track_statistics(object):
     """ decorator that tracks execution time for the given
-    function """
+    function, and traces it as a span of the current request """
 
     def __init__(self, name=None):
         self.name = name
@@ -45,9 +89,11 @@ class track_statistics(object):
             name = "%s:%s" % (obj.__class__.__name__, self.name)
 
             start = time.time()
+            span = obj.tracer.start_span(self.name)
             try:
                 return func(obj, *args, **kwargs)
             finally:
+                obj.tracer.end_span(span)
                 obj.stats.add_value(name, time.time() - start)
 
         return inner
@@ -73,7 +119,11 @@ class BaseCore(object):
     Bcfg2 Server logic and modules.
     """
 
+    #: the number of clients whose deferred file content is kept
+    __deferred_content_size__ = 512
+
     def __init__(self, setup, start_fam_thread=False):
+        self.start_time = time.time()
         self.datastore = setup['repo']
 
         if setup['debug']:
@@ -98,7 +148,7 @@ class BaseCore(object):
             fm = Bcfg2.Server.FileMonitor.available[setup['filemonitor']]
         except KeyError:
             self.logger.error("File monitor driver %s not available; "
-                              "forcing to default" % filemonitor)
+                              "forcing to default" % setup['filemonitor'])
             fm = Bcfg2.Server.FileMonitor.available['default']
         famargs = dict(ignore=[], debug=False)
         if 'ignore' in setup:
@@ -111,18 +161,41 @@ class BaseCore(object):
             msg = "Failed to instantiate fam driver %s" % setup['filemonitor']
             self.logger.error(msg, exc_info=1)
             raise CoreInitError(msg)
+        if 'coalesce_window' in setup:
+            self.fam.coalesce_window = setup['coalesce_window']
         self.pubspace = {}
         self.cfile = setup['configfile']
         self.cron = {}
         self.plugins = {}
         self.plugin_blacklist = {}
         self.revision = '-1'
+        # content of Path entries withheld from the most recent
+        # GetConfig(checksum=True) call for each client.  this is
+        # bounded, since clients that never upload statistics would
+        # otherwise leak their content; GetContent rebuilds the
+        # configuration of clients whose content has been discarded
+        self.deferred_content = LRUCache(self.__deferred_content_size__)
         self.password = setup['password']
         self.encoding = setup['encoding']
         self.setup = setup
         atexit.register(self.shutdown)
         # Create an event to signal worker threads to shutdown
         self.terminate = threading.Event()
+        # set once the file monitor has handled the initial events
+        # for the whole repository
+        self.initial_load = threading.Event()
+        self.stats = Statistics()
+        self.fam.stats = self.stats
+        self.tracer = Tracer(size=setup.get('trace_buffer', 100),
+                             threshold=setup.get('trace_threshold', 5.0),
+                             logfile=setup.get('trace_file'))
+        self.profiler = Profiler()
+        # the addresses that may query traces and run profiling
+        self.admin_addresses = setup.get('admin_addresses', [])
+        # a Bcfg2.Server.Dependencies.DependencyMap to record the
+        # dependencies of each client configuration that is built
+        # in, if any
+        self.dependencies = None
 
         # generate Django ORM settings.  this must be done _before_ we
         # load plugins
@@ -151,6 +224,25 @@ class BaseCore(object):
         if '' in setup['plugins']:
             setup['plugins'].remove('')
 
+        if setup.get('repository_cache'):
+            # XMLSrc files that are unchanged since the snapshot was
+            # written don't need to be read or parsed again
+            Bcfg2.Server.Plugin.snapshot = \
+                Bcfg2.Server.Plugin.RepositorySnapshot(
+                    os.path.join(setup['repository_cache'],
+                                 "repository.snapshot"))
+            Bcfg2.Server.Plugin.snapshot.load()
+
+        if setup.get('load_threads', 0) > 0:
+            # read and parse the repository on a pool of threads, so
+            # that handling the initial file monitor events doesn't
+            # have to
+            Bcfg2.Server.Plugin.preloader = \
+                Bcfg2.Server.Plugin.RepositoryPreloader(ignore=famargs['ignore'])
+            Bcfg2.Server.Plugin.preloader.preload(
+                [os.path.join(self.datastore, p) for p in setup['plugins']],
+                setup['load_threads'])
+
         for plugin in setup['plugins']:
             if not plugin in self.plugins:
                 self.init_plugins(plugin)
@@ -191,14 +283,18 @@ class BaseCore(object):
         self.fam_thread = \
             threading.Thread(name="%sFAMThread" % setup['filemonitor'],
                              target=self._file_monitor_thread)
-        self.lock = threading.Lock()
+        # file monitor events are handled with the write lock held,
+        # so batches of events are applied one at a time, and the
+        # lock's generation counts them.  client builds don't take
+        # the lock, so applying a batch never stalls a build; files
+        # are read and parsed before the lock is taken, so handlers
+        # only have to put the parsed data in place.
+        self.lock = ReadWriteLock()
 
         if start_fam_thread:
             self.fam_thread.start()
             self.fam.AddMonitor(self.cfile, self.setup)
 
-        self.stats = Statistics()
-
     def plugins_by_type(self, base_cls):
         """Return a list of loaded plugins that match the passed type.
 
@@ -226,9 +322,55 @@ class BaseCore(object):
                 self.fam.handle_event_set(self.lock)
             except:
                 continue
-            # VCS plugin periodic updates
+            if (self.initial_load.isSet() and
+                Bcfg2.Server.Plugin.preloader is not None):
+                # discard any files that were read for the events
+                # that have been handled but not used
+                Bcfg2.Server.Plugin.preloader.clear()
+            if (not self.initial_load.isSet() and
+                self.fam.initial_load_complete()):
+                self._initial_load_complete()
+            # VCS plugin updates; the revision is only re-read if the
+            # VCS metadata has changed
             for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Version):
-                self.revision = plugin.get_revision()
+                self.revision = plugin.current_revision()
+
+    def _initial_load_complete(self):
+        """ record that the initial load of the repository is
+        complete """
+        if not self.initial_load.isSet():
+            elapsed = time.time() - self.start_time
+            self.stats.add_value("%s:initial_load" % self.__class__.__name__,
+                                 elapsed)
+            self.logger.info("Initial repository load completed in %.03fs" %
+                             elapsed)
+            # discard any preloaded data that wasn't used.  from now
+            # on, files are read ahead of handling each batch of file
+            # monitor events, without holding the core lock
+            Bcfg2.Server.Plugin.preloader = \
+                Bcfg2.Server.Plugin.RepositoryPreloader()
+            snapshot = Bcfg2.Server.Plugin.snapshot
+            if snapshot is not None:
+                self.logger.info("Used parsed data from the repository "
+                                 "snapshot for %d of %d files" %
+                                 (snapshot.hits,
+                                  snapshot.hits + snapshot.misses))
+                snapshot.save()
+            self.initial_load.set()
+
+    def block_for_initial_load(self, timeout=None):
+        """ Block until the file monitor has handled the initial
+        events for the whole repository, so that all plugins have
+        loaded their data.  If the file monitor thread is not
+        running, events are handled in the calling thread.  Returns
+        False if the load did not complete within timeout seconds. """
+        if self.initial_load.isSet():
+            return True
+        if self.fam_thread.isAlive():
+            self.initial_load.wait(timeout)
+        elif self.fam.wait_for_initial_load(timeout=timeout, lock=self.lock):
+            self._initial_load_complete()
+        return self.initial_load.isSet()
 
     def init_plugins(self, plugin):
         """Handling for the plugins."""
@@ -251,8 +393,12 @@ class BaseCore(object):
         cplugs = [conflict for conflict in plug.conflicts
                   if conflict in self.plugins]
         self.plugin_blacklist[plug.name] = cplugs
+        start = time.time()
         try:
             self.plugins[plugin] = plug(self, self.datastore)
+            elapsed = time.time() - start
+            self.stats.add_value("%s:init" % plug.name, elapsed)
+            self.logger.debug("Loaded plugin %s in %.03fs" % (plugin, elapsed))
         except PluginInitError:
             self.logger.error("Failed to instantiate plugin %s" % plugin,
                               exc_info=1)
@@ -267,6 +413,11 @@ class BaseCore(object):
             self.fam.shutdown()
             for plugin in list(self.plugins.values()):
                 plugin.shutdown()
+            if (self.initial_load.isSet() and
+                Bcfg2.Server.Plugin.snapshot is not None):
+                Bcfg2.Server.Plugin.snapshot.save()
+            self.tracer.close()
+            self.profiler.stop()
 
     def client_run_hook(self, hook, metadata):
         """Checks the data structure."""
@@ -274,16 +425,20 @@ class BaseCore(object):
         try:
             for plugin in \
                     self.plugins_by_type(Bcfg2.Server.Plugin.ClientRunHooks):
+                span = self.tracer.start_span("%s:%s" % (plugin.name, hook))
                 try:
-                    getattr(plugin, hook)(metadata)
-                except AttributeError:
-                    err = sys.exc_info()[1]
-                    self.logger.error("Unknown attribute: %s" % err)
-                    raise
-                except:
-                    err = sys.exc_info()[1]
-                    self.logger.error("%s: Error invoking hook %s: %s" %
-                                      (plugin, hook, err))
+                    try:
+                        getattr(plugin, hook)(metadata)
+                    except AttributeError:
+                        err = sys.exc_info()[1]
+                        self.logger.error("Unknown attribute: %s" % err)
+                        raise
+                    except:
+                        err = sys.exc_info()[1]
+                        self.logger.error("%s: Error invoking hook %s: %s" %
+                                          (plugin, hook, err))
+                finally:
+                    self.tracer.end_span(span)
         finally:
             self.stats.add_value("%s:client_run_hook:%s" %
                                  (self.__class__.__name__, hook),
@@ -293,38 +448,52 @@ class BaseCore(object):
     def validate_structures(self, metadata, data):
         """Checks the data structure."""
         for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.StructureValidator):
+            span = self.tracer.start_span("%s:validate_structures" %
+                                          plugin.name)
             try:
-                plugin.validate_structures(metadata, data)
-            except Bcfg2.Server.Plugin.ValidationError:
-                err = sys.exc_info()[1]
-                self.logger.error("Plugin %s structure validation failed: %s" %
-                                  (plugin.name, err))
-                raise
-            except:
-                self.logger.error("Plugin %s: unexpected structure validation "
-                                  "failure" % plugin.name, exc_info=1)
+                try:
+                    plugin.validate_structures(metadata, data)
+                except Bcfg2.Server.Plugin.ValidationError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Plugin %s structure validation "
+                                      "failed: %s" % (plugin.name, err))
+                    raise
+                except:
+                    self.logger.error("Plugin %s: unexpected structure "
+                                      "validation failure" % plugin.name,
+                                      exc_info=1)
+            finally:
+                self.tracer.end_span(span)
 
     @track_statistics()
     def validate_goals(self, metadata, data):
         """Checks that the config matches the goals enforced by the plugins."""
         for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.GoalValidator):
+            span = self.tracer.start_span("%s:validate_goals" % plugin.name)
             try:
-                plugin.validate_goals(metadata, data)
-            except Bcfg2.Server.Plugin.ValidationError:
-                err = sys.exc_info()[1]
-                self.logger.error("Plugin %s goal validation failed: %s" %
-                                  (plugin.name, err.message))
-                raise
-            except:
-                self.logger.error("Plugin %s: unexpected goal validation "
-                                  "failure" % plugin.name, exc_info=1)
+                try:
+                    plugin.validate_goals(metadata, data)
+                except Bcfg2.Server.Plugin.ValidationError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Plugin %s goal validation failed: %s"
+                                      % (plugin.name, err.message))
+                    raise
+                except:
+                    self.logger.error("Plugin %s: unexpected goal validation "
+                                      "failure" % plugin.name, exc_info=1)
+            finally:
+                self.tracer.end_span(span)
 
     @track_statistics()
     def GetStructures(self, metadata):
         """Get all structures for client specified by metadata."""
-        structures = reduce(lambda x, y: x + y,
-                            [struct.BuildStructures(metadata)
-                             for struct in self.structures], [])
+        structures = []
+        for struct in self.structures:
+            span = self.tracer.start_span("%s:BuildStructures" % struct.name)
+            try:
+                structures.extend(struct.BuildStructures(metadata))
+            finally:
+                self.tracer.end_span(span)
         sbundles = [b.get('name') for b in structures if b.tag == 'Bundle']
         missing = [b for b in metadata.bundles if b not in sbundles]
         if missing:
@@ -350,6 +519,7 @@ class BaseCore(object):
                 continue
             try:
                 self.Bind(entry, metadata)
+                self.set_content_digest(entry)
             except PluginExecutionError:
                 exc = sys.exc_info()[1]
                 if 'failure' not in entry.attrib:
@@ -366,49 +536,121 @@ class BaseCore(object):
     def Bind(self, entry, metadata):
         """Bind an entry using the appropriate generator."""
         start = time.time()
-        if 'altsrc' in entry.attrib:
-            oldname = entry.get('name')
-            entry.set('name', entry.get('altsrc'))
-            entry.set('realname', oldname)
-            del entry.attrib['altsrc']
-            try:
-                ret = self.Bind(entry, metadata)
-                entry.set('name', oldname)
-                del entry.attrib['realname']
-                return ret
-            except:
-                entry.set('name', oldname)
-                self.logger.error("Failed binding entry %s:%s with altsrc %s" %
-                                  (entry.tag, entry.get('name'),
-                                   entry.get('altsrc')))
-                self.logger.error("Falling back to %s:%s" % (entry.tag,
-                                                             entry.get('name')))
-
-        glist = [gen for gen in self.generators if
-                 entry.get('name') in gen.Entries.get(entry.tag, {})]
-        if len(glist) == 1:
-            return glist[0].Entries[entry.tag][entry.get('name')](entry,
-                                                                  metadata)
-        elif len(glist) > 1:
-            generators = ", ".join([gen.name for gen in glist])
-            self.logger.error("%s %s served by multiple generators: %s" %
-                              (entry.tag, entry.get('name'), generators))
-        g2list = [gen for gen in self.generators if
-                  gen.HandlesEntry(entry, metadata)]
+        Bcfg2.Server.Dependencies.record_entry(entry.tag, entry.get('name'))
+        span = self.tracer.start_span("Bind", entry="%s:%s" %
+                                      (entry.tag, entry.get('name')))
         try:
-            if len(g2list) == 1:
-                return g2list[0].HandleEntry(entry, metadata)
-            entry.set('failure', 'no matching generator')
-            raise PluginExecutionError("No matching generator: %s:%s" %
-                                       (entry.tag, entry.get('name')))
+            if 'altsrc' in entry.attrib:
+                oldname = entry.get('name')
+                entry.set('name', entry.get('altsrc'))
+                entry.set('realname', oldname)
+                del entry.attrib['altsrc']
+                try:
+                    ret = self.Bind(entry, metadata)
+                    entry.set('name', oldname)
+                    del entry.attrib['realname']
+                    return ret
+                except:
+                    entry.set('name', oldname)
+                    self.logger.error("Failed binding entry %s:%s with "
+                                      "altsrc %s" %
+                                      (entry.tag, entry.get('name'),
+                                       entry.get('altsrc')))
+                    self.logger.error("Falling back to %s:%s" %
+                                      (entry.tag, entry.get('name')))
+
+            glist = [gen for gen in self.generators if
+                     entry.get('name') in gen.Entries.get(entry.tag, {})]
+            if len(glist) == 1:
+                self.tracer.annotate(span, generator=glist[0].name)
+                return glist[0].Entries[entry.tag][entry.get('name')](entry,
+                                                                      metadata)
+            elif len(glist) > 1:
+                generators = ", ".join([gen.name for gen in glist])
+                self.logger.error("%s %s served by multiple generators: %s" %
+                                  (entry.tag, entry.get('name'), generators))
+            g2list = [gen for gen in self.generators if
+                      gen.HandlesEntry(entry, metadata)]
+            try:
+                if len(g2list) == 1:
+                    self.tracer.annotate(span, generator=g2list[0].name)
+                    return g2list[0].HandleEntry(entry, metadata)
+                entry.set('failure', 'no matching generator')
+                raise PluginExecutionError("No matching generator: %s:%s" %
+                                           (entry.tag, entry.get('name')))
+            finally:
+                self.stats.add_value("%s:Bind:%s" % (self.__class__.__name__,
+                                                     entry.tag),
+                                     time.time() - start)
         finally:
-            self.stats.add_value("%s:Bind:%s" % (self.__class__.__name__,
-                                                 entry.tag),
-                                 time.time() - start)
+            self.tracer.end_span(span)
+
+    def set_content_digest(self, entry):
+        """ Set the sha256 digest of the content of a bound Path
+        type='file' entry, which lets the client verify the file on
+        disk without comparing the full content """
+        if (sha256 is None or entry.tag != 'Path' or
+            entry.get('type') != 'file'):
+            return
+        try:
+            if entry.get('empty', 'false') == 'true':
+                data = ''
+            elif entry.text is None:
+                return
+            elif entry.get('encoding') == 'base64':
+                data = base64.b64decode(entry.text)
+            else:
+                data = entry.text
+            if isinstance(data, unicode):
+                data = data.encode(self.encoding)
+        except (TypeError, ValueError):
+            # the client will fall back to comparing the full content
+            self.logger.debug("Could not compute digest of %s: %s" %
+                              (entry.get('name'), sys.exc_info()[1]))
+            return
+        entry.set('sha256', sha256(data).hexdigest())
+
+    def defer_content(self, client, config):
+        """ Remove the content of Path type='file' entries that have a
+        digest from the given configuration, and store it for later
+        retrieval by GetContent.  Returns a dict of path name =>
+        detached Path element carrying the content. """
+        content = dict()
+        for entry in config.xpath("//Path[@type='file' and @sha256]"):
+            if entry.text is None:
+                continue
+            body = lxml.etree.Element("Path", name=entry.get('name'))
+            if entry.get('encoding'):
+                body.set('encoding', entry.get('encoding'))
+            body.text = entry.text
+            content[entry.get('name')] = body
+            entry.text = None
+            entry.set('deferred', 'true')
+        self.deferred_content[client] = content
+        return content
 
     def BuildConfiguration(self, client):
         """Build configuration for clients."""
+        span = self.tracer.start_span("BuildConfiguration", root=True,
+                                      client=client)
+        # the generation of the repository when the build started.
+        # builds don't wait for file monitor events, so a batch of
+        # changes may be applied while a build is in progress
+        generation = self.lock.generation
+        try:
+            return self._build_configuration(client)
+        finally:
+            if self.lock.generation != generation:
+                self.logger.debug("Repository changes were applied while "
+                                  "building the configuration for %s" %
+                                  client)
+            self.tracer.end_span(span, generation=generation)
+
+    def _build_configuration(self, client):
+        """ build the configuration for a client """
         start = time.time()
+        if self.dependencies is not None:
+            Bcfg2.Server.Dependencies.start_recording()
         config = lxml.etree.Element("Configuration", version='2.0',
                                     revision=self.revision)
         try:
@@ -449,8 +691,13 @@ class BaseCore(object):
 
         sort_xml(config, key=lambda e: e.get('name'))
 
-        self.logger.info("Generated config for %s in %.03f seconds" %
-                         (client, time.time() - start))
+        if self.dependencies is not None:
+            (paths, entries) = Bcfg2.Server.Dependencies.stop_recording()
+            self.dependencies.add(client, paths, entries)
+
+        self.logger.info("Generated config for %s in %.03f seconds "
+                         "(generation %d)" %
+                         (client, time.time() - start, self.lock.generation))
         return config
 
     def run(self, **kwargs):
@@ -504,10 +751,20 @@ class BaseCore(object):
             raise Bcfg2.Server.Plugin.MetadataRuntimeError
         imd = self.metadata.get_initial_metadata(client_name)
         for conn in self.connectors:
-            grps = conn.get_additional_groups(imd)
+            span = self.tracer.start_span("%s:get_additional_groups" %
+                                          conn.name)
+            try:
+                grps = conn.get_additional_groups(imd)
+            finally:
+                self.tracer.end_span(span)
             self.metadata.merge_additional_groups(imd, grps)
         for conn in self.connectors:
-            data = conn.get_additional_data(imd)
+            span = self.tracer.start_span("%s:get_additional_data" %
+                                          conn.name)
+            try:
+                data = conn.get_additional_data(imd)
+            finally:
+                self.tracer.end_span(span)
             self.metadata.merge_additional_data(imd, conn.name, data)
         imd.query.by_name = self.build_metadata
         return imd
@@ -533,6 +790,7 @@ class BaseCore(object):
         try:
             client = self.metadata.resolve_client(address,
                                                   cleanup_cache=cleanup_cache)
+            self.tracer.annotate_request(client=client)
             if metadata:
                 meta = self.build_metadata(client)
             else:
@@ -588,6 +846,7 @@ class BaseCore(object):
         return True
 
     @exposed
+    @traced
     def GetProbes(self, address):
         """Fetch probes for a particular client."""
         resp = lxml.etree.Element('probes')
@@ -604,6 +863,7 @@ class BaseCore(object):
                                 (client, err))
 
     @exposed
+    @traced
     def RecvProbeData(self, address, probedata):
         """Receive probe data from clients."""
         client, metadata = self.resolve_client(address)
@@ -646,20 +906,58 @@ class BaseCore(object):
         return True
 
     @exposed
+    @traced
     def GetConfig(self, address, checksum=False):
-        """Build config for a client."""
+        """Build config for a client.  If checksum is True, the
+        content of files is replaced by their digests, and must be
+        retrieved with GetContent."""
         client = self.resolve_client(address)[0]
         try:
             config = self.BuildConfiguration(client)
+            if checksum:
+                self.defer_content(client, config)
             return lxml.etree.tostring(config,
                                        xml_declaration=False).decode('UTF-8')
         except Bcfg2.Server.Plugin.MetadataConsistencyError:
             self.critical_error("Metadata consistency failure for %s" % client)
 
     @exposed
+    @traced
+    def GetContent(self, address, paths):
+        """Get the content of Path entries that was withheld by
+        GetConfig(checksum=True)."""
+        client = self.resolve_client(address)[0]
+        content = self.deferred_content.get(client, dict())
+        if [p for p in paths if p not in content]:
+            # the content has expired, e.g., because the server was
+            # restarted, so we need to build the config again
+            self.logger.info("Rebuilding configuration for %s to get "
+                             "deferred file content" % client)
+            try:
+                content = self.defer_content(client,
+                                             self.BuildConfiguration(client))
+            except Bcfg2.Server.Plugin.MetadataConsistencyError:
+                self.critical_error("Metadata consistency failure for %s" %
+                                    client)
+        resp = lxml.etree.Element("Content")
+        for path in paths:
+            if path in content:
+                resp.append(copy.copy(content[path]))
+            else:
+                self.logger.error("No content found for %s for client %s" %
+                                  (path, client))
+        return lxml.etree.tostring(resp, xml_declaration=False).decode('UTF-8')
+
+    @exposed
+    @traced
     def RecvStats(self, address, stats):
         """Act on statistics upload."""
         client = self.resolve_client(address)[0]
+        # the client run is finished, so it won't need any more content
+        try:
+            del self.deferred_content[client]
+        except KeyError:
+            pass
         sdata = lxml.etree.XML(stats.encode('utf-8'),
                                parser=Bcfg2.Server.XMLParser)
         self.process_statistics(client, sdata)
@@ -689,3 +987,49 @@ class BaseCore(object):
     def get_statistics(self, _):
         """Get current statistics about component execution"""
         return self.stats.display()
+
+    @exposed
+    @admin_only
+    def get_traces(self, _, client='', slow=False):
+        """Get summaries of the most recent request traces, optionally
+        only those for the given client or those of slow requests"""
+        return self.tracer.get_traces(client=client, slow=slow)
+
+    @exposed
+    @admin_only
+    def get_trace(self, _, trace_id):
+        """Get a request trace by ID"""
+        trace = self.tracer.get_trace(int(trace_id))
+        if trace is None:
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "No such trace: %s" % trace_id)
+        return trace
+
+    @exposed
+    @admin_only
+    def start_profiling(self, _, seconds=0, requests=0, mode='sample'):
+        """Profile the requests handled for the given number of
+        seconds or requests, whichever comes first, in either 'sample'
+        or 'cprofile' mode"""
+        try:
+            self.profiler.start(mode=mode, seconds=seconds,
+                                requests=requests)
+        except ValueError:
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "Cannot start profiling: %s" %
+                                  sys.exc_info()[1])
+        return True
+
+    @exposed
+    @admin_only
+    def stop_profiling(self, _):
+        """Stop profiling requests"""
+        self.profiler.stop()
+        return True
+
+    @exposed
+    @admin_only
+    def get_profile(self, _, limit=0):
+        """Get the results of the most recent profiling, limited to
+        the given number of functions"""
+        return self.profiler.get_results(limit=limit)
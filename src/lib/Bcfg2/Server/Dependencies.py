@@ -0,0 +1,160 @@
+""" Record which repository files and entries each client's
+configuration depends on, and use those records to find the clients
+that a change to the repository affects """
+
+import os
+import bisect
+import threading
+
+# the dependencies of the configuration being built in each thread
+_current = threading.local()
+
+
+def start_recording():
+    """ start recording the dependencies of the configuration that is
+    built in the current thread """
+    _current.deps = (set(), set())
+
+
+def stop_recording():
+    """ stop recording dependencies in the current thread, and return
+    a tuple of (<set of paths>, <set of (tag, name) tuples>) """
+    rv = getattr(_current, "deps", None)
+    _current.deps = None
+    if rv is None:
+        return (set(), set())
+    return rv
+
+
+def record_path(path):
+    """ record that the configuration being built in the current
+    thread uses the given repository file or directory.  this is done
+    for files that don't exist, too, so that creating them can be
+    detected. """
+    deps = getattr(_current, "deps", None)
+    if deps is not None:
+        deps[0].add(path)
+
+
+def record_entry(tag, name):
+    """ record that the configuration being built in the current
+    thread binds the given entry """
+    deps = getattr(_current, "deps", None)
+    if deps is not None:
+        deps[1].add((tag, name))
+
+
+class DependencyMap(object):
+    """ the recorded dependencies of a set of clients """
+
+    def __init__(self):
+        # client -> (<set of paths>, <set of (tag, name) tuples>)
+        self.clients = dict()
+
+    def add(self, client, paths, entries):
+        """ set the dependencies of a client """
+        self.clients[client] = (set(paths), set(entries))
+
+    def update(self, other):
+        """ add all of the dependencies in another DependencyMap """
+        self.clients.update(other.clients)
+
+    def write(self, fileobj):
+        """ write the dependencies to an open file, one per line, as
+        either ``<client> path <path>`` or ``<client> entry <tag>
+        <name>``, separated by tabs """
+        for client in sorted(self.clients.keys()):
+            (paths, entries) = self.clients[client]
+            for path in sorted(paths):
+                fileobj.write("%s\tpath\t%s\n" % (client, path))
+            for entry in sorted(entries):
+                fileobj.write("%s\tentry\t%s\t%s\n" % ((client,) + entry))
+
+    def read(self, fileobj):
+        """ read dependencies written by write() from an open file """
+        for line in fileobj:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 3 and fields[1] == "path":
+                self.clients.setdefault(fields[0],
+                                        (set(), set()))[0].add(fields[2])
+            elif len(fields) == 4 and fields[1] == "entry":
+                self.clients.setdefault(fields[0],
+                                        (set(), set()))[1].add(
+                    (fields[2], fields[3]))
+            else:
+                raise ValueError("Malformed dependency: %s" % line.strip())
+
+    def affected(self, paths, plugins):
+        """ given a list of absolute paths to changed repository files
+        and the list of loaded plugins, return a dict of <client> ->
+        <list of reasons the client is affected>.  A client is
+        affected by a file if:
+
+        * its configuration used the file, a directory the file is
+          in, or a file below it; or
+        * the plugin that the file belongs to can bind an entry in
+          the client's configuration from it; or
+        * the file doesn't belong to any plugin, or the plugin can't
+          tell which entries the file binds.  These files affect all
+          clients. """
+        users = dict()
+        for client, (cpaths, _) in self.clients.items():
+            for path in cpaths:
+                users.setdefault(path, set()).add(client)
+        recorded = sorted(users.keys())
+
+        rv = dict()
+        for path in paths:
+            path = os.path.normpath(path)
+            for used in self._related(path, users, recorded):
+                for client in users[used]:
+                    rv.setdefault(client, []).append("uses %s" % used)
+
+            plugin = self._find_plugin(path, plugins)
+            if plugin is None:
+                for client in self.clients:
+                    rv.setdefault(client, []).append(
+                        "%s is not in a plugin directory" % path)
+                continue
+            for client, (_, entries) in self.clients.items():
+                bound = plugin.get_affected_entries(path, entries)
+                if bound is None:
+                    for other in self.clients:
+                        rv.setdefault(other, []).append(
+                            "%s cannot tell what %s binds" %
+                            (plugin.name, path))
+                    break
+                for entry in sorted(bound):
+                    rv.setdefault(client, []).append(
+                        "%s:%s may be bound from %s" % (entry + (path,)))
+        return rv
+
+    def _related(self, path, users, recorded):
+        """ get the recorded paths that are the given path, a
+        directory it is in, or a path below it """
+        rv = []
+        parent = path
+        while True:
+            if parent in users:
+                rv.append(parent)
+            nextpath = os.path.dirname(parent)
+            if nextpath == parent:
+                break
+            parent = nextpath
+        prefix = path.rstrip("/") + "/"
+        idx = bisect.bisect_left(recorded, prefix)
+        while idx < len(recorded) and recorded[idx].startswith(prefix):
+            rv.append(recorded[idx])
+            idx += 1
+        return rv
+
+    def _find_plugin(self, path, plugins):
+        """ get the plugin whose directory the given path is in, or
+        None """
+        rv = None
+        for plugin in plugins:
+            data = plugin.data.rstrip("/")
+            if ((path == data or path.startswith(data + "/")) and
+                (rv is None or len(data) > len(rv.data.rstrip("/")))):
+                rv = plugin
+        return rv
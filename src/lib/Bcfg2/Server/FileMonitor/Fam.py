@@ -21,8 +21,11 @@ class Fam(FileMonitor):
         """Return fam file handle number."""
         return self.fm.fileno()
 
-    def handle_event_set(self, _):
-        self.Service()
+    def pending(self):
+        return self.fm.pending()
+
+    def handle_event_set(self, lock=None):
+        self.Service(lock=lock)
 
     def handle_events_in_interval(self, interval):
         now = time()
@@ -35,6 +38,7 @@ class Fam(FileMonitor):
         mode = os.stat(path)[stat.ST_MODE]
         if stat.S_ISDIR(mode):
             handle = self.fm.monitorDirectory(path, None)
+            self.loading.add(handle.requestID())
         else:
             handle = self.fm.monitorFile(path, None)
         self.handles[handle.requestID()] = handle
@@ -42,7 +46,7 @@ class Fam(FileMonitor):
             self.users[handle.requestID()] = obj
         return handle.requestID()
 
-    def Service(self, interval=0.50):
+    def Service(self, interval=0.50, lock=None):
         """Handle all fam work."""
         count = 0
         collapsed = 0
@@ -56,8 +60,10 @@ class Fam(FileMonitor):
                     rawevents.append(self.fm.nextEvent())
                 now = time()
         unique = []
-        bookkeeping = []
+        bookkeeping = set()
         for event in rawevents:
+            if event.code2str() == 'endExist':
+                self.loading.discard(event.requestID)
             if self.should_ignore(event):
                 continue
             if event.code2str() != 'changed':
@@ -65,18 +71,35 @@ class Fam(FileMonitor):
                 unique.append(event)
             else:
                 if (event.filename, event.requestID) not in bookkeeping:
-                    bookkeeping.append((event.filename, event.requestID))
+                    bookkeeping.add((event.filename, event.requestID))
                     unique.append(event)
                 else:
                     collapsed += 1
         for event in unique:
-            if event.requestID in self.users:
+            if (event.code2str() in ['created', 'changed'] and
+                hasattr(self.users.get(event.requestID), "PrepareEvent")):
                 try:
-                    self.users[event.requestID].HandleEvent(event)
+                    self.users[event.requestID].PrepareEvent(event)
                 except:
-                    logger.error("Handling event for file %s" % event.filename,
-                                 exc_info=1)
+                    self.debug_log("Error preparing event for file %s" %
+                                   event.filename)
+        if lock:
+            lock.acquire()
+        try:
+            for event in unique:
+                if event.requestID in self.users:
+                    try:
+                        self.users[event.requestID].HandleEvent(event)
+                    except:
+                        logger.error("Handling event for file %s" %
+                                     event.filename, exc_info=1)
+        finally:
+            if lock:
+                lock.release()
         end = time()
+        if self.stats is not None:
+            self.stats.add_value("FileMonitor:dispatched", len(unique))
+            self.stats.add_value("FileMonitor:coalesced", collapsed)
         logger.info("Processed %s fam events in %03.03f seconds. %s coalesced" %
                     (count, (end - start), collapsed))
         return count
@@ -49,6 +49,7 @@ class Gamin(FileMonitor):
             self.mon.handle_one_event()
 
         if stat.S_ISDIR(mode):
+            self.loading.add(handle)
             self.mon.watch_directory(path, self.queue, handle)
         else:
             self.mon.watch_file(path, self.queue, handle)
@@ -15,6 +15,7 @@ class Pseudo(FileMonitor):
             handleID = len(list(self.handles.keys()))
         self.events.append(Event(handleID, path, 'exists'))
         if os.path.isdir(path):
+            self.loading.add(handleID)
             dirList = os.listdir(path)
             for includedFile in dirList:
                 self.events.append(Event(handleID, includedFile, 'exists'))
@@ -1,11 +1,13 @@
 """Bcfg2.Server.FileMonitor provides the support for monitoring files."""
 
 import os
+import re
 import sys
 import fnmatch
 import logging
 import pkgutil
 from time import sleep, time
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -29,14 +31,34 @@ class Event(object):
 
 class FileMonitor(object):
     """File Monitor baseclass."""
+
+    #: the number of seconds to wait for more events after a
+    #: created, changed or deleted event arrives, so that bursts of
+    #: events (e.g., from an editor or a VCS checkout) can be
+    #: coalesced
+    coalesce_window = 0.1
+
     def __init__(self, ignore=None, debug=False):
         object.__init__(self)
         self.debug = debug
         self.handles = dict()
-        self.events = []
+        self.events = deque()
+        # handles of directory monitors whose initial 'exists' events
+        # have not all been handled yet, i.e., that haven't produced
+        # an 'endExist' event
+        self.loading = set()
         if ignore is None:
             ignore = []
         self.ignore = ignore
+        if ignore:
+            self.ignore_re = re.compile("|".join(["(?:%s)" %
+                                                  fnmatch.translate(p)
+                                                  for p in ignore]))
+        else:
+            self.ignore_re = None
+        # a Bcfg2.Statistics.Statistics object to record the number
+        # of events dispatched and coalesced in, if any
+        self.stats = None
 
     def __str__(self):
         return "%s: %s" % (__name__, self.__class__.__name__)
@@ -49,23 +71,63 @@ class FileMonitor(object):
             logger.info(msg)
 
     def should_ignore(self, event):
-        for pattern in self.ignore:
-            if (fnmatch.fnmatch(event.filename, pattern) or 
-                fnmatch.fnmatch(os.path.split(event.filename)[-1], pattern)):
-                self.debug_log("Ignoring %s" % event)
-                return True
+        if self.ignore_re is None:
+            return False
+        if (self.ignore_re.match(os.path.normcase(event.filename)) or
+            self.ignore_re.match(
+                os.path.normcase(os.path.split(event.filename)[-1]))):
+            self.debug_log("Ignoring %s" % event)
+            return True
         return False
 
     def pending(self):
         return bool(self.events)
 
     def get_event(self):
-        return self.events.pop(0)
+        return self.events.popleft()
+
+    def coalesce(self, events):
+        """ remove redundant events from a list of events.  a
+        created, changed or deleted event is redundant if the last
+        remaining event for the same monitor and file has the same
+        action, or if it is a change that follows a creation; the
+        earlier event will see the file as it is after both. """
+        rv = []
+        last = dict()
+        for event in events:
+            action = event.code2str()
+            if action in ['created', 'changed', 'deleted']:
+                key = (event.requestID, event.filename)
+                prev = last.get(key)
+                if (prev == action or
+                    (action == 'changed' and prev == 'created')):
+                    self.debug_log("Coalescing %s" % event)
+                    continue
+                last[key] = action
+            rv.append(event)
+        return rv
 
     def fileno(self):
         return 0
 
+    def prepare_event(self, event):
+        """ give the handler of an event a chance to do any expensive
+        work for it (e.g., reading and parsing files) before the
+        event is handled.  this is done without holding the lock that
+        event handling holds, so it must not change any state that
+        is visible to other threads. """
+        handler = self.handles.get(event.requestID)
+        if handler is not None and hasattr(handler, "PrepareEvent"):
+            try:
+                handler.PrepareEvent(event)
+            except:
+                err = sys.exc_info()[1]
+                self.debug_log("Error preparing event %s for %s: %s" %
+                               (event.code2str(), event.filename, err))
+
     def handle_one_event(self, event):
+        if event.code2str() == 'endExist':
+            self.loading.discard(event.requestID)
         if self.should_ignore(event):
             return
         if event.requestID not in self.handles:
@@ -83,22 +145,67 @@ class FileMonitor(object):
                          (event.code2str(), event.filename, err))
 
     def handle_event_set(self, lock=None):
-        count = 1
-        event = self.get_event()
+        if (self.coalesce_window > 0 and self.events and
+            self.events[0].code2str() in ['created', 'changed', 'deleted']):
+            # give the rest of a burst of events a chance to arrive
+            sleep(self.coalesce_window)
+        count = 0
+        coalesced = 0
         start = time()
-        if lock:
-            lock.acquire()
+        # the events taken from the queue that have not been handled
+        # yet: the raw events until they are coalesced, and then the
+        # coalesced events from index ``handled`` on
+        events = []
+        unique = None
+        handled = 0
         try:
-            self.handle_one_event(event)
+            # handling events can produce more events (e.g., by adding
+            # monitors for new directories), so keep going until there
+            # are none left
             while self.pending():
-                self.handle_one_event(self.get_event())
-                count += 1
+                events = []
+                unique = None
+                handled = 0
+                while self.pending():
+                    event = self.get_event()
+                    if event.code2str() == 'endExist':
+                        self.loading.discard(event.requestID)
+                    if not self.should_ignore(event):
+                        events.append(event)
+                unique = self.coalesce(events)
+                coalesced += len(events) - len(unique)
+                for event in unique:
+                    if event.code2str() in ['created', 'changed']:
+                        self.prepare_event(event)
+                # the lock is only held while the prepared events are
+                # handled, so that each batch is applied as a whole
+                if lock:
+                    lock.acquire()
+                try:
+                    for event in unique:
+                        self.handle_one_event(event)
+                        handled += 1
+                        count += 1
+                finally:
+                    if lock:
+                        lock.release()
         except:
-            pass
-        if lock:
-            lock.release()
+            err = sys.exc_info()[1]
+            if unique is None:
+                remaining = events
+            else:
+                remaining = unique[handled:]
+            # put the events back at the front of the queue, so they
+            # are handled the next time around instead of being lost
+            self.events.extendleft(reversed(remaining))
+            logger.error("Error handling file monitor events, %d events "
+                         "requeued: %s" % (len(remaining), err))
         end = time()
-        logger.info("Handled %d events in %.03fs" % (count, (end - start)))
+        if self.stats is not None:
+            self.stats.add_value("FileMonitor:dispatched", count)
+            self.stats.add_value("FileMonitor:coalesced", coalesced)
+        logger.info("Handled %d events in %.03fs (%d coalesced)" %
+                    (count, (end - start), coalesced))
 
     def handle_events_in_interval(self, interval):
         end = time() + interval
@@ -109,6 +216,30 @@ class FileMonitor(object):
             else:
                 sleep(0.5)
 
+    def initial_load_complete(self):
+        """ return True if the initial 'exists' events for all
+        monitors have been handled """
+        return not self.loading and not self.pending()
+
+    def wait_for_initial_load(self, timeout=None, lock=None):
+        """ handle events until the initial 'exists' events for all
+        monitors have been handled.  returns False if that doesn't
+        happen within timeout seconds. """
+        end = None
+        if timeout is not None:
+            end = time() + timeout
+        while not self.initial_load_complete():
+            if end is not None and time() > end:
+                logger.warning("Timed out waiting for initial file monitor "
+                               "events; %s monitors still loading" %
+                               len(self.loading))
+                return False
+            if self.pending():
+                self.handle_event_set(lock)
+            else:
+                sleep(0.01)
+        return True
+
     def shutdown(self):
         pass
 
@@ -4,15 +4,26 @@ import os
 import re
 import sys
 import copy
+import time
+import bisect
+import fnmatch
 import logging
 import operator
+import tempfile
 import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
+import Bcfg2.Server.Dependencies
+from Bcfg2.version import __version__
 from Bcfg2.Compat import ConfigParser, CmpMixin, reduce, Queue, Empty, \
     Full, cPickle
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 try:
     import django
     has_django = True
@@ -143,6 +154,20 @@ class Plugin(Debuggable):
     def shutdown(self):
         self.running = False
 
+    def get_affected_entries(self, path, entries):
+        """ Given the path to a changed file in this plugin's
+        directory and a collection of (tag, name) tuples of the
+        entries a client's configuration binds, return the entries
+        that could now be bound from the file.  Return None if that
+        can't be determined, in which case all clients are affected
+        by the change.
+
+        Clients whose configuration used the file are found from the
+        paths recorded with Bcfg2.Server.Dependencies.record_path(),
+        so only entries that the file could newly bind need to be
+        returned here. """
+        return None
+
     def __str__(self):
         return "%s Plugin" % self.__class__.__name__
 
@@ -242,57 +267,181 @@ class Statistics(Plugin):
 
 class ThreadedStatistics(Statistics, threading.Thread):
     """Threaded statistics handling capability."""
+
+    #: the maximum number of interactions passed to
+    #: handle_statistics_batch() at once
+    __batch_size__ = 100
+
+    #: the maximum number of seconds to wait for more interactions to
+    #: add to a batch once the first one has arrived
+    __batch_delay__ = 0.5
+
+    #: the number of interactions to handle between rewrites of the
+    #: pending file, which discard the records of handled
+    #: interactions
+    __journal_compact__ = 1000
+
     def __init__(self, core, datastore):
         Statistics.__init__(self, core, datastore)
         threading.Thread.__init__(self)
         # Event from the core signaling an exit
         self.terminate = core.terminate
         self.work_queue = Queue(100000)
+        # interactions are recorded in the pending file as they are
+        # received, and marked as done once they have been handled,
+        # so that unhandled interactions survive a crash
         self.pending_file = os.path.join(datastore, "etc",
                                          "%s.pending" % self.name)
+        self.journal = None
+        self.journal_lock = threading.Lock()
+        # the serial number of the last interaction recorded
+        self.serial = 0
+        # serial -> (hostname, data) for recorded interactions that
+        # have not been handled
+        self.outstanding = dict()
+        # the number of interactions handled since the pending file
+        # was last rewritten
+        self.handled = 0
+        self.pending = self._recover_journal()
         self.daemon = False
         self.start()
 
-    def save(self):
-        """Save any pending data to a file."""
-        pending_data = []
+    def _read_journal(self):
+        """ get a list of (hostname, data) tuples for the interactions
+        in the pending file that have not been handled """
+        legacy = []
+        pending = dict()
+        try:
+            journal = open(self.pending_file, 'rb')
+        except IOError:
+            return []
         try:
-            while not self.work_queue.empty():
-                (metadata, data) = self.work_queue.get_nowait()
+            while True:
                 try:
-                    pending_data.append((metadata.hostname,
-                                         lxml.etree.tostring(data,
-                                                             xml_declaration=False).decode("UTF-8")))
+                    record = cPickle.load(journal)
+                except EOFError:
+                    break
                 except:
+                    # the last record is incomplete if the server
+                    # died while writing it
                     err = sys.exc_info()[1]
-                    self.logger.warning("Dropping interaction for %s: %s" %
-                                        (metadata.hostname, err))
-        except Empty:
-            pass
+                    self.logger.warning("%s: Ignoring incomplete record in "
+                                        "%s: %s" % (self.name,
+                                                    self.pending_file, err))
+                    break
+                if isinstance(record, list):
+                    # pending data saved by an older version of bcfg2
+                    legacy.extend(record)
+                elif record[0] == 'add':
+                    pending[record[1]] = (record[2], record[3])
+                elif record[0] == 'done':
+                    pending.pop(record[1], None)
+        finally:
+            journal.close()
+        serials = list(pending.keys())
+        serials.sort()
+        return legacy + [pending[s] for s in serials]
+
+    def _recover_journal(self):
+        """ rewrite the pending file to contain only the interactions
+        that have not been handled, and return a list of (serial,
+        hostname, data) tuples for them """
+        rv = []
+        for (hostname, data) in self._read_journal():
+            self.serial += 1
+            self.outstanding[self.serial] = (hostname, data)
+            rv.append((self.serial, hostname, data))
+        if not self._journal_rewrite():
+            # fall back to recording the pending interactions in the
+            # existing file
+            for (serial, hostname, data) in rv:
+                self._journal_write(('add', serial, hostname, data))
+        return rv
 
+    def _journal_rewrite(self):
+        """ replace the pending file with one that only records the
+        outstanding interactions, or remove it if there are none.
+        journal_lock must be held (or the thread not yet started) by
+        the caller.  returns False if the file could not be
+        rewritten. """
+        self._journal_close()
+        self.handled = 0
+        if not self.outstanding:
+            if os.path.exists(self.pending_file):
+                try:
+                    os.unlink(self.pending_file)
+                except OSError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Failed to unlink %s: %s" %
+                                      (self.pending_file, err))
+            return True
+        serials = list(self.outstanding.keys())
+        serials.sort()
         try:
-            savefile = open(self.pending_file, 'w')
-            cPickle.dump(pending_data, savefile)
-            savefile.close()
-            self.logger.info("Saved pending %s data" % self.name)
-        except:
+            tmpfile = "%s.new" % self.pending_file
+            journal = open(tmpfile, 'wb')
+            for serial in serials:
+                (hostname, data) = self.outstanding[serial]
+                cPickle.dump(('add', serial, hostname, data), journal)
+            journal.close()
+            os.rename(tmpfile, self.pending_file)
+        except (IOError, OSError):
             err = sys.exc_info()[1]
-            self.logger.warning("Failed to save pending data: %s" % err)
+            self.logger.warning("Failed to rewrite %s: %s" %
+                                (self.pending_file, err))
+            return False
+        return True
 
-    def load(self):
-        """Load any pending data from a file."""
-        if not os.path.exists(self.pending_file):
-            return True
-        pending_data = []
+    def _journal_write(self, record):
+        """ append a record to the pending file.  journal_lock must
+        be held (or the thread not yet started) by the caller """
         try:
-            savefile = open(self.pending_file, 'r')
-            pending_data = cPickle.load(savefile)
-            savefile.close()
-        except Exception:
-            e = sys.exc_info()[1]
-            self.logger.warning("Failed to load pending data: %s" % e)
-            return False
-        for (pmetadata, pdata) in pending_data:
+            if self.journal is None:
+                self.journal = open(self.pending_file, 'ab')
+            cPickle.dump(record, self.journal)
+            self.journal.flush()
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.warning("Failed to write to %s: %s" %
+                                (self.pending_file, err))
+
+    def _journal_done(self, serials):
+        """ mark the interactions with the given serial numbers as
+        handled """
+        if not serials:
+            return
+        self.journal_lock.acquire()
+        try:
+            for serial in serials:
+                self.outstanding.pop(serial, None)
+            self.handled += len(serials)
+            if (not self.outstanding or
+                self.handled >= self.__journal_compact__):
+                # start a new file that only records the outstanding
+                # interactions, so it doesn't grow without bound
+                # while the queue is never empty
+                if self._journal_rewrite():
+                    return
+            for serial in serials:
+                self._journal_write(('done', serial))
+        finally:
+            self.journal_lock.release()
+
+    def _journal_close(self):
+        if self.journal is not None:
+            try:
+                self.journal.close()
+            except IOError:
+                pass
+            self.journal = None
+
+    def load(self):
+        """Load interactions that were not handled before the server
+        last stopped into the work queue."""
+        pending = self.pending
+        self.pending = []
+        done = []
+        for (serial, pmetadata, pdata) in pending:
             # check that shutdown wasnt called early
             if self.terminate.isSet():
                 return False
@@ -309,54 +458,119 @@ class ThreadedStatistics(Statistics, threading.Thread):
                     if self.terminate.isSet():
                         return False
 
-                self.work_queue.put_nowait((metadata,
-                                            lxml.etree.XML(pdata,
-                                                           parser=Bcfg2.Server.XMLParser)))
+                self.work_queue.put_nowait((metadata, pdata, serial))
             except Full:
                 self.logger.warning("Queue.Full: Failed to load queue data")
-                break
-            except lxml.etree.LxmlError:
-                lxml_error = sys.exc_info()[1]
-                self.logger.error("Unable to load saved interaction: %s" %
-                                  lxml_error)
+                done.append(serial)
             except MetadataConsistencyError:
                 self.logger.error("Unable to load metadata for save "
                                   "interaction: %s" % pmetadata)
-        try:
-            os.unlink(self.pending_file)
-        except:
-            self.logger.error("Failed to unlink save file: %s" %
-                              self.pending_file)
-        self.logger.info("Loaded pending %s data" % self.name)
+                done.append(serial)
+        self._journal_done(done)
+        if pending:
+            self.logger.info("Loaded pending %s data" % self.name)
         return True
 
+    def _get_batch(self):
+        """ get up to __batch_size__ (metadata, data, serial) tuples
+        from the work queue """
+        try:
+            batch = [self.work_queue.get(block=True, timeout=2)]
+        except Empty:
+            return []
+        except Exception:
+            e = sys.exc_info()[1]
+            self.logger.error("ThreadedStatistics: %s" % e)
+            return []
+        deadline = time.time() + self.__batch_delay__
+        while len(batch) < self.__batch_size__:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.work_queue.get(block=True, timeout=timeout))
+            except Empty:
+                break
+        return batch
+
     def run(self):
         if not self.load():
             return
         while not self.terminate.isSet() and self.work_queue != None:
-            try:
-                (client, xdata) = self.work_queue.get(block=True, timeout=2)
-            except Empty:
-                continue
-            except Exception:
-                e = sys.exc_info()[1]
-                self.logger.error("ThreadedStatistics: %s" % e)
+            batch = self._get_batch()
+            if not batch:
+                try:
+                    self.handle_idle()
+                except:
+                    err = sys.exc_info()[1]
+                    self.logger.error("%s: Failed to handle idle time: %s" %
+                                      (self.name, err))
                 continue
-            self.handle_statistic(client, xdata)
-        if self.work_queue != None and not self.work_queue.empty():
-            self.save()
+            data = []
+            for (metadata, xdata, serial) in batch:
+                try:
+                    data.append((metadata,
+                                 lxml.etree.XML(xdata,
+                                                parser=Bcfg2.Server.XMLParser)))
+                except lxml.etree.LxmlError:
+                    lxml_error = sys.exc_info()[1]
+                    self.logger.error("Unable to load interaction for %s: %s"
+                                      % (metadata.hostname, lxml_error))
+            try:
+                self.handle_statistics_batch(data)
+            except:
+                err = sys.exc_info()[1]
+                self.logger.error("%s: Failed to handle statistics: %s" %
+                                  (self.name, err))
+            self._journal_done([serial for (m, x, serial) in batch])
+        # anything left in the queue is still in the pending file,
+        # and will be loaded when the server next starts
+        self.journal_lock.acquire()
+        try:
+            self._journal_close()
+        finally:
+            self.journal_lock.release()
 
     def process_statistics(self, metadata, data):
+        # the serialized data is both recorded in the pending file
+        # and queued, so it doesn't have to be copied
+        xdata = lxml.etree.tostring(data, xml_declaration=False).decode('UTF-8')
+        self.journal_lock.acquire()
         try:
-            self.work_queue.put_nowait((metadata, copy.copy(data)))
-        except Full:
-            self.logger.warning("%s: Queue is full.  Dropping interactions." %
-                                self.name)
+            self.serial += 1
+            self._journal_write(('add', self.serial, metadata.hostname,
+                                 xdata))
+            try:
+                self.work_queue.put_nowait((metadata, xdata, self.serial))
+                self.outstanding[self.serial] = (metadata.hostname, xdata)
+            except Full:
+                self.logger.warning("%s: Queue is full.  Dropping "
+                                    "interactions." % self.name)
+                self._journal_write(('done', self.serial))
+        finally:
+            self.journal_lock.release()
+
+    def handle_statistics_batch(self, batch):
+        """Handle a list of (metadata, data) tuples.  By default,
+        each one is passed to handle_statistic()."""
+        for (metadata, data) in batch:
+            try:
+                self.handle_statistic(metadata, data)
+            except:
+                err = sys.exc_info()[1]
+                self.logger.error("%s: Failed to handle statistics for %s: "
+                                  "%s" % (self.name, metadata.hostname, err))
 
     def handle_statistic(self, metadata, data):
         """Handle stats here."""
         pass
 
+    def handle_idle(self):
+        """Called every few seconds while no statistics are
+        waiting to be handled, e.g., to write out state whose writes
+        have been deferred.  By default, does nothing."""
+        pass
+
 
 class PullSource(object):
     def GetExtra(self, client):
@@ -400,13 +614,95 @@ class GoalValidator(object):
 
 class Version(object):
     """Interact with various version control systems."""
+
+    #: paths, relative to the repository, of VCS metadata that changes
+    #: whenever the revision does.  they are watched with the file
+    #: monitor, and get_revision() is only called again after they
+    #: change.  if none are given (or none exist), get_revision() is
+    #: called after every set of file monitor events.
+    __vcs_metadata__ = []
+
+    #: directories, relative to the repository, of VCS metadata that
+    #: are watched along with all of their subdirectories, including
+    #: those created later
+    __vcs_metadata_recursive__ = []
+
+    def __init__(self):
+        self.cached_revision = None
+        self.revision_stale = True
+        self.revision_monitored = None
+        # paths of the VCS metadata that are being watched
+        self.revision_monitors = set()
+
     def get_revision(self):
         return []
 
+    def monitor_vcs_metadata(self, path, recursive=False):
+        """ watch a VCS metadata path with the file monitor, and all
+        of its subdirectories if recursive is True """
+        if path in self.revision_monitors or not os.path.exists(path):
+            return
+        self.revision_monitors.add(path)
+        self.core.fam.AddMonitor(path,
+                                 VersionMetadataMonitor(self, path,
+                                                        recursive))
+        self.revision_monitored = True
+        if recursive and os.path.isdir(path):
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path, name)):
+                    self.monitor_vcs_metadata(os.path.join(path, name),
+                                              recursive=True)
+
+    def current_revision(self):
+        """ get the current revision of the repository, only calling
+        get_revision() if the revision may have changed """
+        if self.revision_monitored is None:
+            self.revision_monitored = False
+            for path in self.__vcs_metadata__:
+                self.monitor_vcs_metadata(os.path.join(self.core.datastore,
+                                                       path))
+            for path in self.__vcs_metadata_recursive__:
+                self.monitor_vcs_metadata(os.path.join(self.core.datastore,
+                                                       path),
+                                          recursive=True)
+        if self.revision_stale or not self.revision_monitored:
+            self.revision_stale = False
+            revision = self.get_revision()
+            if revision != self.cached_revision:
+                if self.cached_revision is not None:
+                    self.logger.info("%s: Revision changed from %s to %s" %
+                                     (self.name, self.cached_revision,
+                                      revision))
+                    if hasattr(self.core, 'stats'):
+                        self.core.stats.add_value("%s:revision_changed" %
+                                                  self.name, 1)
+                self.cached_revision = revision
+        return self.cached_revision
+
     def commit_data(self, file_list, comment=None):
         pass
 
 
+class VersionMetadataMonitor(object):
+    """ File monitor handler that marks the revision of a Version
+    plugin as stale when its VCS metadata changes.  If recursive is
+    True, new subdirectories of the monitored directory are watched
+    too. """
+    def __init__(self, plugin, path, recursive=False):
+        self.plugin = plugin
+        self.path = path
+        self.recursive = recursive
+
+    def HandleEvent(self, event):
+        self.plugin.revision_stale = True
+        if (self.recursive and
+            event.code2str() in ['exists', 'created'] and
+            event.filename != self.path):
+            self.plugin.monitor_vcs_metadata(os.path.join(self.path,
+                                                          event.filename),
+                                             recursive=True)
+
+
 class ClientRunHooks(object):
     """ Provides hooks to interact with client runs """
     def start_client_run(self, metadata):
@@ -420,6 +716,352 @@ class ClientRunHooks(object):
 
 # the rest of the file contains classes for coherent file caching
 
+class RepositoryPreloader(object):
+    """ Reads the files in a set of directories, and parses the XML
+    files among them, on a pool of threads.  This is used at startup,
+    so that the file monitor events for the initial load of the
+    repository (which are handled serially) can use data that has
+    already been read and parsed.  After startup, it holds the files
+    that were read for a batch of file monitor events before the
+    events were handled (see :func:`prepare_file`). """
+
+    #: files larger than this many bytes are not preloaded
+    __max_size__ = 1024 * 1024
+
+    def __init__(self, ignore=None):
+        if ignore is None:
+            ignore = []
+        self.ignore = ignore
+        # path -> ((mtime, size), data)
+        self.files = dict()
+        # path -> (data, parsed XML)
+        self.xml = dict()
+        self.lock = threading.Lock()
+
+    def _ignored(self, name):
+        for pattern in self.ignore:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def discover(self, paths):
+        """ get a sorted list of files in the given directories """
+        rv = []
+        for path in paths:
+            for root, dirs, files in os.walk(path):
+                dirs[:] = [d for d in dirs if not self._ignored(d)]
+                rv.extend([os.path.join(root, f) for f in files
+                           if not self._ignored(f)])
+        rv.sort()
+        return rv
+
+    def _load(self, queue):
+        """ read and parse files from the queue until it is empty """
+        # lxml parsers can't be shared between threads
+        parser = Bcfg2.Server.XMLParser.copy()
+        while True:
+            try:
+                path = queue.get_nowait()
+            except Empty:
+                return
+            self.load(path, parser)
+
+    def load(self, path, parser=None):
+        """ read the given file, and parse it if it is an XML file """
+        if parser is None:
+            parser = Bcfg2.Server.XMLParser.copy()
+        if snapshot is not None and snapshot.unchanged(path):
+            # files whose state is restored from the snapshot don't
+            # need to be read at all
+            return
+        try:
+            stat = os.stat(path)
+            if stat.st_size > self.__max_size__:
+                return
+            data = open(path).read()
+        except (IOError, OSError, UnicodeDecodeError):
+            # the file will be read (and the error reported) when
+            # its event is handled
+            return
+        xdata = None
+        if path.endswith(".xml"):
+            try:
+                xdata = lxml.etree.XML(data, base_url=path, parser=parser)
+            except lxml.etree.XMLSyntaxError:
+                pass
+        self.lock.acquire()
+        try:
+            self.files[path] = ((stat.st_mtime, stat.st_size), data)
+            if xdata is not None:
+                self.xml[path] = (data, xdata)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ discard all data that has not been used """
+        self.lock.acquire()
+        try:
+            self.files.clear()
+            self.xml.clear()
+        finally:
+            self.lock.release()
+
+    def preload(self, paths, threads):
+        """ read and parse all files in the given directories using
+        the given number of threads """
+        start = time.time()
+        queue = Queue()
+        for fname in self.discover(paths):
+            queue.put(fname)
+        workers = []
+        for i in range(threads):
+            worker = threading.Thread(name="RepositoryPreloader%d" % i,
+                                      target=self._load, args=(queue,))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        logger.info("Preloaded %d files (%d XML) in %.03fs" %
+                    (len(self.files), len(self.xml), time.time() - start))
+
+    def read(self, path):
+        """ get the preloaded contents of the given file, or None if
+        it was not preloaded or has changed since """
+        self.lock.acquire()
+        try:
+            entry = self.files.pop(path, None)
+        finally:
+            self.lock.release()
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if entry[0] != (stat.st_mtime, stat.st_size):
+            self.xml.pop(path, None)
+            return None
+        return entry[1]
+
+    def parse(self, path, data):
+        """ get the preloaded parsed XML of the given file, or None
+        if it was not preloaded or the data has changed since """
+        self.lock.acquire()
+        try:
+            entry = self.xml.pop(path, None)
+        finally:
+            self.lock.release()
+        if entry is None or (entry[0] is not data and entry[0] != data):
+            return None
+        return entry[1]
+
+
+class RepositorySnapshot(object):
+    """ A persistent cache of the state parsed from files in the
+    repository, which lets the server skip reading and parsing
+    unchanged files when it restarts.  Only plugins whose parsed
+    state can be pickled record it; currently that is :class:`XMLSrc`
+    (Rules, Pkgmgr, Deps, ...).  Other plugins, such as Metadata,
+    Bundler and Cfg, keep lxml trees or file contents, and read and
+    parse their files as usual, so a restart is only faster to the
+    extent that XMLSrc files dominate the repository.
+
+    Each file is recorded with its mtime and size, not its contents,
+    and the recorded state is used only if the mtime and size of the
+    file still match.  The snapshot file carries a format version,
+    the Bcfg2 version and a digest of its contents; if any of them
+    doesn't match, the snapshot is ignored. """
+
+    #: the version of the snapshot file format
+    __format__ = 3
+
+    magic = "BCFG2-REPOSITORY-SNAPSHOT"
+
+    def __init__(self, path):
+        self.path = path
+        # path -> [(mtime, size), (state key, state)]
+        self.files = dict()
+        # whether the snapshot has changed since it was loaded or
+        # saved
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _header(self, digest):
+        return "%s %s %s %s\n" % (self.magic, self.__format__, __version__,
+                                  digest)
+
+    def load(self):
+        """ load the snapshot from disk, if it exists and is valid """
+        try:
+            sfile = open(self.path, 'rb')
+            try:
+                header = sfile.readline().decode('UTF-8')
+                payload = sfile.read()
+            finally:
+                sfile.close()
+        except IOError:
+            err = sys.exc_info()[1]
+            logger.info("Could not read repository snapshot %s: %s" %
+                        (self.path, err))
+            return False
+        fields = header.split()
+        if (len(fields) != 4 or
+            header != self._header(md5(payload).hexdigest())):
+            logger.warning("Ignoring repository snapshot %s: version "
+                           "mismatch or corrupt data" % self.path)
+            return False
+        try:
+            files = cPickle.loads(payload)
+        except:
+            err = sys.exc_info()[1]
+            logger.warning("Ignoring repository snapshot %s: %s" %
+                           (self.path, err))
+            return False
+        self.lock.acquire()
+        try:
+            self.files = files
+        finally:
+            self.lock.release()
+        logger.info("Loaded repository snapshot of %d files from %s" %
+                    (len(files), self.path))
+        return True
+
+    def save(self):
+        """ write the snapshot to disk if it has changed, leaving out
+        files that no longer exist and any state that can't be
+        pickled """
+        start = time.time()
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return True
+            files = dict([(path, entry)
+                          for path, entry in self.files.items()
+                          if os.path.exists(path)])
+            self.dirty = False
+        finally:
+            self.lock.release()
+        try:
+            payload = cPickle.dumps(files, 2)
+        except (cPickle.PicklingError, TypeError):
+            for path, entry in list(files.items()):
+                try:
+                    cPickle.dumps(entry[1], 2)
+                except (cPickle.PicklingError, TypeError):
+                    del files[path]
+            payload = cPickle.dumps(files, 2)
+        cachedir = os.path.dirname(self.path)
+        try:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            (fd, tmpfile) = tempfile.mkstemp(dir=cachedir)
+            sfile = os.fdopen(fd, 'wb')
+            sfile.write(self._header(md5(payload).hexdigest()).encode('UTF-8'))
+            sfile.write(payload)
+            sfile.close()
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            logger.error("Could not write repository snapshot %s: %s" %
+                         (self.path, err))
+            self.dirty = True
+            return False
+        logger.info("Wrote repository snapshot of %d files to %s in %.03fs" %
+                    (len(files), self.path, time.time() - start))
+        return True
+
+    def unchanged(self, path):
+        """ return True if state is recorded for the given file, and
+        its mtime and size haven't changed since """
+        entry = self.files.get(path)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry[0] == (stat.st_mtime, stat.st_size)
+
+    def get_state(self, path, key):
+        """ get the state recorded under the given key for the given
+        file, or None if there is none or the file has changed """
+        entry = self.files.get(path)
+        if (entry is not None and entry[1][0] == key and
+            self.unchanged(path)):
+            self.hits += 1
+            return entry[1][1]
+        self.misses += 1
+        return None
+
+    def set_state(self, path, ondisk, key, state):
+        """ record state parsed from the given file under the given
+        key.  ondisk is the stat of the file from before it was read,
+        so a change made while it was read isn't mistaken for the
+        state of the new contents. """
+        entry = [(ondisk.st_mtime, ondisk.st_size), (key, state)]
+        self.lock.acquire()
+        try:
+            self.files[path] = entry
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+
+#: the RepositoryPreloader that holds files read ahead of handling
+#: their events, if any
+preloader = None
+
+#: the RepositorySnapshot used to persist the repository across
+#: server restarts, if any
+snapshot = None
+
+
+def prepare_file(path):
+    """ read (and parse) the given file ahead of handling an event for
+    it, so that :func:`read_file` and :func:`parse_xml` don't have to
+    while the core lock is held """
+    if preloader is not None and not os.path.isdir(path):
+        preloader.load(path)
+
+
+def read_file(path):
+    """ read the given file, using preloaded data if possible """
+    data = None
+    if preloader is not None:
+        data = preloader.read(path)
+    if data is None:
+        data = open(path).read()
+    return data
+
+
+def get_state(path, key):
+    """ get the state that was parsed from the given file under the
+    given key from the repository snapshot, or None if it is not
+    available or the file has changed """
+    if snapshot is None:
+        return None
+    return snapshot.get_state(path, key)
+
+
+def set_state(path, ondisk, key, state):
+    """ record the state that was parsed from the given file, whose
+    stat before it was read was ondisk, in the repository snapshot """
+    if snapshot is not None:
+        snapshot.set_state(path, ondisk, key, state)
+
+
+def parse_xml(data, path):
+    """ parse the XML data read from the given file, using preloaded
+    data if possible """
+    if preloader is not None:
+        xdata = preloader.parse(path, data)
+        if xdata is not None:
+            return xdata
+    return lxml.etree.XML(data, base_url=path, parser=Bcfg2.Server.XMLParser)
+
+
 class FileBacked(object):
     """This object caches file data in memory.
     HandleEvent is called whenever fam registers an event.
@@ -438,12 +1080,16 @@ class FileBacked(object):
         if event and event.code2str() not in ['exists', 'changed', 'created']:
             return
         try:
-            self.data = open(self.name).read()
+            self.data = read_file(self.name)
             self.Index()
         except IOError:
             err = sys.exc_info()[1]
             logger.error("Failed to read file %s: %s" % (self.name, err))
 
+    def PrepareEvent(self, event):
+        """Read the file ahead of a change event."""
+        prepare_file(self.name)
+
     def Index(self):
         """Update local data structures based on current file state"""
         pass
@@ -452,6 +1098,128 @@ class FileBacked(object):
         return "%s: %s" % (self.__class__.__name__, self.name)
 
 
+class PathDict(dict):
+    """ A dict keyed by paths that also keeps its keys in sorted
+    order, so that the keys in a subtree can be found without
+    scanning every key. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._keys = sorted(dict.keys(self))
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            bisect.insort(self._keys, key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            rv = self[key]
+            del self[key]
+            return rv
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        (key, value) = dict.popitem(self)
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        return (key, value)
+
+    def clear(self):
+        dict.clear(self)
+        self._keys = []
+
+    def subtree(self, path):
+        """ get a list of the keys that are the given path or are
+        below it """
+        path = path.rstrip("/")
+        if not path:
+            return list(self._keys)
+        rv = []
+        if path in self:
+            rv.append(path)
+        prefix = path + "/"
+        i = bisect.bisect_left(self._keys, prefix)
+        while i < len(self._keys) and self._keys[i].startswith(prefix):
+            rv.append(self._keys[i])
+            i += 1
+        return rv
+
+
+class ReverseDict(dict):
+    """ A dict that also maps each of its values back to the keys
+    that have it, so that the keys for a value can be found without
+    scanning every item. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.reverse = dict()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._unmap(key)
+        dict.__setitem__(self, key, value)
+        self.reverse.setdefault(value, []).append(key)
+
+    def __delitem__(self, key):
+        self._unmap(key)
+        dict.__delitem__(self, key)
+
+    def _unmap(self, key):
+        value = self[key]
+        keys = self.reverse[value]
+        keys.remove(key)
+        if not keys:
+            del self.reverse[value]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            rv = self[key]
+            del self[key]
+            return rv
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        (key, value) = dict.popitem(self)
+        dict.__setitem__(self, key, value)
+        del self[key]
+        return (key, value)
+
+    def clear(self):
+        dict.clear(self)
+        self.reverse.clear()
+
+    def has_value(self, value):
+        """ return True if any key has the given value """
+        return value in self.reverse
+
+    def keys_for(self, value):
+        """ get a list of the keys that have the given value """
+        return list(self.reverse.get(value, []))
+
+
 class DirectoryBacked(object):
     """This object is a coherent cache for a filesystem hierarchy of files."""
     __child__ = FileBacked
@@ -476,14 +1244,14 @@ class DirectoryBacked(object):
         # by this object.... The keys of the dict are the relative
         # paths to the files. The values are the objects (of type
         # __child__) that handle their contents.
-        self.entries = {}
+        self.entries = PathDict()
 
         # self.handles contains information about the directories
         # monitored by this object. The keys of the dict are the
         # values returned by the initial fam.AddMonitor() call (which
         # appear to be integers). The values are the relative paths of
         # the directories.
-        self.handles = {}
+        self.handles = ReverseDict()
 
         # Monitor everything in the plugin's directory
         self.add_directory_monitor('')
@@ -502,7 +1270,7 @@ class DirectoryBacked(object):
         cause the plugin directory itself to be monitored.
         """
         dirpathname = os.path.join(self.data, relative)
-        if relative not in self.handles.values():
+        if not self.handles.has_value(relative):
             if not os.path.isdir(dirpathname):
                 logger.error("%s is not a directory" % dirpathname)
                 return
@@ -522,6 +1290,19 @@ class DirectoryBacked(object):
                                                 self.fam)
         self.entries[relative].HandleEvent(event)
 
+    def PrepareEvent(self, event):
+        """Read the file an event refers to ahead of handling it."""
+        if event.requestID not in self.handles:
+            return
+        fname = os.path.normpath(event.filename)
+        if fname.startswith(self.data) or fname.startswith('/'):
+            return
+        if ((self.ignore and self.ignore.search(fname)) or
+            not self.patterns.search(fname)):
+            return
+        prepare_file(os.path.join(self.data, self.handles[event.requestID],
+                                  fname))
+
     def HandleEvent(self, event):
         """Handle FAM/Gamin events.
 
@@ -562,9 +1343,8 @@ class DirectoryBacked(object):
                                event.filename).lstrip('/')
 
         if action == 'deleted':
-            for key in list(self.entries.keys()):
-                if key.startswith(relpath):
-                    del self.entries[key]
+            for key in self.entries.subtree(relpath):
+                del self.entries[key]
             # We remove values from self.entries, but not
             # self.handles, because the FileMonitor doesn't stop
             # watching a directory just because it gets deleted. If it
@@ -673,8 +1453,7 @@ class XMLFileBacked(FileBacked):
     def Index(self):
         """Build local data structures."""
         try:
-            self.xdata = lxml.etree.XML(self.data, base_url=self.name,
-                                        parser=Bcfg2.Server.XMLParser)
+            self.xdata = parse_xml(self.data, self.name)
         except lxml.etree.XMLSyntaxError:
             msg = "Failed to parse %s: %s" % (self.name, sys.exc_info()[1])
             logger.error(msg)
@@ -862,36 +1641,85 @@ class XMLSrc(XMLFileBacked):
         XMLFileBacked.__init__(self, filename, fam, should_monitor)
         self.items = {}
         self.cache = None
-        self.pnode = None
+        self._pnode = None
+        # whether the items and priority were restored from the
+        # repository snapshot and the file hasn't been read to build
+        # the node tree yet
+        self._unparsed = False
         self.priority = -1
 
+    def _get_pnode(self):
+        if self._pnode is None and self._unparsed:
+            try:
+                data = read_file(self.name)
+            except IOError:
+                msg = "Failed to read file %s: %s" % (self.name,
+                                                      sys.exc_info()[1])
+                logger.error(msg)
+                raise PluginExecutionError(msg)
+            self._pnode = self._parse(data)[0]
+            self._unparsed = False
+        return self._pnode
+
+    def _set_pnode(self, value):
+        self._pnode = value
+        self._unparsed = False
+
+    pnode = property(_get_pnode, _set_pnode)
+
     def HandleEvent(self, _=None):
         """Read file upon update."""
+        state = get_state(self.name, self.__class__.__name__)
+        if state is not None:
+            # the file is read and the node tree is built when it's
+            # needed
+            (self.items, self.priority) = state
+            self._pnode = None
+            self._unparsed = True
+            self.cache = None
+            return
         try:
-            data = open(self.name).read()
+            # stat the file before reading it, so that a change made
+            # while it's read isn't recorded as unchanged
+            ondisk = os.stat(self.name)
+        except OSError:
+            ondisk = None
+        try:
+            data = read_file(self.name)
         except IOError:
             msg = "Failed to read file %s: %s" % (self.name, sys.exc_info()[1])
             logger.error(msg)
             raise PluginExecutionError(msg)
-        self.items = {}
+        (self.pnode, self.items, self.priority) = self._parse(data)
+        self.cache = None
+        if ondisk is not None:
+            set_state(self.name, ondisk, self.__class__.__name__,
+                      (self.items, self.priority))
+
+    def _parse(self, data):
+        """ parse the file contents, returning a tuple of (<node
+        tree>, <items>, <priority>) """
+        items = {}
         try:
-            xdata = lxml.etree.XML(data, parser=Bcfg2.Server.XMLParser)
+            xdata = parse_xml(data, self.name)
         except lxml.etree.XMLSyntaxError:
-            msg = "Failed to parse file %s" % (self.name, sys.exc_info()[1])
+            msg = "Failed to parse file %s: %s" % (self.name,
+                                                   sys.exc_info()[1])
             logger.error(msg)
             raise PluginExecutionError(msg)
-        self.pnode = self.__node__(xdata, self.items)
-        self.cache = None
+        pnode = self.__node__(xdata, items)
         try:
-            self.priority = int(xdata.get('priority'))
+            priority = int(xdata.get('priority'))
         except (ValueError, TypeError):
             if self.__priority_required__:
                 msg = "Got bogus priority %s for file %s" % \
                     (xdata.get('priority'), self.name)
                 logger.error(msg)
                 raise PluginExecutionError(msg)
+            priority = self.priority
 
         del xdata, data
+        return (pnode, items, priority)
 
     def Cache(self, metadata):
         """Build a package dict for a given host."""
@@ -925,6 +1753,15 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
     __child__ = XMLSrc
 
     def __init__(self, core, datastore):
+        # the dispatch table is rebuilt when it is next used after
+        # events have been handled, rather than after every event, so
+        # loading a directory of N files doesn't rebuild it N times.
+        # _entries_version counts the events handled, and
+        # _entries_built is the version the table was built from.
+        self._entries = {}
+        self._entries_version = 0
+        self._entries_built = 0
+        self._entries_lock = threading.Lock()
         Plugin.__init__(self, core, datastore)
         Generator.__init__(self)
         XMLDirectoryBacked.__init__(self, self.data, self.core.fam)
@@ -932,18 +1769,51 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
     def HandleEvent(self, event):
         """Handle events and update dispatch table."""
         XMLDirectoryBacked.HandleEvent(self, event)
-        self.Entries = {}
-        for src in list(self.entries.values()):
-            for itype, children in list(src.items.items()):
-                for child in children:
-                    try:
-                        self.Entries[itype][child] = self.BindEntry
-                    except KeyError:
-                        self.Entries[itype] = {child: self.BindEntry}
+        self._entries_version += 1
+
+    def _get_entries(self):
+        if self._entries_built != self._entries_version:
+            # builds may use the table concurrently; only one rebuilds
+            # it, and the others wait for the new table rather than
+            # getting the old one
+            self._entries_lock.acquire()
+            try:
+                version = self._entries_version
+                if self._entries_built != version:
+                    entries = {}
+                    for src in list(self.entries.values()):
+                        for itype, children in list(src.items.items()):
+                            for child in children:
+                                try:
+                                    entries[itype][child] = self.BindEntry
+                                except KeyError:
+                                    entries[itype] = {child: self.BindEntry}
+                    self._entries = entries
+                    self._entries_built = version
+            finally:
+                self._entries_lock.release()
+        return self._entries
+
+    def _set_entries(self, value):
+        self._entries_lock.acquire()
+        try:
+            self._entries = value
+            self._entries_built = self._entries_version
+        finally:
+            self._entries_lock.release()
+
+    Entries = property(_get_entries, _set_entries)
 
     def _matches(self, entry, metadata, rules):
         return entry.get('name') in rules
 
+    def get_affected_entries(self, path, entries):
+        src = self.entries.get(path[len(self.data):].lstrip("/"))
+        if src is None:
+            return []
+        return [(tag, name) for (tag, name) in entries
+                if name in src.items.get(tag, {})]
+
     def BindEntry(self, entry, metadata):
         attrs = self.get_attrs(entry, metadata)
         for key, val in list(attrs.items()):
@@ -959,6 +1829,8 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
                         entry.tag in src.cache[1] and
                         self._matches(entry, metadata,
                                       src.cache[1][entry.tag]))]
+        for src in matching:
+            Bcfg2.Server.Dependencies.record_path(src.name)
         if len(matching) == 0:
             raise PluginExecutionError('No matching source for entry when retrieving attributes for %s(%s)' % (entry.tag, entry.attrib.get('name')))
         elif len(matching) == 1:
@@ -1057,7 +1929,7 @@ class SpecificData(object):
         if event.code2str() == 'deleted':
             return
         try:
-            self.data = open(self.name).read()
+            self.data = read_file(self.name)
         except UnicodeDecodeError:
             self.data = open(self.name, mode='rb').read()
         except:
@@ -1209,6 +2081,7 @@ class EntrySet(Debuggable):
     def bind_entry(self, entry, metadata):
         """Return the appropriate interpreted template from the set of
         available templates."""
+        Bcfg2.Server.Dependencies.record_path(self.path)
         self.bind_info_to_entry(entry, metadata)
         return self.best_matching(metadata).bind_entry(entry, metadata)
 
@@ -1228,8 +2101,8 @@ class GroupSpool(Plugin, Generator):
         if self.data[-1] == '/':
             self.data = self.data[:-1]
         self.Entries[self.entry_type] = {}
-        self.entries = {}
-        self.handles = {}
+        self.entries = PathDict()
+        self.handles = ReverseDict()
         self.AddDirectoryMonitor('')
         self.encoding = core.encoding
 
@@ -1269,6 +2142,20 @@ class GroupSpool(Plugin, Generator):
                 entry.toggle_debug()
         return Plugin.toggle_debug(self)
 
+    def get_affected_entries(self, path, entries):
+        # the path may be a file in an entry set, or an entry set
+        # directory itself
+        ident = path[len(self.data):]
+        idents = [ident, os.path.dirname(ident)]
+        return [(tag, name) for (tag, name) in entries
+                if tag == self.entry_type and name in idents]
+
+    def PrepareEvent(self, event):
+        """Read the file an event refers to ahead of handling it."""
+        if event.filename[0] == '/' or event.requestID not in self.handles:
+            return
+        prepare_file(self.event_path(event))
+
     def HandleEvent(self, event):
         """Unified FAM event handler for GroupSpool."""
         action = event.code2str()
@@ -1291,9 +2178,11 @@ class GroupSpool(Plugin, Generator):
         elif action == 'deleted':
             fbase = self.handles[event.requestID] + event.filename
             if fbase in self.entries:
-                # a directory was deleted
-                del self.entries[fbase]
-                del self.Entries[self.entry_type][fbase]
+                # a directory was deleted; remove it and everything
+                # below it
+                for key in self.entries.subtree(fbase):
+                    del self.entries[key]
+                    self.Entries[self.entry_type].pop(key, None)
             elif ident in self.entries:
                 self.entries[ident].handle_event(event)
             elif ident not in self.entries:
@@ -1305,7 +2194,7 @@ class GroupSpool(Plugin, Generator):
         if not relative.endswith('/'):
             relative += '/'
         name = self.data + relative
-        if relative not in list(self.handles.values()):
+        if not self.handles.has_value(relative):
             if not os.path.isdir(name):
                 self.logger.error("Failed to open directory %s" % name)
                 return
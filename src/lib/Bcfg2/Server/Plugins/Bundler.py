@@ -9,6 +9,7 @@ import re
 import sys
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 import Bcfg2.Server.Lint
 
 try:
@@ -117,6 +118,11 @@ class Bundler(Bcfg2.Server.Plugin.Plugin,
         else:
             return BundleFile(name, self.fam)
 
+    def get_affected_entries(self, path, entries):
+        # clients that use a bundle, or would use it if it existed,
+        # have recorded its path
+        return []
+
     def BuildStructures(self, metadata):
         """Build all structures for client (metadata)."""
         bundleset = []
@@ -132,7 +138,12 @@ class Bundler(Bcfg2.Server.Plugin.Plugin,
             except KeyError:
                 self.logger.error("Bundler: Bundle %s does not exist" %
                                   bundlename)
+                # the bundle will be used if it's created
+                for ext in ['xml', 'genshi']:
+                    Bcfg2.Server.Dependencies.record_path(
+                        os.path.join(self.data, "%s.%s" % (bundlename, ext)))
                 continue
+            Bcfg2.Server.Dependencies.record_path(entries[0].name)
             try:
                 bundleset.append(entries[0].get_xml_value(metadata))
             except genshi.template.base.TemplateError:
@@ -14,6 +14,7 @@ class Bzr(Bcfg2.Server.Plugin.Plugin,
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        Bcfg2.Server.Plugin.Version.__init__(self)
         self.core = core
         self.datastore = datastore
 
@@ -1,20 +1,68 @@
-import copy
+import os
+import sys
 import logging
+import tempfile
+import threading
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Plugins.Cfg
 from Bcfg2.Server.Plugins.Cfg import CfgGenerator
 
 logger = logging.getLogger(__name__)
 
 try:
+    import Cheetah
     from Cheetah.Template import Template
     have_cheetah = True
 except ImportError:
     have_cheetah = False
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+#: the name of the cached module for the current version of each
+#: template, keyed by template filename
+_cached_modules = dict()
+#: the cache directories that have been pruned of modules that no
+#: template uses
+_pruned = set()
+_cache_lock = threading.Lock()
+
+
+def _remove_module(cachedir, modname):
+    """ remove a cached template module and its compiled bytecode """
+    for ext in ['py', 'pyc', 'pyo']:
+        try:
+            os.unlink(os.path.join(cachedir, "%s.%s" % (modname, ext)))
+        except OSError:
+            pass
+
+
+def prune_cache(cachedir):
+    """ remove all cached template modules from cachedir that are not
+    used by the current version of any template """
+    _cache_lock.acquire()
+    try:
+        current = set(_cached_modules.values())
+        try:
+            files = os.listdir(cachedir)
+        except OSError:
+            return
+        for fname in files:
+            modname = os.path.splitext(fname)[0]
+            if modname.startswith("cheetah_") and modname not in current:
+                logger.debug("Cfg: Removing unused cached template %s" %
+                             modname)
+                _remove_module(cachedir, modname)
+    finally:
+        _cache_lock.release()
+
 
 class CfgCheetahGenerator(CfgGenerator):
     __extensions__ = ['cheetah']
     settings = dict(useStackFrames=False)
+    classname = 'CfgCheetahTemplate'
 
     def __init__(self, fname, spec, encoding):
         CfgGenerator.__init__(self, fname, spec, encoding)
@@ -22,10 +70,102 @@ class CfgCheetahGenerator(CfgGenerator):
             msg = "Cfg: Cheetah is not available: %s" % entry.get("name")
             logger.error(msg)
             raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
+        # the compiled template class; each bind instantiates it
+        # rather than compiling the template again
+        self.template_cls = None
+
+    def handle_event(self, event):
+        CfgGenerator.handle_event(self, event)
+        self.template_cls = None
+        self.update_cache()
+
+    def _get_cachedir(self):
+        """ get the directory compiled templates are cached in, or
+        None if they are not cached """
+        setup = Bcfg2.Server.Plugins.Cfg.SETUP
+        if setup is not None and 'cheetah_cache' in setup:
+            return setup['cheetah_cache']
+        return None
+
+    def _get_modname(self, source):
+        """ get the name of the cached module for the given template
+        source """
+        key = "%s\0%s\0%s" % (getattr(Cheetah, 'Version', ''),
+                              self.settings, source)
+        return "cheetah_%s" % md5(key.encode('UTF-8')).hexdigest()
+
+    def update_cache(self):
+        """ record the cached module used by the current version of
+        the template, and remove the module of the previous version
+        if no other template uses it """
+        cachedir = self._get_cachedir()
+        if not cachedir or self.data is None:
+            return
+        try:
+            modname = self._get_modname(self.data.decode(self.encoding))
+        except UnicodeError:
+            return
+        _cache_lock.acquire()
+        try:
+            old = _cached_modules.get(self.name)
+            _cached_modules[self.name] = modname
+            if (old is not None and old != modname and
+                old not in _cached_modules.values()):
+                _remove_module(cachedir, old)
+        finally:
+            _cache_lock.release()
+
+    def get_template_cls(self):
+        """ get the compiled template class, compiling it (or loading
+        it from the on-disk cache) if necessary """
+        if self.template_cls is None:
+            source = self.data.decode(self.encoding)
+            cachedir = self._get_cachedir()
+            if cachedir:
+                self.template_cls = self._load_cached(source, cachedir)
+            else:
+                self.template_cls = \
+                    Template.compile(source, className=self.classname,
+                                     compilerSettings=self.settings)
+        return self.template_cls
+
+    def _load_cached(self, source, cachedir):
+        """ get the template class for the given source from the
+        generated Python module in cachedir, generating and saving
+        the module first if it doesn't exist.  The first time this
+        is called, which is after the repository has been loaded,
+        modules that no template uses (e.g., those of templates that
+        were changed while the server was down) are removed. """
+        if cachedir not in _pruned:
+            _pruned.add(cachedir)
+            prune_cache(cachedir)
+        modname = self._get_modname(source)
+        modfile = os.path.join(cachedir, "%s.py" % modname)
+        try:
+            code = open(modfile).read()
+        except IOError:
+            code = Template.compile(source, returnAClass=False,
+                                    moduleName=modname,
+                                    className=self.classname,
+                                    compilerSettings=self.settings)
+            try:
+                if not os.path.exists(cachedir):
+                    os.makedirs(cachedir)
+                (fd, tmpfile) = tempfile.mkstemp(dir=cachedir)
+                cache = os.fdopen(fd, 'w')
+                cache.write(code)
+                cache.close()
+                os.rename(tmpfile, modfile)
+            except (IOError, OSError, UnicodeError):
+                err = sys.exc_info()[1]
+                logger.warning("Cfg: Could not cache compiled template %s: "
+                               "%s" % (self.name, err))
+        namespace = dict(__name__=modname)
+        eval(compile(code, modfile, 'exec'), namespace)
+        return namespace[self.classname]
 
     def get_data(self, entry, metadata):
-        template = Template(self.data.decode(self.encoding),
-                            compilerSettings=self.settings)
+        template = self.get_template_cls()()
         template.metadata = metadata
         template.path = entry.get('realname', entry.get('name'))
         template.source_path = self.name
@@ -2,6 +2,12 @@ import logging
 from Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator import CfgCheetahGenerator
 from Bcfg2.Server.Plugins.Cfg.CfgEncryptedGenerator import CfgEncryptedGenerator
 
+try:
+    from Cheetah.Template import Template
+except ImportError:
+    # CfgCheetahGenerator refuses to load templates without Cheetah
+    pass
+
 logger = logging.getLogger(__name__)
 
 class CfgEncryptedCheetahGenerator(CfgCheetahGenerator, CfgEncryptedGenerator):
@@ -9,6 +15,23 @@ class CfgEncryptedCheetahGenerator(CfgCheetahGenerator, CfgEncryptedGenerator):
 
     def handle_event(self, event):
         CfgEncryptedGenerator.handle_event(self, event)
+        self.template_cls = None
+
+    def update_cache(self):
+        """ encrypted templates are never cached on disk, so there is
+        no cached module to keep track of """
+        pass
+
+    def get_template_cls(self):
+        """ get the compiled template class.  The decrypted template
+        is only compiled in memory; writing it to the on-disk cache
+        would store it in plaintext. """
+        if self.template_cls is None:
+            self.template_cls = \
+                Template.compile(self.data.decode(self.encoding),
+                                 className=self.classname,
+                                 compilerSettings=self.settings)
+        return self.template_cls
 
     def get_data(self, entry, metadata):
         return CfgCheetahGenerator.get_data(self, entry, metadata)
@@ -1,33 +1,102 @@
 import os
+import time
 import shlex
 import logging
+import threading
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Plugins.Cfg
 from subprocess import Popen, PIPE
+from Bcfg2.Cache import LRUCache
+from Bcfg2.Compat import unicode
 from Bcfg2.Server.Plugins.Cfg import CfgVerifier, CfgVerificationError
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 logger = logging.getLogger(__name__)
 
 class CfgExternalCommandVerifier(CfgVerifier):
     __basenames__ = [':test']
 
+    #: the number of verification results to remember
+    __cache_size__ = 1024
+
+    def __init__(self, fname, spec, encoding):
+        CfgVerifier.__init__(self, fname, spec, encoding)
+        self.cmd = []
+        # results are keyed on (revision, digest of the data), so
+        # identical data is only verified once for each revision of
+        # the :test file
+        self.revision = 0
+        self.results = LRUCache(self.__cache_size__)
+        # verifications that are currently running, keyed like
+        # self.results.  other threads verifying the same data wait
+        # for the running verification instead of starting another
+        self.running = dict()
+        self.lock = threading.Lock()
+
     def verify_entry(self, entry, metadata, data):
+        if isinstance(data, unicode):
+            key = (self.revision, md5(data.encode(self.encoding)).hexdigest())
+        else:
+            key = (self.revision, md5(data).hexdigest())
+        result = None
+        while result is None:
+            self.lock.acquire()
+            result = self.results.get(key)
+            if result is None:
+                event = self.running.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.running[key] = event
+                    self.lock.release()
+                    try:
+                        result = self._run(data)
+                        self.results[key] = result
+                    finally:
+                        self.lock.acquire()
+                        del self.running[key]
+                        self.lock.release()
+                        event.set()
+                else:
+                    self.lock.release()
+                    event.wait()
+            else:
+                self.lock.release()
+        (rv, err) = result
+        if rv != 0:
+            raise CfgVerificationError(err)
+
+    def _run(self, data):
+        """ run the verifier command on the given data and return a
+        tuple of (return value, stderr) """
+        start = time.time()
         proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
         err = proc.communicate(input=data)[1]
         rv = proc.wait()
-        if rv != 0:
-            raise CfgVerificationError(err)
+        cfg = Bcfg2.Server.Plugins.Cfg.CFG
+        if cfg is not None and hasattr(cfg.core, 'stats'):
+            cfg.core.stats.add_value("%s:run" % self.__class__.__name__,
+                                     time.time() - start)
+        return (rv, err)
 
     def handle_event(self, event):
         if event.code2str() == 'deleted':
             return
-        self.cmd = []
+        cmd = []
         if not os.access(self.name, os.X_OK):
             bangpath = open(self.name).readline().strip()
             if bangpath.startswith("#!"):
-                self.cmd.extend(shlex.split(bangpath[2:].strip()))
+                cmd.extend(shlex.split(bangpath[2:].strip()))
             else:
                 msg = "Cannot execute %s" % self.name
                 logger.error(msg)
                 raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
-        self.cmd.append(self.name)
-    
+        cmd.append(self.name)
+        self.lock.acquire()
+        self.cmd = cmd
+        self.revision += 1
+        self.results.clear()
+        self.lock.release()
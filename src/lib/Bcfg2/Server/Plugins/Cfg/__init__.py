@@ -8,6 +8,7 @@ import logging
 import lxml.etree
 import Bcfg2.Options
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 from Bcfg2.Compat import u_str, unicode, b64encode, walk_packages
 import Bcfg2.Server.Lint
 
@@ -15,6 +16,7 @@ logger = logging.getLogger(__name__)
 
 PROCESSORS = None
 SETUP = None
+CFG = None
 
 class CfgBaseFileMatcher(Bcfg2.Server.Plugin.SpecificData):
     __basenames__ = []
@@ -213,6 +215,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             self.entries[event.filename].handle_event(event)
 
     def bind_entry(self, entry, metadata):
+        Bcfg2.Server.Dependencies.record_path(self.path)
         info_handlers = []
         generators = []
         filters = []
@@ -398,14 +401,18 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
     es_child_cls = Bcfg2.Server.Plugin.SpecificData
 
     def __init__(self, core, datastore):
-        global SETUP
+        global SETUP, CFG
         Bcfg2.Server.Plugin.GroupSpool.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.PullTarget.__init__(self)
         
+        CFG = self
         SETUP = core.setup
         if 'validate' not in SETUP:
             SETUP.add_option('validate', Bcfg2.Options.CFG_VALIDATION)
             SETUP.reparse()
+        if 'cheetah_cache' not in SETUP:
+            SETUP.add_option('cheetah_cache', Bcfg2.Options.CFG_CHEETAH_CACHE)
+            SETUP.reparse()
 
     def has_generator(self, entry, metadata):
         """ return True if the given entry can be generated for the
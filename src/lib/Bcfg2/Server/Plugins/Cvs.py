@@ -15,6 +15,7 @@ class Cvs(Bcfg2.Server.Plugin.Plugin,
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        Bcfg2.Server.Plugin.Version.__init__(self)
         self.core = core
         self.datastore = datastore
 
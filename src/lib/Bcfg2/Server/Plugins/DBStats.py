@@ -11,7 +11,7 @@ except ImportError:
     pass
 
 import Bcfg2.Server.Plugin
-from Bcfg2.Server.Reports.importscript import load_stat
+from Bcfg2.Server.Reports.importscript import load_stat, load_stat_batch
 from Bcfg2.Server.Reports.reports.models import Client
 from Bcfg2.Compat import b64decode
 
@@ -31,10 +31,35 @@ class DBStats(Bcfg2.Server.Plugin.ThreadedStatistics,
         if not self.core.database_available:
             raise Bcfg2.Server.Plugin.PluginInitError
 
+    def handle_statistics_batch(self, batch):
+        if len(batch) == 1:
+            self.handle_statistic(*batch[0])
+            return
+        stats = []
+        for (metadata, data) in batch:
+            newstats = data.find("Statistics")
+            newstats.set('time', time.asctime(time.localtime()))
+            stats.append((metadata, newstats))
+
+        start = time.time()
+        # interactions that can't be imported together are imported
+        # one at a time, with retries
+        load_stat_batch(stats,
+                        self.core.encoding,
+                        0,
+                        logger,
+                        True,
+                        platform.node(),
+                        fallback=self._load_stat)
+        logger.info("Imported data for %s clients in %s seconds" \
+                    % (len(stats), time.time() - start))
+
     def handle_statistic(self, metadata, data):
         newstats = data.find("Statistics")
         newstats.set('time', time.asctime(time.localtime()))
+        self._load_stat(metadata, newstats)
 
+    def _load_stat(self, metadata, newstats):
         start = time.time()
         for i in [1, 2, 3]:
             try:
@@ -11,9 +11,11 @@ class Fossil(Bcfg2.Server.Plugin.Plugin,
     """Fossil is a version plugin for dealing with Bcfg2 repos."""
     name = 'Fossil'
     __author__ = 'bcfg-dev@mcs.anl.gov'
+    __vcs_metadata__ = ['_FOSSIL_']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        Bcfg2.Server.Plugin.Version.__init__(self)
         self.core = core
         self.datastore = datastore
 
@@ -14,12 +14,15 @@ class Git(Bcfg2.Server.Plugin.Plugin,
     """Git is a version plugin for dealing with Bcfg2 repos."""
     name = 'Git'
     __author__ = 'bcfg-dev@mcs.anl.gov'
+    __vcs_metadata__ = ['.git', '.git/HEAD', '.git/packed-refs']
+    __vcs_metadata_recursive__ = ['.git/refs/heads']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.Version.__init__(self)
         self.core = core
         self.datastore = datastore
+        self.repo = None
 
         # path to git directory for bcfg2 repo
         git_dir = "%s/.git" % datastore
@@ -36,8 +39,9 @@ class Git(Bcfg2.Server.Plugin.Plugin,
     def get_revision(self):
         """Read git revision information for the Bcfg2 repository."""
         try:
-            repo = Repo(self.datastore)
-            revision = repo.head()
+            if self.repo is None:
+                self.repo = Repo(self.datastore)
+            revision = self.repo.head()
         except:
             logger.error("Failed to read git repository; disabling git support")
             raise Bcfg2.Server.Plugin.PluginInitError
@@ -12,6 +12,7 @@ class Hg(Bcfg2.Server.Plugin.Plugin,
     name = 'Mercurial'
     __author__ = 'bcfg-dev@mcs.anl.gov'
     experimental = True
+    __vcs_metadata__ = ['.hg', '.hg/store']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
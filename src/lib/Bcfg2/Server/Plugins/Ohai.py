@@ -1,10 +1,20 @@
-import lxml.etree
 import os
+import sys
+import tempfile
+import threading
+import lxml.etree
 
 import logging
 logger = logging.getLogger('Bcfg2.Plugins.Ohai')
 
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import LRUCache
+from Bcfg2.Compat import Mapping, unicode
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 try:
     import json
@@ -32,30 +42,133 @@ fi
 """
 
 class OhaiCache(object):
-    def __init__(self, dirname):
+    """ Ohai data for each client.  The raw JSON is stored on disk,
+    and only parsed when it is used; at most ``size`` parsed
+    documents are kept in memory. """
+
+    def __init__(self, dirname, size=128):
         self.dirname = dirname
-        self.cache = dict()
+        # hostname -> parsed data, for recently used clients
+        self.cache = LRUCache(size)
+        # hostname -> mtime of the raw JSON on disk
+        self.mtimes = dict()
+        # hostname -> digest of the raw JSON on disk; computed the
+        # first time new data arrives for a client
+        self.digests = dict()
+        self.lock = threading.Lock()
+        for fname in os.listdir(self.dirname):
+            if fname.endswith(".json"):
+                try:
+                    self.mtimes[fname[:-5]] = \
+                        os.stat(os.path.join(self.dirname, fname)).st_mtime
+                except OSError:
+                    pass
+
+    def _path(self, item):
+        return os.path.join(self.dirname, "%s.json" % item)
+
+    def _digest(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('UTF-8')
+        return md5(value).hexdigest()
 
     def __setitem__(self, item, value):
         if value == None:
             # simply return if the client returned nothing
             return
-        self.cache[item] = json.loads(value)
-        open("%s/%s.json" % (self.dirname, item), 'w').write(value)
+        digest = self._digest(value)
+        self.lock.acquire()
+        try:
+            if item not in self.digests and item in self.mtimes:
+                try:
+                    self.digests[item] = \
+                        self._digest(open(self._path(item)).read())
+                except IOError:
+                    pass
+            if self.digests.get(item) == digest:
+                # unchanged since the last upload
+                return
+            try:
+                # make sure the new data can be parsed, but leave
+                # parsing it for real until somebody uses it
+                json.loads(value)
+            except ValueError:
+                # keep the last good data rather than replacing it
+                # with something that can't be parsed
+                logger.error("Ohai: Invalid JSON from %s, discarding: %s" %
+                             (item, sys.exc_info()[1]))
+                return
+            (fd, tmpfile) = tempfile.mkstemp(dir=self.dirname)
+            os.fdopen(fd, 'w').write(value)
+            os.rename(tmpfile, self._path(item))
+            self.mtimes[item] = os.stat(self._path(item)).st_mtime
+            self.digests[item] = digest
+            try:
+                # the parsed data is stale
+                del self.cache[item]
+            except KeyError:
+                pass
+        finally:
+            self.lock.release()
 
     def __getitem__(self, item):
-        if item not in self.cache:
+        rv = self.cache.get(item)
+        if rv is None:
+            if item not in self.mtimes:
+                raise KeyError(item)
             try:
-                data = open("%s/%s.json" % (self.dirname, item)).read()
-            except:
+                rv = json.loads(open(self._path(item)).read())
+            except IOError:
+                raise KeyError(item)
+            except ValueError:
+                logger.error("Ohai: Invalid JSON in %s: %s" %
+                             (self._path(item), sys.exc_info()[1]))
                 raise KeyError(item)
-            self.cache[item] = json.loads(data)
-        return self.cache[item]
+            self.cache[item] = rv
+        return rv
+
+    def __contains__(self, item):
+        return item in self.mtimes
 
     def __iter__(self):
-        data = list(self.cache.keys())
-        data.extend([x[:-5] for x in os.listdir(self.dirname)])
-        return data.__iter__()
+        return iter(list(self.mtimes.keys()))
+
+
+class OhaiData(Mapping):
+    """ Ohai data for a single client.  The JSON is only parsed when
+    the data is first accessed. """
+
+    def __init__(self, cache, hostname):
+        self.cache = cache
+        self.hostname = hostname
+        self._data = None
+
+    def _get_data(self):
+        if self._data is None:
+            try:
+                self._data = self.cache[self.hostname]
+            except (KeyError, ValueError):
+                self._data = dict()
+        return self._data
+    data = property(_get_data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.hostname)
 
 
 class Ohai(Bcfg2.Server.Plugin.Plugin,
@@ -67,6 +180,9 @@ class Ohai(Bcfg2.Server.Plugin.Plugin,
     name = 'Ohai'
     experimental = True
 
+    #: the default number of parsed Ohai documents to keep in memory
+    __cache_size__ = 128
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.Probing.__init__(self)
@@ -78,7 +194,14 @@ class Ohai(Bcfg2.Server.Plugin.Plugin,
             os.stat(self.data)
         except:
             os.makedirs(self.data)
-        self.cache = OhaiCache(self.data)
+        try:
+            size = int(core.setup.cfp.get("ohai", "cache_size",
+                                          default=str(self.__cache_size__)))
+        except ValueError:
+            self.logger.error("Ohai: Invalid cache_size, using default of "
+                              "%s" % self.__cache_size__)
+            size = self.__cache_size__
+        self.cache = OhaiCache(self.data, size=size)
 
     def GetProbes(self, meta, force=False):
         return [self.probe]
@@ -88,5 +211,5 @@ class Ohai(Bcfg2.Server.Plugin.Plugin,
 
     def get_additional_data(self, meta):
         if meta.hostname in self.cache:
-            return self.cache[meta.hostname]
+            return OhaiData(self.cache, meta.hostname)
         return dict()
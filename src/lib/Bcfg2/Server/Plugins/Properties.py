@@ -3,8 +3,12 @@ import re
 import sys
 import copy
 import logging
+import threading
 import lxml.etree
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
+from Bcfg2.Cache import LRUCache
+from Bcfg2.Compat import MutableMapping
 try:
     from Bcfg2.Encryption import ssl_decrypt, EVPError
     have_crypto = True
@@ -26,6 +30,17 @@ def passphrases():
 
 class PropertyFile(Bcfg2.Server.Plugin.StructFile):
     """Class for properties files."""
+
+    #: the number of filtered views of the file to keep
+    __view_cache_size__ = 128
+
+    def __init__(self, filename, fam=None, should_monitor=False):
+        Bcfg2.Server.Plugin.StructFile.__init__(self, filename, fam=fam,
+                                                should_monitor=should_monitor)
+        self.groups = set()
+        self.clients = set()
+        self.views = LRUCache(self.__view_cache_size__)
+
     def write(self):
         """ Write the data in this data structure back to the property
         file """
@@ -74,6 +89,11 @@ class PropertyFile(Bcfg2.Server.Plugin.StructFile):
 
     def Index(self):
         Bcfg2.Server.Plugin.StructFile.Index(self)
+        # the groups and clients this file refers to.  any two
+        # clients that agree on these get the same XMLMatch() result
+        self.groups = set(self.xdata.xpath("//Group/@name"))
+        self.clients = set(self.xdata.xpath("//Client/@name"))
+        self.views.clear()
         if self.xdata.get("encryption", "false").lower() != "false":
             if not have_crypto:
                 msg = "Properties: M2Crypto is not available: %s" % self.name
@@ -88,6 +108,22 @@ class PropertyFile(Bcfg2.Server.Plugin.StructFile):
                     logger.error(msg)
                     raise Bcfg2.Server.PluginExecutionError(msg)
 
+    def XMLMatch(self, metadata):
+        """ Return a rebuilt XML document that only contains the
+        matching portions.  The filtered document is cached for all
+        clients with the same relevant groups, and each caller gets
+        its own copy of it. """
+        if metadata.hostname in self.clients:
+            client = metadata.hostname
+        else:
+            client = None
+        key = (frozenset(self.groups.intersection(metadata.groups)), client)
+        view = self.views.get(key)
+        if view is None:
+            view = Bcfg2.Server.Plugin.StructFile.XMLMatch(self, metadata)
+            self.views[key] = view
+        return copy.deepcopy(view)
+
     def _decrypt(self, element):
         if not element.text.strip():
             return
@@ -107,6 +143,65 @@ class PropertyFile(Bcfg2.Server.Plugin.StructFile):
                     pass
         raise EVPError("Failed to decrypt")
 
+class LazyProperties(MutableMapping):
+    """ dict of property file name -> property data for a client.
+    The filtered views of automatch property files are only built when
+    they are first accessed.  If the Properties directory is given,
+    the files that are accessed are recorded as dependencies of the
+    configuration being built. """
+
+    def __init__(self, metadata, data=None):
+        self.metadata = metadata
+        self.datadir = data
+        self.data = dict()
+        # property files whose views haven't been built yet
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def add_match(self, fname, pfile):
+        """ add a property file whose XMLMatch() should be returned
+        for fname when it is accessed """
+        self.pending[fname] = pfile
+
+    def __getitem__(self, key):
+        if self.datadir is not None:
+            Bcfg2.Server.Dependencies.record_path(os.path.join(self.datadir,
+                                                               key))
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                self.data[key] = self.pending[key].XMLMatch(self.metadata)
+                del self.pending[key]
+            return self.data[key]
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, key, value):
+        self.pending.pop(key, None)
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        if key in self.pending:
+            del self.pending[key]
+        else:
+            del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.pending or key in self.data
+
+    def keys(self):
+        return list(self.data.keys()) + list(self.pending.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.data) + len(self.pending)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.keys())
+
+
 class PropDirectoryBacked(Bcfg2.Server.Plugin.DirectoryBacked):
     __child__ = PropertyFile
     patterns = re.compile(r'.*\.xml$')
@@ -135,14 +230,19 @@ class Properties(Bcfg2.Server.Plugin.Plugin,
 
         SETUP = core.setup
 
+    def get_affected_entries(self, path, entries):
+        # clients whose templates use a property file, or tried to use
+        # it before it existed, have recorded its path
+        return []
+
     def get_additional_data(self, metadata):
         autowatch = self.core.setup.cfp.getboolean("properties", "automatch",
                                                    default=False)
-        rv = dict()
+        rv = LazyProperties(metadata, data=self.store.data)
         for fname, pfile in self.store.entries.items():
             if (autowatch or
                 pfile.xdata.get("automatch", "false").lower() == "true"):
-                rv[fname] = pfile.XMLMatch(metadata)
+                rv.add_match(fname, pfile)
             else:
                 rv[fname] = copy.copy(pfile)
         return rv
@@ -1,7 +1,11 @@
 import os
+import sys
+import time
+import threading
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
 from subprocess import Popen, PIPE
+from Bcfg2.Cache import LRUCache
 
 try:
     from syck import load as yaml_load, error as yaml_error
@@ -26,6 +30,13 @@ class PuppetENC(Bcfg2.Server.Plugin.Plugin,
     experimental = True
     __child__ = PuppetENCFile
 
+    #: the maximum number of ENC results to keep across client runs
+    __cache_size__ = 4096
+
+    #: cached ENC results are refreshed in the background once they
+    #: are older than this fraction of cache_ttl
+    __refresh_after__ = 0.75
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.Connector.__init__(self)
@@ -34,35 +45,135 @@ class PuppetENC(Bcfg2.Server.Plugin.Plugin,
                                                      self.core.fam)
         self.cache = dict()
 
+        # ENC output is kept across client runs for cache_ttl
+        # seconds.  results are keyed on (enc, hostname), and store
+        # the mtime of the ENC so that changing it invalidates them
+        try:
+            self.ttl = int(self.core.setup.cfp.get("puppetenc", "cache_ttl",
+                                                   default="0"))
+        except ValueError:
+            self.logger.error("PuppetENC: Invalid cache_ttl, disabling "
+                              "ENC result cache")
+            self.ttl = 0
+        self.results = LRUCache(self.__cache_size__)
+        # (enc, hostname) pairs that are being refreshed in the
+        # background
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def _run_enc(self, enc, hostname):
+        """ run a single ENC for the given host and return the parsed
+        YAML output """
+        epath = os.path.join(self.data, enc)
+        self.debug_log("PuppetENC: Running ENC %s for %s" % (enc, hostname))
+        start = time.time()
+        proc = Popen([epath, hostname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        (out, err) = proc.communicate()
+        rv = proc.wait()
+        if hasattr(self.core, 'stats'):
+            self.core.stats.add_value("PuppetENC:%s" % enc,
+                                      time.time() - start)
+        if rv != 0:
+            msg = "PuppetENC: Error running ENC %s for %s (%s)" % \
+                (enc, hostname, rv)
+            self.logger.error("%s: %s" % (msg, err))
+            raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
+        if err:
+            self.debug_log("ENC Error: %s" % err)
+
+        try:
+            yaml = yaml_load(out)
+            self.debug_log("Loaded data from %s for %s: %s" %
+                           (enc, hostname, yaml))
+        except yaml_error:
+            err = sys.exc_info()[1]
+            msg = "Error decoding YAML from %s for %s: %s" % \
+                (enc, hostname, err)
+            self.logger.error(msg)
+            raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
+        return yaml
+
+    def _refresh(self, enc, hostname, mtime):
+        """ run an ENC, cache the result, and return it """
+        try:
+            yaml = self._run_enc(enc, hostname)
+            self.results[(enc, hostname)] = (mtime, time.time(), yaml)
+            return yaml
+        finally:
+            self.lock.acquire()
+            self.refreshing.discard((enc, hostname))
+            self.lock.release()
+
+    def _background_refresh(self, enc, hostname, mtime):
+        """ refresh a cached ENC result in a separate thread """
+        try:
+            self._refresh(enc, hostname, mtime)
+        except Bcfg2.Server.Plugin.PluginExecutionError:
+            # already logged; the old result stays cached until it
+            # expires
+            pass
+
+    def _get_enc(self, enc, hostname):
+        """ get the parsed output of an ENC for the given host, from
+        the cache if possible """
+        if not self.ttl:
+            return self._run_enc(enc, hostname)
+        key = (enc, hostname)
+        try:
+            mtime = os.stat(os.path.join(self.data, enc)).st_mtime
+        except OSError:
+            mtime = None
+        cached = self.results.get(key)
+        if cached is not None and cached[0] == mtime:
+            age = time.time() - cached[1]
+            if age < self.ttl:
+                if age > self.ttl * self.__refresh_after__:
+                    self.lock.acquire()
+                    try:
+                        if key not in self.refreshing:
+                            self.refreshing.add(key)
+                            thread = threading.Thread(
+                                target=self._background_refresh,
+                                args=(enc, hostname, mtime))
+                            thread.setDaemon(True)
+                            thread.start()
+                    finally:
+                        self.lock.release()
+                return cached[2]
+        self.lock.acquire()
+        self.refreshing.add(key)
+        self.lock.release()
+        return self._refresh(enc, hostname, mtime)
+
     def _run_encs(self, metadata):
         cache = dict(groups=[], params=dict())
-        for enc in self.entries.keys():
-            epath = os.path.join(self.data, enc)
-            self.debug_log("PuppetENC: Running ENC %s for %s" %
-                           (enc, metadata.hostname))
-            proc = Popen([epath, metadata.hostname], stdin=PIPE, stdout=PIPE,
-                         stderr=PIPE)
-            (out, err) = proc.communicate()
-            rv = proc.wait()
-            if rv != 0:
-                msg = "PuppetENC: Error running ENC %s for %s (%s): %s" % \
-                    (enc, metadata.hostname, rv)
-                self.logger.error("%s: %s" % (msg, err))
-                raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
-            if err:
-                self.debug_log("ENC Error: %s" % err)
-
-            try:
-                yaml = yaml_load(out)
-                self.debug_log("Loaded data from %s for %s: %s" %
-                               (enc, metadata.hostname, yaml))
-            except yaml_error:
-                err = sys.exc_info()[1]
-                msg = "Error decoding YAML from %s for %s: %s" % \
-                    (enc, metadata.hostname, err)
-                self.logger.error(msg)
-                raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
-            
+        encs = sorted(self.entries.keys())
+        results = dict()
+        if len(encs) > 1:
+            # run the ENCs concurrently
+            errors = []
+
+            def run(enc):
+                try:
+                    results[enc] = self._get_enc(enc, metadata.hostname)
+                except:
+                    errors.append(sys.exc_info()[1])
+
+            threads = []
+            for enc in encs:
+                thread = threading.Thread(target=run, args=(enc,))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        else:
+            for enc in encs:
+                results[enc] = self._get_enc(enc, metadata.hostname)
+
+        for enc in encs:
+            yaml = results[enc]
             groups = []
             if "classes" in yaml:
                 # stock Puppet ENC output format
@@ -110,8 +221,10 @@ class PuppetENC(Bcfg2.Server.Plugin.Plugin,
         the caching less than stellar, but it does prevent multiple
         runs of ENCs for a single host a) for groups and data
         separately; and b) when a single client's metadata is
-        generated multiple times by separate templates """
+        generated multiple times by separate templates.  if cache_ttl
+        is set, the ENC output itself is kept across runs in
+        self.results, so rebuilding this cache is cheap """
         self.cache = dict()
 
     def end_statistics(self, metadata):
-        self.end_client_run(self, metadata)
+        self.end_client_run(metadata)
@@ -1,6 +1,7 @@
 """This generator provides rule-based entry mappings."""
 
 import re
+import sys
 import Bcfg2.Server.Plugin
 
 class Rules(Bcfg2.Server.Plugin.PrioDir):
@@ -8,44 +9,139 @@ class Rules(Bcfg2.Server.Plugin.PrioDir):
     name = 'Rules'
     __author__ = 'bcfg-dev@mcs.anl.gov'
 
+    #: the number of regex rules combined into a single pattern that
+    #: is used to quickly rule out entries that match none of them
+    __regex_chunk__ = 50
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.PrioDir.__init__(self, core, datastore)
         self._regex_cache = dict()
+        self._reset_index()
 
     def HandlesEntry(self, entry, metadata):
         if entry.tag in self.Entries:
-            return self._matches(entry, metadata,
-                                 self.Entries[entry.tag].keys())
+            return bool(self._matching_rules(entry.tag, entry.get('name')))
         return False
 
     def HandleEntry(self, entry, metadata):
         return self.BindEntry(entry, metadata)
 
+    def HandleEvent(self, event):
+        Bcfg2.Server.Plugin.PrioDir.HandleEvent(self, event)
+        self._reset_index()
+
     def BindEntry(self, entry, metadata):
         attrs = self.get_attrs(entry, metadata)
         for key, val in list(attrs.items()):
             if key not in entry.attrib:
                 entry.attrib[key] = val
 
+    def get_affected_entries(self, path, entries):
+        src = self.entries.get(path[len(self.data):].lstrip("/"))
+        if src is None:
+            return []
+        return [(tag, name) for (tag, name) in entries
+                if (tag in src.items and
+                    self._matching_rules(tag, name) & set(src.items[tag]))]
+
     def _matches(self, entry, metadata, rules):
-        if Bcfg2.Server.Plugin.PrioDir._matches(self, entry, metadata, rules):
-            return True
-        elif (entry.tag == "Path" and
-              ((entry.get('name').endswith("/") and
-                entry.get('name').rstrip("/") in rules) or
-               (not entry.get('name').endswith("/") and
-                entry.get('name') + '/' in rules))):
+        for rule in self._matching_rules(entry.tag, entry.get('name')):
+            if rule in rules:
+                return True
+        return False
+
+    def _reset_index(self):
+        """ discard the rule index and the match cache; they are
+        rebuilt on demand """
+        self._index = None
+        self._match_cache = dict()
+
+    def _build_index(self):
+        """ build a dict of <tag> -> (<set of rule names>, <list of
+        (<combined regex>, <list of rule names>)>) from all rules """
+        rules = dict()
+        for src in list(self.entries.values()):
+            for tag, names in list(src.items.items()):
+                rules.setdefault(tag, set()).update(names)
+
+        index = dict()
+        regex_enabled = self._regex_enabled()
+        for tag, names in rules.items():
+            chunks = []
+            if regex_enabled:
+                regexes = []
+                for name in names:
+                    if not self._compile_rule(name):
+                        continue
+                    if self._regex_cache[name].groups:
+                        # combining regexes renumbers their groups,
+                        # which breaks backreferences, so regexes with
+                        # groups are tested alone
+                        chunks.append((self._regex_cache[name], [name]))
+                    else:
+                        regexes.append(name)
+                for i in range(0, len(regexes), self.__regex_chunk__):
+                    chunk = regexes[i:i + self.__regex_chunk__]
+                    try:
+                        combined = re.compile("|".join(["(?:%s)$" % n
+                                                        for n in chunk]))
+                        chunks.append((combined, chunk))
+                    except re.error:
+                        # some regexes can't be combined
+                        chunks.extend([(self._regex_cache[n], [n])
+                                       for n in chunk])
+            index[tag] = (names, chunks)
+        return index
+
+    def _compile_rule(self, rule):
+        """ compile a single rule name into a regex, returning False
+        if it is not a valid regex """
+        if rule not in self._regex_cache:
+            try:
+                self._regex_cache[rule] = re.compile("%s$" % rule)
+            except re.error:
+                self.logger.error("%s: Invalid regular expression %s: %s" %
+                                  (self.name, rule, sys.exc_info()[1]))
+                self._regex_cache[rule] = None
+        return self._regex_cache[rule] is not None
+
+    def _matching_rules(self, tag, name):
+        """ get the set of rule names of the given tag that match the
+        given entry name """
+        # capture the cache and index so that a concurrent
+        # HandleEvent() can't leave stale data in the new ones
+        cache = self._match_cache
+        if (tag, name) in cache:
+            return cache[(tag, name)]
+        index = self._index
+        if index is None:
+            index = self._build_index()
+            if cache is self._match_cache:
+                self._index = index
+        if tag not in index:
+            return set()
+        rules, chunks = index[tag]
+
+        matched = set()
+        if name in rules:
+            matched.add(name)
+        if tag == "Path":
             # special case for Path tags:
             # http://trac.mcs.anl.gov/projects/bcfg2/ticket/967
-            return True
-        elif self._regex_enabled:
+            if name.endswith("/"):
+                other = name.rstrip("/")
+            else:
+                other = name + "/"
+            if other in rules:
+                matched.add(other)
+        for combined, chunk in chunks:
             # attempt regular expression matching
-            for rule in rules:
-                if rule not in self._regex_cache:
-                    self._regex_cache[rule] = re.compile("%s$" % rule)
-                if self._regex_cache[rule].match(entry.get('name')):
-                    return True
-        return False
+            if combined.match(name):
+                for rule in chunk:
+                    if self._regex_cache[rule].match(name):
+                        matched.add(rule)
+        cache[(tag, name)] = matched
+        return matched
 
     def _regex_enabled(self):
         return self.core.setup.cfp.getboolean("rules", "regex", default=False)
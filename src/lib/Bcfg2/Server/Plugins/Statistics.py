@@ -8,38 +8,68 @@ import os
 import sys
 from time import asctime, localtime, time, strptime, mktime
 import threading
+from Bcfg2.Cache import LRUCache
 from Bcfg2.Compat import b64decode
 import Bcfg2.Server.Plugin
 
 
 class StatisticsStore(object):
     """Manages the memory and file copy of statistics collected about client runs."""
-    __min_write_delay__ = 0
+    #: the minimum number of seconds between rewrites of the whole
+    #: statistics file.  new statistics are appended to a journal
+    #: in the meantime.
+    __min_write_delay__ = 60
+
+    #: the number of parsed timestamps to remember
+    __time_cache_size__ = 16384
 
     def __init__(self, filename):
         self.filename = filename
+        self.journal = "%s.journal" % filename
         self.element = lxml.etree.Element('Dummy')
+        # client name -> Node element
+        self.nodes = dict()
+        # sequence number of the last entry appended to the journal.
+        # the statistics file records the last sequence number it
+        # contains, so entries that were already written out are not
+        # applied twice if the journal outlives a write.
+        self.seq = 0
+        self.times = LRUCache(self.__time_cache_size__)
         self.dirty = 0
         self.lastwrite = 0
+        self.lock = threading.RLock()
         self.logger = logging.getLogger('Bcfg2.Server.Statistics')
         self.ReadFromFile()
 
     def WriteBack(self, force=0):
         """Write statistics changes back to persistent store."""
-        if (self.dirty and (self.lastwrite + self.__min_write_delay__ <= time())) \
-                or force:
-            try:
-                fout = open(self.filename + '.new', 'w')
-            except IOError:
-                ioerr = sys.exc_info()[1]
-                self.logger.error("Failed to open %s for writing: %s" % (self.filename + '.new', ioerr))
-            else:
-                fout.write(lxml.etree.tostring(self.element,
-                                               xml_declaration=False).decode('UTF-8'))
-                fout.close()
-                os.rename(self.filename + '.new', self.filename)
-                self.dirty = 0
-                self.lastwrite = time()
+        self.lock.acquire()
+        try:
+            if (self.dirty and
+                (self.lastwrite + self.__min_write_delay__ <= time())) \
+                    or force:
+                try:
+                    fout = open(self.filename + '.new', 'w')
+                except IOError:
+                    ioerr = sys.exc_info()[1]
+                    self.logger.error("Failed to open %s for writing: %s" %
+                                      (self.filename + '.new', ioerr))
+                else:
+                    self.element.set('journal_seq', str(self.seq))
+                    fout.write(lxml.etree.tostring(self.element,
+                                                   xml_declaration=False).decode('UTF-8'))
+                    fout.close()
+                    os.rename(self.filename + '.new', self.filename)
+                    # everything in the journal is now in the
+                    # statistics file
+                    try:
+                        os.unlink(self.journal)
+                    except OSError:
+                        pass
+                    self.dirty = 0
+                    self.lastwrite = time()
+        finally:
+            self.lock.release()
 
     def ReadFromFile(self):
         """Reads current state regarding statistics."""
@@ -49,64 +79,142 @@ class StatisticsStore(object):
             fin.close()
             self.element = lxml.etree.XML(data)
             self.dirty = 0
+            try:
+                self.seq = int(self.element.get('journal_seq', 0))
+            except ValueError:
+                self.seq = 0
         except (IOError, lxml.etree.XMLSyntaxError):
             self.logger.error("Creating new statistics file %s"%(self.filename))
             self.element = lxml.etree.Element('ConfigStatistics')
             self.WriteBack()
             self.dirty = 0
+        self.nodes = dict()
+        for node in self.element.findall('Node'):
+            if node.get('name') in self.nodes:
+                self.logger.error("Duplicate node entry for %s" %
+                                  node.get('name'))
+            else:
+                self.nodes[node.get('name')] = node
+        self.ReadJournal()
+
+    def ReadJournal(self):
+        """Apply statistics from the journal that have not yet been
+        written to the statistics file."""
+        try:
+            data = open(self.journal).read()
+        except IOError:
+            return
+        # the last entry may be incomplete if the server died while
+        # writing it, so parse the journal leniently
+        parser = lxml.etree.XMLParser(recover=True)
+        try:
+            journal = lxml.etree.XML("<Journal>%s</Journal>" % data,
+                                     parser=parser)
+        except lxml.etree.XMLSyntaxError:
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to read statistics journal %s: %s" %
+                              (self.journal, err))
+            return
+        count = 0
+        checkpoint = self.seq
+        for entry in journal.findall('Node'):
+            newstat = entry.find('Statistics')
+            if newstat is None or not newstat.get('time'):
+                continue
+            try:
+                seq = int(entry.get('seq'))
+            except (TypeError, ValueError):
+                seq = None
+            if seq is not None:
+                if seq <= checkpoint:
+                    # already in the statistics file
+                    continue
+                self.seq = max(self.seq, seq)
+            self._add_stat(entry.get('name'), newstat)
+            count += 1
+        if count:
+            self.logger.info("Recovered %s statistics from %s" %
+                             (count, self.journal))
+            self.WriteBack(force=1)
 
     def updateStats(self, xml, client):
         """Updates the statistics of a current node with new data."""
+        newstat = copy.copy(xml.find('Statistics'))
+
+        # Set current time for stats
+        newstat.set('time', asctime(localtime()))
 
+        self.lock.acquire()
+        try:
+            self._add_stat(client, newstat)
+            # Set dirty
+            self.dirty = 1
+            self.AppendJournal(client, newstat)
+            self.WriteBack()
+        finally:
+            self.lock.release()
+
+    def AppendJournal(self, client, newstat):
+        """Append a single statistics entry to the journal."""
+        self.seq += 1
+        entry = lxml.etree.Element('Node', name=client, seq=str(self.seq))
+        entry.append(copy.copy(newstat))
+        try:
+            fout = open(self.journal, 'a')
+            fout.write(lxml.etree.tostring(entry,
+                                           xml_declaration=False).decode('UTF-8'))
+            fout.write("\n")
+            fout.close()
+        except IOError:
+            ioerr = sys.exc_info()[1]
+            self.logger.error("Failed to write to %s, writing statistics "
+                              "file instead: %s" % (self.journal, ioerr))
+            self.WriteBack(force=1)
+
+    def _add_stat(self, client, newstat):
+        """ add a Statistics element to the node for the given
+        client, pruning old statistics """
         # Current policy:
         # - Keep anything less than 24 hours old
         #   - Keep latest clean run for clean nodes
         #   - Keep latest clean and dirty run for dirty nodes
-        newstat = xml.find('Statistics')
-
         if newstat.get('state') == 'clean':
             node_dirty = 0
         else:
             node_dirty = 1
 
         # Find correct node entry in stats data
-        # The following list comprehension should be guarenteed to return at
-        # most one result
-        nodes = [elem for elem in self.element.findall('Node') \
-                 if elem.get('name') == client]
-        nummatch = len(nodes)
-        if nummatch == 0:
+        node = self.nodes.get(client)
+        if node is None:
             # Create an entry for this node
             node = lxml.etree.SubElement(self.element, 'Node', name=client)
-        elif nummatch == 1 and not node_dirty:
+            self.nodes[client] = node
+        elif not node_dirty:
             # Delete old instance
-            node = nodes[0]
             [node.remove(elem) for elem in node.findall('Statistics') \
              if self.isOlderThan24h(elem.get('time'))]
-        elif nummatch == 1 and node_dirty:
+        else:
             # Delete old dirty statistics entry
-            node = nodes[0]
             [node.remove(elem) for elem in node.findall('Statistics') \
              if (elem.get('state') == 'dirty' \
                  and self.isOlderThan24h(elem.get('time')))]
-        else:
-            # Shouldn't be reached
-            self.logger.error("Duplicate node entry for %s"%(client))
-
-        # Set current time for stats
-        newstat.set('time', asctime(localtime()))
 
         # Add statistic
-        node.append(copy.copy(newstat))
+        node.append(newstat)
 
-        # Set dirty
-        self.dirty = 1
-        self.WriteBack(force=1)
+    def parseTime(self, testTime):
+        """Get the time in seconds since the epoch from a <time>
+        string."""
+        rv = self.times.get(testTime)
+        if rv is None:
+            rv = mktime(strptime(testTime))
+            self.times[testTime] = rv
+        return rv
 
     def isOlderThan24h(self, testTime):
         """Helper function to determine if <time> string is older than 24 hours."""
         now = time()
-        utime = mktime(strptime(testTime))
+        utime = self.parseTime(testTime)
         secondsPerDay = 60*60*24
 
         return (now-utime) > secondsPerDay
@@ -126,12 +234,23 @@ class Statistics(Bcfg2.Server.Plugin.ThreadedStatistics,
     def handle_statistic(self, metadata, data):
         self.data_file.updateStats(data, metadata.hostname)
 
+    def handle_idle(self):
+        # write out statistics that were only journaled, once the
+        # minimum write delay has passed
+        self.data_file.WriteBack()
+
+    def shutdown(self):
+        Bcfg2.Server.Plugin.ThreadedStatistics.shutdown(self)
+        if self.data_file.dirty:
+            self.data_file.WriteBack(force=1)
+
     def FindCurrent(self, client):
-        rt = self.data_file.element.xpath('//Node[@name="%s"]' % client)[0]
-        maxtime = max([strptime(stat.get('time')) for stat \
-                       in rt.findall('Statistics')])
-        return [stat for stat in rt.findall('Statistics') \
-                if strptime(stat.get('time')) == maxtime][0]
+        rt = self.data_file.nodes[client]
+        stats = rt.findall('Statistics')
+        maxtime = max([self.data_file.parseTime(stat.get('time'))
+                       for stat in stats])
+        return [stat for stat in stats
+                if self.data_file.parseTime(stat.get('time')) == maxtime][0]
 
     def GetExtra(self, client):
         return [(entry.tag, entry.get('name')) for entry \
@@ -13,9 +13,11 @@ class Svn(Bcfg2.Server.Plugin.Plugin,
     """Svn is a version plugin for dealing with Bcfg2 repos."""
     name = 'Svn'
     __author__ = 'bcfg-dev@mcs.anl.gov'
+    __vcs_metadata__ = ['.svn']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        Bcfg2.Server.Plugin.Version.__init__(self)
         self.core = core
         self.datastore = datastore
 
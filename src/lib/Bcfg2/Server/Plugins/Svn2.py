@@ -13,10 +13,12 @@ class Svn2(Bcfg2.Server.Plugin.Plugin,
 
     conflicts = ['Svn']
     experimental = True
+    __vcs_metadata__ = ['.svn']
     __rmi__ = Bcfg2.Server.Plugin.Plugin.__rmi__ + ['Update','Commit']
 
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
+        Bcfg2.Server.Plugin.Version.__init__(self)
 
         if missing:
             self.logger.error("Svn2: Missing PySvn")
@@ -24,8 +24,7 @@ class TemplateFile:
         self.name = name
         self.specific = specific
         self.encoding = encoding
-        self.template = None
-        self.searchlist = dict()
+        self.template_cls = None
 
     def handle_event(self, event):
         """Handle all fs events for this template."""
@@ -33,9 +32,9 @@ class TemplateFile:
             return
         try:
             s = {'useStackFrames': False}
-            self.template = Cheetah.Template.Template(open(self.name).read(),
-                                                      compilerSettings=s,
-                                                      searchList=self.searchlist)
+            self.template_cls = \
+                Cheetah.Template.Template.compile(open(self.name).read(),
+                                                  compilerSettings=s)
         except Cheetah.Parser.ParseError:
             perror = sys.exc_info()[1]
             logger.error("Cheetah parse error for file %s" % (self.name))
@@ -43,29 +42,32 @@ class TemplateFile:
 
     def bind_entry(self, entry, metadata):
         """Build literal file information."""
-        self.template.metadata = metadata
-        self.searchlist['metadata'] = metadata
-        self.template.path = entry.get('realname', entry.get('name'))
-        self.searchlist['path'] = entry.get('realname', entry.get('name'))
-        self.template.source_path = self.name
-        self.searchlist['source_path'] = self.name
+        searchlist = dict(metadata=metadata,
+                          path=entry.get('realname', entry.get('name')),
+                          source_path=self.name)
+        # each bind gets its own instance of the compiled template
+        # class, so the template is only compiled when it changes
+        template = self.template_cls(searchList=[searchlist])
+        template.metadata = metadata
+        template.path = searchlist['path']
+        template.source_path = self.name
 
         if entry.tag == 'Path':
             entry.set('type', 'file')
         try:
-            if type(self.template) == unicode:
-                entry.text = self.template
+            if type(template) == unicode:
+                entry.text = template
             else:
                 if entry.get('encoding') == 'base64':
                     # take care of case where file needs base64 encoding
-                    entry.text = b64encode(self.template)
+                    entry.text = b64encode(template)
                 else:
-                    entry.text = unicode(str(self.template), self.encoding)
+                    entry.text = unicode(str(template), self.encoding)
         except:
             (a, b, c) = sys.exc_info()
             msg = traceback.format_exception(a, b, c, limit=2)[-1][:-1]
             logger.error(msg)
-            logger.error("TCheetah template error for %s" % self.searchlist['path'])
+            logger.error("TCheetah template error for %s" % searchlist['path'])
             del a, b, c
             raise Bcfg2.Server.Plugin.PluginExecutionError
 
@@ -1,3 +1,4 @@
+import os
 import re
 import imp
 import sys
@@ -5,6 +6,7 @@ import glob
 import logging
 import Bcfg2.Server.Lint
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Dependencies
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +58,25 @@ class HelperSet(Bcfg2.Server.Plugin.DirectoryBacked):
     __child__ = HelperModule
 
 
+class HelperDict(dict):
+    """ dict of module name -> HelperModule that records the modules
+    that are used as dependencies of the configuration being built """
+    def __init__(self, data, helpers):
+        dict.__init__(self, helpers)
+        self.data = data
+
+    def __getitem__(self, key):
+        Bcfg2.Server.Dependencies.record_path(os.path.join(self.data,
+                                                           "%s.py" % key))
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
 class TemplateHelper(Bcfg2.Server.Plugin.Plugin,
                      Bcfg2.Server.Plugin.Connector):
     """ A plugin to provide helper classes and functions to templates """
@@ -67,9 +88,15 @@ class TemplateHelper(Bcfg2.Server.Plugin.Plugin,
         Bcfg2.Server.Plugin.Connector.__init__(self)
         self.helpers = HelperSet(self.data, core.fam)
 
+    def get_affected_entries(self, path, entries):
+        # clients whose templates use a helper, or tried to use it
+        # before it existed, have recorded its path
+        return []
+
     def get_additional_data(self, _):
-        return dict([(h._module_name, h)
-                     for h in self.helpers.entries.values()])
+        return HelperDict(self.data,
+                          [(h._module_name, h)
+                           for h in self.helpers.entries.values()])
 
 
 class TemplateHelperLint(Bcfg2.Server.Lint.ServerlessPlugin):
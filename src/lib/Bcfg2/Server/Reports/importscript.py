@@ -33,9 +33,16 @@ import logging
 import Bcfg2.Logger
 import platform
 
+from Bcfg2.Cache import LRUCache
+
 # Compatibility import
 from Bcfg2.Compat import ConfigParser, b64decode
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 
 def build_reason_kwargs(r_ent, encoding, logger):
     binary_file = False
@@ -86,6 +93,63 @@ def build_reason_kwargs(r_ent, encoding, logger):
                 is_sensitive=sensitive_file,
                 unpruned=unpruned_entries)
 
+#: the number of ids to look up in a single query
+QUERY_CHUNK = 500
+
+#: the number of interactions to import in a single transaction
+STATS_BATCH = 100
+
+# caches of database ids that are kept across interactions.  rows can
+# be deleted by "bcfg2-admin reports purge", so cached ids are
+# verified (in bulk) before each interaction uses them.
+_entry_ids = dict()            # (kind, name) -> Entries id
+_reason_ids = LRUCache(16384)  # digest of reason kwargs -> Reason id
+_group_ids = dict()            # name -> Group id
+_bundle_ids = dict()           # name -> Bundle id
+
+
+def clear_caches():
+    """ forget all cached database ids """
+    _entry_ids.clear()
+    _reason_ids.clear()
+    _group_ids.clear()
+    _bundle_ids.clear()
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), QUERY_CHUNK):
+        yield items[i:i + QUERY_CHUNK]
+
+
+def _existing_ids(model, ids):
+    """ get the subset of the given ids that still exist in the
+    table for the given model """
+    rv = set()
+    for chunk in _chunks(set(ids)):
+        rv.update(model.objects.filter(id__in=chunk).values_list('id',
+                                                                 flat=True))
+    return rv
+
+
+def _verify_cache(model, cache, keys):
+    """ drop cached ids for the given keys that no longer exist """
+    cached = dict()
+    for key in keys:
+        cid = cache.get(key)
+        if cid is not None:
+            cached[key] = cid
+    if cached:
+        existing = _existing_ids(model, cached.values())
+        for key, cid in cached.items():
+            if cid not in existing:
+                del cache[key]
+
+
+def _reason_digest(kargs):
+    return md5(repr(sorted(kargs.items())).encode('UTF-8')).hexdigest()
+
+
 def _fetch_reason(elem, kargs, logger):
     try:
         rr = None
@@ -104,18 +168,125 @@ def _fetch_reason(elem, kargs, logger):
     return rr
 
 
+def _fetch_reasons(elems, encoding, logger):
+    """ get a list of Reason ids for the given elements.  identical
+    reasons are only looked up once. """
+    kwargs = [build_reason_kwargs(x, encoding, logger) for x in elems]
+    digests = [_reason_digest(k) for k in kwargs]
+    _verify_cache(Reason, _reason_ids, set(digests))
+    rv = []
+    for elem, kargs, digest in zip(elems, kwargs, digests):
+        rid = _reason_ids.get(digest)
+        if rid is None:
+            rid = _fetch_reason(elem, kargs, logger).id
+            _reason_ids[digest] = rid
+        rv.append(rid)
+    return rv
+
+
+def _fetch_entries(keys):
+    """ get a dict of (kind, name) -> Entries id for the given keys,
+    creating entries that don't exist """
+    keys = set(keys)
+    _verify_cache(Entries, _entry_ids, keys)
+    missing = [k for k in keys if k not in _entry_ids]
+    for chunk in _chunks(set([k[1] for k in missing])):
+        for eid, kind, name in \
+                Entries.objects.filter(name__in=chunk).values_list('id',
+                                                                   'kind',
+                                                                   'name'):
+            _entry_ids[(kind, name)] = eid
+    for key in missing:
+        if key not in _entry_ids:
+            entry = Entries.objects.get_or_create(kind=key[0],
+                                                  name=key[1])[0]
+            _entry_ids[key] = entry.id
+    return dict([(k, _entry_ids[k]) for k in keys])
+
+
+def _fetch_named(model, cache, names, logger):
+    """ get a list of ids of objects (Groups or Bundles) with the
+    given names, creating them if necessary """
+    _verify_cache(model, cache, names)
+    rv = []
+    for name in names:
+        if name not in cache:
+            obj, created = model.objects.get_or_create(name=name)
+            if created:
+                logger.debug("Added %s %s" % (model.__name__.lower(), name))
+            cache[name] = obj.id
+        rv.append(cache[name])
+    return rv
+
+
 def load_stats(sdata, encoding, vlevel, logger, quick=False, location=''):
+    stats = []
     for node in sdata.findall('Node'):
         name = node.get('name')
         for statistics in node.findall('Statistics'):
-            try:
-                load_stat(name, statistics, encoding, vlevel, logger, quick, location)
-            except:
-                logger.error("Failed to create interaction for %s: %s" %
-                    (name, traceback.format_exc().splitlines()[-1]))
+            stats.append((name, statistics))
+    for i in range(0, len(stats), STATS_BATCH):
+        load_stat_batch(stats[i:i + STATS_BATCH], encoding, vlevel, logger,
+                        quick, location)
+
+
+def load_stat_batch(stats, encoding, vlevel, logger, quick, location,
+                    fallback=None):
+    """ import a list of (client, <Statistics> element) tuples in a
+    single transaction.  if that fails, each interaction is imported
+    individually by calling ``fallback(client, statistics)``, so that
+    a single bad interaction doesn't lose the rest.  by default,
+    :func:`load_stat` is used, and failures are logged. """
+    try:
+        _load_stat_batch(stats, encoding, vlevel, logger, quick, location)
+        return
+    except:
+        logger.debug("Failed to import %s interactions at once, importing "
+                     "them individually: %s" %
+                     (len(stats), traceback.format_exc().splitlines()[-1]))
+        # the transaction was rolled back, so ids cached during it
+        # may not exist
+        clear_caches()
+    for (cobj, statistics) in stats:
+        if fallback is not None:
+            fallback(cobj, statistics)
+            continue
+        try:
+            load_stat(cobj, statistics, encoding, vlevel, logger, quick,
+                      location)
+        except:
+            if isinstance(cobj, ClientMetadata):
+                name = cobj.hostname
+            else:
+                name = cobj
+            logger.error("Failed to create interaction for %s: %s" %
+                (name, traceback.format_exc().splitlines()[-1]))
+
 
 @transaction.commit_on_success
+def _load_stat_batch(stats, encoding, vlevel, logger, quick, location):
+    for (cobj, statistics) in stats:
+        _load_stat(cobj, statistics, encoding, vlevel, logger, quick,
+                   location)
+
+
 def load_stat(cobj, statistics, encoding, vlevel, logger, quick, location):
+    try:
+        _load_stat_transaction(cobj, statistics, encoding, vlevel, logger,
+                               quick, location)
+    except:
+        # the transaction was rolled back, so ids cached during it
+        # may not exist
+        clear_caches()
+        raise
+
+
+@transaction.commit_on_success
+def _load_stat_transaction(*args):
+    _load_stat(*args)
+
+
+def _load_stat(cobj, statistics, encoding, vlevel, logger, quick, location):
     if isinstance(cobj, ClientMetadata):
         client_name = cobj.hostname
     else:
@@ -154,70 +325,61 @@ def load_stat(cobj, statistics, encoding, vlevel, logger, quick, location):
     if isinstance(cobj, ClientMetadata):
         try:
             imeta = InteractionMetadata(interaction=current_interaction)
-            profile, created = Group.objects.get_or_create(name=cobj.profile)
-            imeta.profile = profile
+            imeta.profile_id = _fetch_named(Group, _group_ids,
+                                            [cobj.profile], logger)[0]
             imeta.save() # save here for m2m
 
-            #FIXME - this should be more efficient
-            group_set = []
-            for group_name in cobj.groups:
-                group, created = Group.objects.get_or_create(name=group_name)
-                if created:
-                    logger.debug("Added group %s" % group)
-                imeta.groups.add(group)
-            for bundle_name in cobj.bundles:
-                bundle, created = Bundle.objects.get_or_create(name=bundle_name)
-                if created:
-                    logger.debug("Added bundle %s" % bundle)
-                imeta.bundles.add(bundle)
-            imeta.save()
+            groups = _fetch_named(Group, _group_ids, cobj.groups, logger)
+            if groups:
+                imeta.groups.add(*groups)
+            bundles = _fetch_named(Bundle, _bundle_ids, cobj.bundles, logger)
+            if bundles:
+                imeta.bundles.add(*bundles)
         except:
             logger.error("Failed to save interaction metadata for %s: %s" %
                 (client_name, traceback.format_exc().splitlines()[-1]))
 
-
-    entries_cache = {}
-    [entries_cache.__setitem__((e.kind, e.name), e) \
-        for e in Entries.objects.all()]
     counter_fields = {TYPE_BAD: 0,
                       TYPE_MODIFIED: 0,
                       TYPE_EXTRA: 0}
     pattern = [('Bad/*', TYPE_BAD),
                ('Extra/*', TYPE_EXTRA),
                ('Modified/*', TYPE_MODIFIED)]
+    # (element, type) for each entry; the reason for each bad,
+    # modified, and extra entry is looked up, but all good entries
+    # share the reason of the first one
+    elems = []
     for (xpath, type) in pattern:
         for x in statistics.findall(xpath):
             counter_fields[type] = counter_fields[type] + 1
-            rr = _fetch_reason(x, build_reason_kwargs(x, encoding, logger), logger)
-
-            try:
-                entry = entries_cache[(x.tag, x.get('name'))]
-            except KeyError:
-                entry, created = Entries.objects.get_or_create(\
-                    name=x.get('name'), kind=x.tag)
-
-            Entries_interactions(entry=entry, reason=rr,
-                                 interaction=current_interaction,
-                                 type=type).save()
-            if vlevel > 0:
-                logger.info("%s interaction created with reason id %s and entry %s" % (xpath, rr.id, entry.id))
-
-    # add good entries
-    good_reason = None
-    for x in statistics.findall('Good/*'):
-        if good_reason == None:
-            # Do this once.  Really need to fix Reasons...
-            good_reason = _fetch_reason(x, build_reason_kwargs(x, encoding, logger), logger)
-        try:
-            entry = entries_cache[(x.tag, x.get('name'))]
-        except KeyError:
-            entry, created = Entries.objects.get_or_create(\
-                name=x.get('name'), kind=x.tag)
-        Entries_interactions(entry=entry, reason=good_reason,
-                             interaction=current_interaction,
-                             type=TYPE_GOOD).save()
+            elems.append((x, type))
+    good = [(x, TYPE_GOOD) for x in statistics.findall('Good/*')]
+
+    reasons = _fetch_reasons([x for x, type in elems], encoding, logger)
+    if good:
+        good_reason = _fetch_reasons([good[0][0]], encoding, logger)[0]
+        reasons.extend([good_reason] * len(good))
+    elems.extend(good)
+    entries = _fetch_entries([(x.tag, x.get('name')) for x, type in elems])
+
+    ents = []
+    for (x, type), reason in zip(elems, reasons):
+        ents.append(Entries_interactions(entry_id=entries[(x.tag,
+                                                           x.get('name'))],
+                                         reason_id=reason,
+                                         interaction=current_interaction,
+                                         type=type))
         if vlevel > 0:
-            logger.info("%s interaction created with reason id %s and entry %s" % (xpath, good_reason.id, entry.id))
+            logger.info("%s interaction created with reason id %s and entry "
+                        "%s" % (dict(TYPE_CHOICES)[type], reason,
+                                entries[(x.tag, x.get('name'))]))
+    if hasattr(Entries_interactions.objects, 'bulk_create'):
+        for chunk in _chunks(ents):
+            Entries_interactions.objects.bulk_create(chunk)
+    else:
+        # bulk_create() is new in django 1.4
+        for ent in ents:
+            ent.save()
 
     # Update interaction counters
     current_interaction.bad_entries = counter_fields[TYPE_BAD]
@@ -2,8 +2,8 @@
 
 import lxml.etree
 
-__all__ = ["Admin", "Core", "FileMonitor", "Plugin", "Plugins",
-           "Hostbase", "Reports", "Snapshots", "XMLParser",
+__all__ = ["Admin", "Core", "Dependencies", "FileMonitor", "Plugin",
+           "Plugins", "Hostbase", "Reports", "Snapshots", "XMLParser",
            "XI", "XI_NAMESPACE"]
 
 XMLParser = lxml.etree.XMLParser(remove_blank_text=True)
@@ -0,0 +1,207 @@
+""" Per-request traces of the time spent in each step of handling a
+request """
+
+import sys
+import time
+import logging
+import threading
+from collections import deque
+
+try:
+    import json
+    has_json = True
+except ImportError:
+    try:
+        import simplejson as json
+        has_json = True
+    except ImportError:
+        has_json = False
+
+logger = logging.getLogger(__name__)
+
+
+class Span(object):
+    """ a single timed step of handling a request, and the steps it
+    is made up of """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+        self.children = []
+
+    def to_dict(self, origin, depth=None):
+        """ get a dict describing the span that can be marshalled
+        over XML-RPC or to JSON.  the start time is given relative to
+        origin.  only depth levels of child spans are included, or
+        all of them if depth is None. """
+        end = self.end
+        if end is None:
+            end = time.time()
+        rv = dict(name=self.name,
+                  attrs=self.attrs,
+                  start=self.start - origin,
+                  duration=end - self.start,
+                  children=[])
+        if depth is None or depth > 0:
+            if depth is not None:
+                depth -= 1
+            rv['children'] = [c.to_dict(origin, depth)
+                              for c in self.children]
+        return rv
+
+
+class Tracer(object):
+    """ Records a trace of the spans of each request handled by the
+    server.  The most recent traces are kept in a ring buffer of the
+    given size.  Traces of requests that take at least threshold
+    seconds keep all of their spans; other traces only keep the steps
+    of the request itself, not the spans within them.  If a log file
+    is given, each trace is also appended to it as a line of JSON. """
+
+    def __init__(self, size=100, threshold=None, logfile=None):
+        self.size = size
+        self.threshold = threshold
+        self.logfile = None
+        if logfile:
+            if has_json:
+                try:
+                    self.logfile = open(logfile, 'a')
+                except IOError:
+                    logger.error("Failed to open trace file %s: %s" %
+                                 (logfile, sys.exc_info()[1]))
+            else:
+                logger.error("No JSON module available, not writing traces "
+                             "to %s" % logfile)
+        self.traces = deque()
+        self.lock = threading.Lock()
+        self.last_id = 0
+        # the stack of spans that are in progress in each thread
+        self._current = threading.local()
+
+    def start_span(self, name, root=False, **attrs):
+        """ start a span of the trace of the current request.  If no
+        trace is in progress in this thread, a new one is started if
+        root is True; otherwise nothing is traced.  The span returned
+        must be passed to end_span(), even if it is None. """
+        if not self.size:
+            return None
+        stack = getattr(self._current, "stack", None)
+        if not stack:
+            if not root:
+                return None
+            stack = []
+            self._current.stack = stack
+        span = Span(name, dict([(k, "%s" % v) for k, v in attrs.items()]))
+        if stack:
+            stack[-1].children.append(span)
+        stack.append(span)
+        return span
+
+    def annotate(self, span, **attrs):
+        """ add attributes to a span started with start_span() """
+        if span is None:
+            return
+        for key, val in attrs.items():
+            span.attrs[key] = "%s" % val
+
+    def annotate_request(self, **attrs):
+        """ add attributes to the first span of the trace in progress
+        in this thread, if any """
+        stack = getattr(self._current, "stack", None)
+        if stack:
+            self.annotate(stack[0], **attrs)
+
+    def end_span(self, span, **attrs):
+        """ end a span started with start_span().  Any attributes
+        given are added to the span.  Ending the first span of a
+        trace records the trace. """
+        if span is None:
+            return
+        span.end = time.time()
+        self.annotate(span, **attrs)
+        stack = self._current.stack
+        while stack:
+            # spans below this one that weren't ended are ended too
+            top = stack.pop()
+            if top is span:
+                break
+            top.end = span.end
+        if not stack:
+            self._record(span)
+
+    def _record(self, root):
+        """ add the trace of a finished request to the ring buffer and
+        log file """
+        duration = root.end - root.start
+        slow = self.threshold is not None and duration >= self.threshold
+        if slow:
+            depth = None
+        else:
+            depth = 1
+        trace = dict(name=root.name,
+                     client=root.attrs.get("client", ""),
+                     start=root.start,
+                     duration=duration,
+                     slow=slow,
+                     spans=root.to_dict(root.start, depth=depth))
+        self.lock.acquire()
+        try:
+            self.last_id += 1
+            trace['id'] = self.last_id
+            self.traces.append(trace)
+            while len(self.traces) > self.size:
+                self.traces.popleft()
+            if self.logfile is not None:
+                try:
+                    self.logfile.write(json.dumps(trace) + "\n")
+                    self.logfile.flush()
+                except IOError:
+                    logger.error("Failed to write trace: %s" %
+                                 sys.exc_info()[1])
+        finally:
+            self.lock.release()
+        if slow:
+            logger.info("Slow request: %s for %s took %.03fs (trace %d)" %
+                        (trace['name'], trace['client'], duration,
+                         trace['id']))
+
+    def get_traces(self, client=None, slow=False):
+        """ get summaries of the traces in the ring buffer, oldest
+        first, optionally limited to those for the given client or to
+        slow requests.  Each summary includes the time taken by each
+        step of the request, but not the spans within them. """
+        self.lock.acquire()
+        try:
+            traces = list(self.traces)
+        finally:
+            self.lock.release()
+        rv = []
+        for trace in traces:
+            if client and trace['client'] != client:
+                continue
+            if slow and not trace['slow']:
+                continue
+            summary = dict([(k, v) for k, v in trace.items() if k != 'spans'])
+            summary['steps'] = [(s['name'], s['duration'])
+                                for s in trace['spans']['children']]
+            rv.append(summary)
+        return rv
+
+    def get_trace(self, trace_id):
+        """ get a trace in the ring buffer by ID, or None """
+        self.lock.acquire()
+        try:
+            for trace in self.traces:
+                if trace['id'] == trace_id:
+                    return trace
+        finally:
+            self.lock.release()
+        return None
+
+    def close(self):
+        """ close the trace log file """
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
@@ -0,0 +1,80 @@
+import os
+import sys
+from Bcfg2.Cache import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestLRUCache(Bcfg2TestCase):
+    def test_get_set(self):
+        cache = LRUCache(3)
+        self.assertNotIn("foo", cache)
+        self.assertIsNone(cache.get("foo"))
+        self.assertEqual(cache.get("foo", "bar"), "bar")
+        self.assertRaises(KeyError, cache.__getitem__, "foo")
+
+        cache["foo"] = 1
+        self.assertIn("foo", cache)
+        self.assertEqual(cache["foo"], 1)
+        self.assertEqual(cache.get("foo"), 1)
+        self.assertEqual(len(cache), 1)
+
+        cache["foo"] = 2
+        self.assertEqual(cache["foo"], 2)
+        self.assertEqual(len(cache), 1)
+
+        del cache["foo"]
+        self.assertNotIn("foo", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["c"] = 3
+        # using "a" makes "b" the least recently used item
+        cache.get("a")
+        cache["d"] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn("b", cache)
+        for key in ["a", "c", "d"]:
+            self.assertIn(key, cache)
+
+        # replacing an item doesn't evict anything
+        cache["c"] = 5
+        self.assertEqual(len(cache), 3)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_order(self):
+        cache = LRUCache(100)
+        for i in range(200):
+            cache[i] = i
+        self.assertEqual(cache.keys(), list(range(100, 200)))
+        cache.get(150)
+        cache[120] = "foo"
+        del cache[100]
+        self.assertEqual(cache.keys(),
+                         [i for i in range(101, 200) if i not in [120, 150]] +
+                         [150, 120])
+        cache[200] = 200
+        cache[201] = 201
+        self.assertEqual(len(cache), 100)
+        self.assertNotIn(101, cache)
+        self.assertEqual(cache[120], "foo")
+
+        cache = LRUCache(0)
+        cache["foo"] = 1
+        self.assertEqual(len(cache), 0)
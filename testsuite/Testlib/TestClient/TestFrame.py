@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Client.Frame import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+def get_tool(name, entries, inventory):
+    tool = Mock()
+    tool.name = name
+    tool.handled = entries
+    tool.Inventory.side_effect = inventory
+    return tool
+
+
+class TestFrame(Bcfg2TestCase):
+    def get_obj(self, config, tools, threads=1):
+        frame = Frame(config, dict(inventory_threads=threads), dict(), [],
+                      False)
+        frame.tools = tools
+        return frame
+
+    def get_config(self):
+        config = lxml.etree.Element("Configuration")
+        bundle = lxml.etree.SubElement(config, "Bundle", name="test")
+        foo = [lxml.etree.SubElement(bundle, "Path", name="/foo%d" % i,
+                                     type="file")
+               for i in range(3)]
+        bar = [lxml.etree.SubElement(bundle, "Service", name="bar%d" % i)
+               for i in range(3)]
+        return config, foo, bar
+
+    def test_Inventory_parallel(self):
+        config, foo, bar = self.get_config()
+        started = dict(foo=threading.Event(), bar=threading.Event())
+        concurrent = []
+
+        def inventory(name, other, entries):
+            def inner(states):
+                started[name].set()
+                # each tool only returns once the other has started,
+                # so this only succeeds if they run at the same time
+                started[other].wait(5)
+                concurrent.append(started[other].isSet())
+                for entry in entries:
+                    states[entry] = True
+            return inner
+
+        tools = [get_tool("foo", foo, inventory("foo", "bar", foo)),
+                 get_tool("bar", bar, inventory("bar", "foo", bar))]
+        frame = self.get_obj(config, tools, threads=2)
+        frame.Inventory()
+        self.assertEqual(concurrent, [True, True])
+        for entry in foo + bar:
+            self.assertTrue(frame.states[entry])
+        for tool in ["foo", "bar"]:
+            # the time each inventory took, not when it finished
+            self.assertTrue(frame.inventory_times[tool] < 5)
+            # durations aren't mixed in with the timestamps
+            self.assertNotIn('%s_inventory' % tool, frame.times)
+
+    def test_Inventory_failure(self):
+        config, foo, bar = self.get_config()
+
+        def good(states):
+            for entry in foo:
+                states[entry] = True
+
+        def bad(states):
+            states[bar[0]] = True
+            raise OSError
+
+        for threads in [1, 4]:
+            tools = [get_tool("foo", foo, good), get_tool("bar", bar, bad)]
+            frame = self.get_obj(config, tools, threads=threads)
+            frame.logger = Mock()
+            frame.Inventory()
+            self.assertTrue(frame.logger.error.called)
+            self.assertIn("bar.Inventory()",
+                          frame.logger.error.call_args[0][0])
+            for entry in foo:
+                self.assertTrue(frame.states[entry])
+            # the failing tool's entries are bad
+            for entry in bar[1:]:
+                self.assertFalse(frame.states[entry])
+            self.assertIn("bar", frame.inventory_times)
+
+    def test_FetchContent(self):
+        config, foo, bar = self.get_config()
+        for entry in foo:
+            entry.set("sha256", "digest")
+            entry.set("deferred", "true")
+        tool = get_tool("foo", foo, None)
+        tool.VerifyPath.side_effect = lambda e, m: e.text == "good"
+        frame = self.get_obj(config, [tool])
+        frame.entry_tools = dict([(e, [tool]) for e in foo + bar])
+        frame.logger = Mock()
+        frame.states = dict([(e, False) for e in foo + bar])
+        frame.states[foo[0]] = True
+
+        # the content isn't fetched if there's no way to fetch it
+        frame.FetchContent()
+        self.assertFalse(tool.VerifyPath.called)
+
+        content = lxml.etree.Element("Content")
+        lxml.etree.SubElement(content, "Path", name="/foo1").text = "good"
+        lxml.etree.SubElement(content, "Path", name="/foo2",
+                              encoding="base64").text = "YmFk"
+        frame.fetch_content = Mock()
+        frame.fetch_content.return_value = content
+        frame.FetchContent()
+        # only the content of entries that failed verification is
+        # fetched
+        frame.fetch_content.assert_called_with(["/foo1", "/foo2"])
+        self.assertTrue(frame.states[foo[1]])
+        self.assertFalse(frame.states[foo[2]])
+        self.assertEqual(foo[2].get("encoding"), "base64")
+        self.assertEqual(foo[2].text, "YmFk")
+        for entry in foo[1:]:
+            self.assertEqual(entry.get("deferred"), None)
+        self.assertEqual(foo[0].get("deferred"), "true")
+        tool.buildModlist.assert_called_once_with()
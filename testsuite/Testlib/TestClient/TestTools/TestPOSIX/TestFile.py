@@ -2,9 +2,12 @@
 import os
 import sys
 import copy
+import shutil
+import tempfile
 import difflib
 import binascii
 import lxml.etree
+from hashlib import sha256
 from Bcfg2.Compat import b64encode, b64decode, u_str
 from mock import Mock, MagicMock, patch
 from Bcfg2.Client.Tools.POSIX.File import *
@@ -24,11 +27,53 @@ from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
     skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
     patchIf, datastore
 
+def digest(data):
+    if inPy3k:
+        data = data.encode("UTF-8")
+    return sha256(data).hexdigest()
+
 def get_file_object(posix=None):
     if posix is None:
         posix = get_posix_object()
     return POSIXFile(posix.logger, posix.setup, posix.config)
 
+class TestDigestCache(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "digests")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save(self):
+        logger = Mock()
+        cache = DigestCache(self.path, logger)
+        ondisk = os.stat(self.tmpdir)
+        self.assertIsNone(cache.get(self.tmpdir, ondisk))
+        cache.set(self.tmpdir, ondisk, "digest")
+        cache.save()
+        self.assertFalse(cache.dirty)
+        self.assertEqual(os.listdir(self.tmpdir), ["digests"])
+
+        cache = DigestCache(self.path, logger)
+        self.assertEqual(cache.get(self.tmpdir, ondisk), "digest")
+        self.assertFalse(logger.warning.called)
+
+        # a cache that can't be written doesn't leave a temp file
+        # behind, and stays dirty
+        cache.set("/foo", ondisk, "digest")
+
+        @patch("os.rename")
+        def inner(mock_rename):
+            mock_rename.side_effect = OSError
+            cache.save()
+
+        inner()
+        self.assertTrue(logger.warning.called)
+        self.assertTrue(cache.dirty)
+        self.assertEqual(os.listdir(self.tmpdir), ["digests"])
+
+
 class TestPOSIXFile(TestPOSIXTool):
     test_obj = POSIXFile
 
@@ -42,6 +87,13 @@ class TestPOSIXFile(TestPOSIXTool):
         entry.set("empty", "false")
         entry.text = "text"
         self.assertTrue(self.ptool.fully_specified(entry))
+
+        entry = lxml.etree.Element("Path", name="/test", type="file",
+                                   deferred="true")
+        self.assertFalse(self.ptool.fully_specified(entry))
+
+        entry.set("sha256", digest("text"))
+        self.assertTrue(self.ptool.fully_specified(entry))
     
     def test_is_string(self):
         for char in list(range(8)) + list(range(14, 32)):
@@ -84,14 +136,43 @@ class TestPOSIXFile(TestPOSIXTool):
         self.assertEqual(ptool._get_data(entry), (ustr, False))
 
     @patch("%s.open" % builtins)
+    def test_file_digest(self, mock_open):
+        entry = lxml.etree.Element("Path", name="/test", type="file")
+        ptool = self.get_obj()
+        ondisk = MagicMock()
+
+        mock_open.return_value.read.side_effect = ["te", "st", ""]
+        self.assertEqual(ptool._file_digest(entry, ondisk),
+                         digest("test"))
+        mock_open.assert_called_with(entry.get("name"), 'rb')
+        self.assertTrue(mock_open.return_value.close.called)
+
+        # test the digest cache
+        mock_open.reset_mock()
+        ptool.digest_cache = Mock()
+        ptool.digest_cache.get.return_value = "cached"
+        self.assertEqual(ptool._file_digest(entry, ondisk), "cached")
+        ptool.digest_cache.get.assert_called_with(entry.get("name"), ondisk)
+        self.assertFalse(mock_open.called)
+
+        ptool.digest_cache.get.return_value = None
+        mock_open.return_value.read.side_effect = ["test", ""]
+        self.assertEqual(ptool._file_digest(entry, ondisk),
+                         digest("test"))
+        ptool.digest_cache.set.assert_called_with(entry.get("name"), ondisk,
+                                                  digest("test"))
+
     @patch("Bcfg2.Client.Tools.POSIX.base.POSIXTool.verify")
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._exists" % test_obj.__name__)
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_data" % test_obj.__name__)
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_diffs" % test_obj.__name__)
-    def test_verify(self, mock_get_diffs, mock_get_data, mock_exists,
-                    mock_verify, mock_open):
+    @patch("Bcfg2.Client.Tools.POSIX.File.%s._file_digest" %
+           test_obj.__name__)
+    def test_verify(self, mock_file_digest, mock_get_diffs, mock_get_data,
+                    mock_exists, mock_verify):
         entry = lxml.etree.Element("Path", name="/test", type="file")
-        setup = dict(interactive=False, ppath='/', max_copies=5)
+        setup = dict(interactive=False, ppath='/', max_copies=5,
+                     encoding="ascii")
         ptool = self.get_obj(posix=get_posix_object(setup=setup))
 
         def reset():
@@ -99,7 +180,7 @@ class TestPOSIXFile(TestPOSIXTool):
             mock_get_data.reset_mock()
             mock_exists.reset_mock()
             mock_verify.reset_mock()
-            mock_open.reset_mock()
+            mock_file_digest.reset_mock()
 
         mock_get_data.return_value = ("test", False)
         mock_exists.return_value = False
@@ -120,41 +201,97 @@ class TestPOSIXFile(TestPOSIXTool):
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
+        self.assertFalse(mock_file_digest.called)
         mock_get_diffs.assert_called_with(entry, interactive=False,
                                           sensitive=False,
                                           is_binary=True,
                                           content=None)
-        
+
         reset()
         mock_get_data.return_value = ("test", False)
         exists_rv.__getitem__.return_value = 4
         entry.set("sensitive", "true")
-        mock_open.return_value.read.return_value = "tart"
+        mock_file_digest.return_value = digest("tart")
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
-        mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_called_with()
+        mock_file_digest.assert_called_with(entry, exists_rv)
         mock_get_diffs.assert_called_with(entry, interactive=False,
                                           sensitive=True,
                                           is_binary=False,
-                                          content="tart")
+                                          content=None)
 
         reset()
-        mock_open.return_value.read.return_value = "test"
+        mock_file_digest.return_value = digest("test")
         self.assertTrue(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
-        mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_called_with()
+        mock_file_digest.assert_called_with(entry, exists_rv)
         self.assertFalse(mock_get_diffs.called)
 
         reset()
-        mock_open.side_effect = IOError
+        mock_file_digest.side_effect = IOError
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
-        mock_open.assert_called_with(entry.get("name"))
-    
+        mock_file_digest.assert_called_with(entry, exists_rv)
+
+        # test digest supplied by the server
+        reset()
+        mock_file_digest.side_effect = None
+        mock_file_digest.return_value = digest("test")
+        entry.set("sha256", digest("test"))
+        self.assertTrue(ptool.verify(entry, []))
+        mock_file_digest.assert_called_with(entry, exists_rv)
+        self.assertFalse(mock_get_data.called)
+        self.assertFalse(mock_get_diffs.called)
+
+        reset()
+        entry.set("sha256", digest("tart"))
+        self.assertTrue(ptool.verify(entry, []))
+        mock_get_data.assert_called_with(entry)
+        self.assertFalse(mock_get_diffs.called)
+        # the file is only hashed once
+        self.assertEqual(mock_file_digest.call_count, 1)
+
+        # the server's digest of binary content is authoritative
+        reset()
+        entry.set("encoding", "base64")
+        self.assertFalse(ptool.verify(entry, []))
+        self.assertFalse(mock_get_data.called)
+        self.assertEqual(mock_file_digest.call_count, 1)
+        mock_get_diffs.assert_called_with(entry, interactive=False,
+                                          sensitive=True,
+                                          is_binary=True,
+                                          content=None)
+
+    @patch("Bcfg2.Client.Tools.POSIX.base.POSIXTool.verify")
+    @patch("Bcfg2.Client.Tools.POSIX.File.%s._exists" % test_obj.__name__)
+    @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_diffs" % test_obj.__name__)
+    @patch("%s.open" % builtins)
+    def test_verify_digest_mismatch(self, mock_open, mock_get_diffs,
+                                    mock_exists, mock_verify):
+        entry = lxml.etree.Element("Path", name="/test", type="file",
+                                   sha256=digest("tart"))
+        entry.text = "test"
+        setup = dict(interactive=False, ppath='/', max_copies=5,
+                     encoding="ascii")
+        ptool = self.get_obj(posix=get_posix_object(setup=setup))
+        exists_rv = MagicMock()
+        exists_rv.__getitem__.return_value = 4
+        mock_exists.return_value = exists_rv
+        mock_verify.return_value = True
+
+        # the file differs from the server's digest, but not from the
+        # entry content, and is only read once
+        mock_open.return_value.read.side_effect = ["test", ""]
+        self.assertTrue(ptool.verify(entry, []))
+        self.assertEqual(mock_open.call_count, 1)
+
+        mock_open.reset_mock()
+        mock_open.return_value.read.side_effect = ["toot", ""]
+        self.assertFalse(ptool.verify(entry, []))
+        self.assertEqual(mock_open.call_count, 1)
+
     @patch("os.fdopen")
     @patch("tempfile.mkstemp")
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_data" % test_obj.__name__)
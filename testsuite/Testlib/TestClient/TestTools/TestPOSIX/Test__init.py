@@ -122,6 +122,55 @@ class TestPOSIX(Bcfg2TestCase):
         mock_fully_spec.assert_called_with(entry)
         self.assertFalse(self.posix.logger.error.called)
 
+    @patch("Bcfg2.Client.Tools.Tool.Inventory")
+    def test_Inventory(self, mock_Inventory):
+        entries = [lxml.etree.Element("Path", name="/test%d" % i,
+                                      type="file")
+                   for i in range(10)]
+        config = get_config(entries)
+        states = dict()
+
+        # no batching configured
+        setup = dict(ppath='/', max_copies=5, inventory_threads=4)
+        posix = get_posix_object(config=config, setup=setup)
+        posix.Inventory(states)
+        mock_Inventory.assert_called_with(posix, states, [])
+
+        # batched inventory
+        mock_Inventory.reset_mock()
+        setup['posix_inventory_batch'] = 3
+        posix = get_posix_object(config=config, setup=setup)
+        posix.canVerify = Mock()
+        posix.canVerify.return_value = True
+        posix.VerifyPath = Mock()
+        posix.VerifyPath.side_effect = \
+            lambda e, m: e.get("name") != "/test4"
+        posix.Inventory(states)
+        self.assertFalse(mock_Inventory.called)
+        self.assertItemsEqual(posix.VerifyPath.call_args_list,
+                              [call(e, [e.get("name") for e in entries])
+                               for e in entries])
+        self.assertItemsEqual(states.keys(), entries)
+        self.assertFalse(states[entries[4]])
+        self.assertEqual(len([s for s in states.values() if s]), 9)
+
+        # a batch that fails is logged, and doesn't stop the other
+        # batches from being collected
+        states = dict()
+        verify_batch = posix._verify_batch
+
+        def bad_batch(batch, mods):
+            if entries[0] in batch:
+                raise OSError
+            return verify_batch(batch, mods)
+
+        posix._verify_batch = Mock()
+        posix._verify_batch.side_effect = bad_batch
+        posix.logger = Mock()
+        posix.Inventory(states)
+        self.assertTrue(posix.logger.error.called)
+        self.assertItemsEqual(states.keys(), entries[3:])
+
     def test_InstallPath(self):
         entry = lxml.etree.Element("Path", name="test", type="file")
 
@@ -0,0 +1,112 @@
+import os
+import sys
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+try:
+    import rpm
+    from Bcfg2.Client.Tools.rpmtools import *
+    has_rpm = True
+except ImportError:
+    has_rpm = False
+
+
+class TestRPMDBSnapshot(Bcfg2TestCase):
+    def setUp(self):
+        self.rpmdb = dict()
+
+    def header(self, name, obsoletes=None):
+        return {'name': name, rpm.RPMTAG_OBSOLETENAME: obsoletes}
+
+    def install(self, name, obsoletes=None):
+        self.rpmdb[name] = self.header(name, obsoletes)
+
+    def get_ts(self):
+        """ get a mock transaction set that reads self.rpmdb """
+        def dbMatch(*args):
+            if not args:
+                return list(self.rpmdb.values())
+            elif args[1] in self.rpmdb:
+                return [self.rpmdb[args[1]]]
+            else:
+                return []
+
+        ts = Mock()
+        ts.dbMatch.side_effect = dbMatch
+        return ts
+
+    @skipUnless(has_rpm, "rpm not found, skipping")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.header_pkgspec")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.rpmtransactionset")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.rpmdb_stamp")
+    def test_refresh(self, mock_rpmdb_stamp, mock_rpmtransactionset,
+                     mock_header_pkgspec):
+        mock_rpmdb_stamp.return_value = "stamp1"
+        mock_rpmtransactionset.side_effect = self.get_ts
+        mock_header_pkgspec.side_effect = lambda h: dict(name=h['name'])
+        self.install("foo")
+        self.install("bar")
+
+        snapshot = RPMDBSnapshot()
+        self.assertTrue(snapshot.refresh())
+        self.assertItemsEqual(snapshot.installed().keys(), ["foo", "bar"])
+        self.assertEqual(snapshot.installed()["foo"], [dict(name="foo")])
+
+        # the rpmdb hasn't changed, so it isn't read again
+        mock_rpmtransactionset.reset_mock()
+        self.assertFalse(snapshot.refresh())
+        self.assertFalse(mock_rpmtransactionset.called)
+
+        # a transaction upgrades foo, which pulls in baz and removes
+        # bar; refreshing foo only re-reads foo
+        mock_rpmdb_stamp.return_value = "stamp2"
+        self.install("foo")
+        self.install("baz")
+        del self.rpmdb["bar"]
+        self.assertTrue(snapshot.refresh(["foo"]))
+        self.assertItemsEqual(snapshot.installed().keys(), ["foo", "bar"])
+
+        # the partial refresh didn't bring the whole snapshot up to
+        # date, so a full refresh still rescans the rpmdb
+        self.assertTrue(snapshot.refresh())
+        self.assertItemsEqual(snapshot.installed().keys(), ["foo", "baz"])
+        self.assertFalse(snapshot.refresh())
+
+    @skipUnless(has_rpm, "rpm not found, skipping")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.header_pkgspec")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.rpmtransactionset")
+    @patchIf(has_rpm, "Bcfg2.Client.Tools.rpmtools.rpmdb_stamp")
+    def test_refresh_names(self, mock_rpmdb_stamp, mock_rpmtransactionset,
+                           mock_header_pkgspec):
+        mock_rpmdb_stamp.return_value = "stamp1"
+        mock_rpmtransactionset.side_effect = self.get_ts
+        mock_header_pkgspec.side_effect = lambda h: dict(name=h['name'])
+        self.install("foo")
+        self.install("bar")
+        snapshot = RPMDBSnapshot()
+        snapshot.refresh()
+
+        # installing a package that obsoletes another removes the
+        # obsoleted package from the snapshot
+        mock_rpmdb_stamp.return_value = "stamp2"
+        self.install("newbar", obsoletes=["bar"])
+        del self.rpmdb["bar"]
+        self.assertTrue(snapshot.refresh(["newbar"]))
+        self.assertItemsEqual(snapshot.installed().keys(), ["foo", "newbar"])
+
+        # erasing a package
+        del self.rpmdb["foo"]
+        snapshot.refresh(["foo"])
+        self.assertItemsEqual(snapshot.installed().keys(), ["newbar"])
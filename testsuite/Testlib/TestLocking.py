@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+from Bcfg2.Locking import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestReadWriteLock(Bcfg2TestCase):
+    def _try(self, func):
+        """ run func in another thread and return True if it
+        returned within a short time """
+        done = threading.Event()
+
+        def inner():
+            func()
+            done.set()
+
+        thread = threading.Thread(target=inner)
+        thread.setDaemon(True)
+        thread.start()
+        done.wait(0.5)
+        return done.isSet()
+
+    def test_readers(self):
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        # reentrant, and shared with other readers
+        lock.acquire_read()
+        self.assertTrue(self._try(lambda: (lock.acquire_read(),
+                                           lock.release_read())))
+        # writers wait for readers
+        self.assertFalse(self._try(lock.acquire_write))
+        # ...and new readers wait for the waiting writer
+        self.assertFalse(self._try(lock.acquire_read))
+        self.assertRaises(RuntimeError, lock.acquire_write)
+        lock.release_read()
+        lock.release_read()
+        self.assertRaises(RuntimeError, lock.release_read)
+
+    def test_writer(self):
+        lock = ReadWriteLock()
+        self.assertEqual(lock.generation, 0)
+        lock.acquire()
+        lock.acquire_write()
+        lock.acquire_read()
+        lock.release_read()
+        self.assertFalse(self._try(lock.acquire_read))
+        lock.release_write()
+        self.assertEqual(lock.generation, 0)
+        lock.release()
+        self.assertEqual(lock.generation, 1)
+        self.assertRaises(RuntimeError, lock.release)
+
+        lock.acquire_read()
+        lock.release_read()
+        self.assertEqual(lock.generation, 1)
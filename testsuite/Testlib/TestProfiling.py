@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import threading
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Profiling import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+def request(duration):
+    """ a fake request that takes the given number of seconds, and
+    calls a function in a Bcfg2 module """
+    end = time.time() + duration
+    bcfg2_function(__file__, 1, "request")
+    while time.time() < end:
+        pass
+    return "ok"
+
+
+class TestProfiler(Bcfg2TestCase):
+    def test_bcfg2_function(self):
+        self.assertEqual(
+            bcfg2_function("/usr/lib/python2.7/site-packages/Bcfg2/Server/"
+                           "Core.py", 10, "BuildConfiguration"),
+            "Bcfg2/Server/Core.py:10(BuildConfiguration)")
+        self.assertEqual(
+            bcfg2_function("/usr/lib/python2.7/threading.py", 10, "run"),
+            None)
+
+    def test_start(self):
+        profiler = Profiler()
+        self.assertRaises(ValueError, profiler.start, "bogus", seconds=1)
+        self.assertRaises(ValueError, profiler.start, "sample")
+        profiler.start("sample", seconds=60)
+        self.assertRaises(ValueError, profiler.start, "sample", seconds=60)
+        profiler.stop()
+        self.assertFalse(profiler.get_results()['running'])
+
+    def test_not_running(self):
+        profiler = Profiler()
+        self.assertEqual(profiler.run_request(request, 0), "ok")
+        rv = profiler.get_results()
+        self.assertEqual(rv['requests'], 0)
+        self.assertEqual(rv['functions'], [])
+
+    @skipUnless(hasattr(sys, "_current_frames"), "Sampling not available")
+    def test_sample(self):
+        profiler = Profiler(interval=0.005)
+        profiler.start("sample", requests=2)
+        rv = []
+
+        def run():
+            rv.append(profiler.run_request(request, 0.2))
+
+        threads = [threading.Thread(target=run) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(rv, ["ok", "ok"])
+
+        # the request limit stopped profiling
+        results = profiler.get_results()
+        self.assertFalse(results['running'])
+        self.assertEqual(results['mode'], "sample")
+        self.assertEqual(results['requests'], 2)
+        self.assertTrue(results['samples'] > 0)
+        # this test module isn't a Bcfg2 module, so only functions
+        # in Bcfg2 modules are counted
+        names = [f['function'] for f in results['functions']]
+        self.assertIn("run_request", names[0])
+        for func in results['functions']:
+            self.assertTrue(func['function'].startswith("Bcfg2" + os.sep))
+            self.assertTrue(func['own'] <= func['cumulative'])
+        xmlrpclib.dumps((results, ), methodresponse=True)
+
+        # requests run after profiling has stopped aren't counted
+        profiler.run_request(request, 0)
+        self.assertEqual(profiler.get_results()['requests'], 2)
+
+    def test_cprofile(self):
+        profiler = Profiler()
+        profiler.start("cprofile", seconds=60, requests=3)
+        for i in range(3):
+            self.assertEqual(profiler.run_request(request, 0), "ok")
+        results = profiler.get_results(limit=1)
+        self.assertFalse(results['running'])
+        self.assertEqual(results['mode'], "cprofile")
+        self.assertEqual(results['requests'], 3)
+        self.assertEqual(len(results['functions']), 1)
+        self.assertIn("bcfg2_function", results['functions'][0]['function'])
+        self.assertEqual(results['functions'][0]['calls'], 3)
+        xmlrpclib.dumps((results, ), methodresponse=True)
+
+    def test_seconds(self):
+        profiler = Profiler()
+        profiler.start("cprofile", seconds=0.1)
+        self.assertTrue(profiler.get_results()['running'])
+        time.sleep(0.2)
+        self.assertFalse(profiler.get_results()['running'])
@@ -0,0 +1,226 @@
+import os
+import sys
+import threading
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Cache import LRUCache
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Locking import ReadWriteLock
+from Bcfg2.Server.FileMonitor import Event
+from Bcfg2.Server.FileMonitor.Pseudo import Pseudo
+from Bcfg2.Tracing import Tracer
+from Bcfg2.Profiling import Profiler
+from Bcfg2.Server.Core import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestBaseCore(Bcfg2TestCase):
+    def get_obj(self):
+        """ get a BaseCore object without running its constructor,
+        which sets up plugins, the file monitor, and so on """
+        core = BaseCore.__new__(BaseCore)
+        core.logger = Mock()
+        core.tracer = Tracer(size=0)
+        core.profiler = Profiler()
+        core.deferred_content = LRUCache(core.__deferred_content_size__)
+        core.admin_addresses = []
+        core.resolve_client = Mock()
+        core.resolve_client.side_effect = \
+            lambda address, metadata=True: (address[0], Mock())
+        core.BuildConfiguration = Mock()
+        core.BuildConfiguration.side_effect = self.get_config
+        return core
+
+    def get_config(self, client):
+        config = lxml.etree.Element("Configuration")
+        bundle = lxml.etree.SubElement(config, "Bundle", name="test")
+        for name in ["/foo", "/bar"]:
+            entry = lxml.etree.SubElement(bundle, "Path", name=name,
+                                          type="file", sha256="digest")
+            entry.text = "%s on %s" % (name, client)
+        lxml.etree.SubElement(bundle, "Path", name="/baz", type="file",
+                              empty="true")
+        return config
+
+    def get_content(self, core, client, paths):
+        return dict([(e.get("name"), e.text)
+                     for e in lxml.etree.XML(core.GetContent((client, 0),
+                                                             paths))])
+
+    def test_deferred_content(self):
+        core = self.get_obj()
+        config = lxml.etree.XML(core.GetConfig(("foo.example.com", 0),
+                                               checksum=True))
+        for entry in config.xpath("//Path[@sha256]"):
+            self.assertEqual(entry.text, None)
+            self.assertEqual(entry.get("deferred"), "true")
+        baz = config.xpath("//Path[@name='/baz']")[0]
+        self.assertEqual(baz.get("deferred"), None)
+
+        core.BuildConfiguration.reset_mock()
+        self.assertEqual(self.get_content(core, "foo.example.com",
+                                          ["/foo", "/bar"]),
+                         {"/foo": "/foo on foo.example.com",
+                          "/bar": "/bar on foo.example.com"})
+        self.assertFalse(core.BuildConfiguration.called)
+
+        # content that isn't deferred isn't returned
+        self.assertEqual(self.get_content(core, "foo.example.com", ["/baz"]),
+                         dict())
+        self.assertTrue(core.logger.error.called)
+
+    def test_deferred_content_rebuild(self):
+        core = self.get_obj()
+        # the content of a client that hasn't called GetConfig (e.g.,
+        # because the server was restarted) is rebuilt
+        self.assertEqual(self.get_content(core, "foo.example.com", ["/foo"]),
+                         {"/foo": "/foo on foo.example.com"})
+        core.BuildConfiguration.assert_called_with("foo.example.com")
+
+        # the content is discarded when the client uploads stats
+        core.process_statistics = Mock()
+        core.RecvStats(("foo.example.com", 0), "<Statistics/>")
+        self.assertNotIn("foo.example.com", core.deferred_content)
+
+        # the content of clients that never upload stats is
+        # discarded once too many other clients have deferred content
+        core.deferred_content = LRUCache(2)
+        for client in ["foo", "bar", "baz"]:
+            core.GetConfig((client, 0), checksum=True)
+        self.assertEqual(len(core.deferred_content), 2)
+        self.assertNotIn("foo", core.deferred_content)
+        core.BuildConfiguration.reset_mock()
+        self.assertEqual(self.get_content(core, "foo", ["/foo"]),
+                         {"/foo": "/foo on foo"})
+        core.BuildConfiguration.assert_called_with("foo")
+
+
+    def test_admin_only(self):
+        core = self.get_obj()
+        admin = ("127.0.0.1", 0)
+        client = ("10.0.0.5", 0)
+        # traces and profiling are disabled by default
+        self.assertRaises(xmlrpclib.Fault, core.get_traces, admin)
+
+        core.admin_addresses = ["127.0.0.1"]
+        self.assertEqual(core.get_traces(admin), [])
+        # managed clients can't read other clients' traces, or
+        # change how the server runs
+        self.assertRaises(xmlrpclib.Fault, core.get_traces, client)
+        self.assertRaises(xmlrpclib.Fault, core.get_trace, client, 1)
+        self.assertRaises(xmlrpclib.Fault, core.start_profiling, client,
+                          seconds=10, mode='cprofile')
+        self.assertFalse(core.profiler.running)
+        self.assertRaises(xmlrpclib.Fault, core.get_profile, client)
+        self.assertTrue(core.logger.warning.called)
+
+        self.assertTrue(core.start_profiling(admin, seconds=10))
+        self.assertTrue(core.profiler.running)
+        self.assertRaises(xmlrpclib.Fault, core.stop_profiling, client)
+        self.assertTrue(core.profiler.running)
+        self.assertTrue(core.stop_profiling(admin))
+        self.assertFalse(core.profiler.running)
+        self.assertFalse(core.get_profile(admin)['running'])
+
+
+class TestCoreLock(Bcfg2TestCase):
+    """ test the core lock with file monitor events being handled
+    while client configurations are built """
+
+    def get_obj(self):
+        core = BaseCore.__new__(BaseCore)
+        core.logger = Mock()
+        core.tracer = Tracer(size=0)
+        core.lock = ReadWriteLock()
+        core.fam = Pseudo()
+        core.fam.coalesce_window = 0
+        # builds wait for this to be set before finishing
+        core.finish_build = threading.Event()
+        core.finish_build.set()
+        core.building = threading.Event()
+        core.builds = []
+
+        def build(client):
+            core.building.set()
+            core.finish_build.wait(2)
+            core.builds.append(client)
+
+        core._build_configuration = Mock()
+        core._build_configuration.side_effect = build
+        return core
+
+    def start(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def test_reload_during_build(self):
+        core = self.get_obj()
+        handler = Mock()
+        # whether the write lock was held when each step ran
+        handler.locked = dict()
+        # HandleEvent waits for this to be set before finishing
+        finish_handle = threading.Event()
+        finish_handle.set()
+        handling = threading.Event()
+
+        def prepare(event):
+            handler.locked['prepare'] = core.lock.writer is not None
+
+        def handle(event):
+            handler.locked['handle'] = \
+                core.lock.writer is threading.currentThread()
+            handling.set()
+            finish_handle.wait(2)
+
+        handler.PrepareEvent.side_effect = prepare
+        handler.HandleEvent.side_effect = handle
+        core.fam.handles[0] = handler
+
+        # a file changes while a build is in progress; the event is
+        # applied without waiting for the build to finish
+        core.finish_build.clear()
+        build = self.start(core.BuildConfiguration, "foo.example.com")
+        self.assertTrue(core.building.wait(2) or core.building.isSet())
+        core.fam.events.append(Event(0, "test.xml", "changed"))
+        reload = self.start(core.fam.handle_event_set, core.lock)
+        reload.join(2)
+        self.assertFalse(reload.isAlive())
+        self.assertFalse(handler.locked['prepare'])
+        self.assertTrue(handler.locked['handle'])
+        self.assertEqual(core.lock.generation, 1)
+        self.assertTrue(build.isAlive())
+        core.finish_build.set()
+        build.join(2)
+        self.assertEqual(core.builds, ["foo.example.com"])
+        # the build is recorded as having started before the reload
+        self.assertTrue(core.logger.debug.called)
+
+        # builds don't wait for events that are being applied
+        finish_handle.clear()
+        handling.clear()
+        core.fam.events.append(Event(0, "test.xml", "changed"))
+        reload = self.start(core.fam.handle_event_set, core.lock)
+        self.assertTrue(handling.wait(2) or handling.isSet())
+        build = self.start(core.BuildConfiguration, "bar.example.com")
+        build.join(2)
+        self.assertFalse(build.isAlive())
+        self.assertEqual(core.builds, ["foo.example.com", "bar.example.com"])
+        self.assertTrue(reload.isAlive())
+        finish_handle.set()
+        reload.join(2)
+        self.assertFalse(reload.isAlive())
+        self.assertEqual(core.lock.generation, 2)
@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+from mock import Mock
+from Bcfg2.Compat import StringIO
+from Bcfg2.Server.Dependencies import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestRecording(Bcfg2TestCase):
+    def test_recording(self):
+        # nothing is recorded unless recording has been started
+        record_path("/test/foo")
+        record_entry("Path", "/etc/foo.conf")
+        self.assertEqual(stop_recording(), (set(), set()))
+
+        start_recording()
+        record_path("/test/foo")
+        record_path("/test/foo")
+        record_entry("Path", "/etc/foo.conf")
+
+        # recording is done per thread
+        def inner():
+            start_recording()
+            record_path("/test/bar")
+            stop_recording()
+
+        thread = threading.Thread(target=inner)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(stop_recording(),
+                         (set(["/test/foo"]),
+                          set([("Path", "/etc/foo.conf")])))
+        record_path("/test/baz")
+        self.assertEqual(stop_recording(), (set(), set()))
+
+
+class TestDependencyMap(Bcfg2TestCase):
+    def get_obj(self):
+        deps = DependencyMap()
+        deps.add("foo.example.com",
+                 ["/test/Cfg/etc/foo.conf", "/test/Bundler/foo.xml"],
+                 [("Path", "/etc/foo.conf")])
+        deps.add("bar.example.com",
+                 ["/test/Cfg/etc/bar.conf", "/test/Bundler/bar.xml"],
+                 [("Path", "/etc/bar.conf"), ("Service", "bar")])
+        return deps
+
+    def get_plugin(self, name, affected=None):
+        plugin = Mock()
+        plugin.name = name
+        plugin.data = os.path.join("/test", name)
+        plugin.get_affected_entries.return_value = affected
+        return plugin
+
+    def test_read_write(self):
+        deps = self.get_obj()
+        data = StringIO()
+        deps.write(data)
+        data.seek(0)
+        deps2 = DependencyMap()
+        deps2.read(data)
+        self.assertEqual(deps.clients, deps2.clients)
+
+        self.assertRaises(ValueError, deps2.read, ["foo.example.com\tbogus"])
+
+    def test_affected(self):
+        deps = self.get_obj()
+        cfg = self.get_plugin("Cfg", [])
+        bundler = self.get_plugin("Bundler", [])
+        metadata = self.get_plugin("Metadata")
+        plugins = [cfg, bundler, metadata]
+
+        # a file in a directory that was used
+        rv = deps.affected(["/test/Cfg/etc/foo.conf/foo.conf.H_foo"],
+                           plugins)
+        self.assertItemsEqual(rv.keys(), ["foo.example.com"])
+
+        # a directory that contains files that were used
+        rv = deps.affected(["/test/Bundler"], plugins)
+        self.assertItemsEqual(rv.keys(),
+                              ["foo.example.com", "bar.example.com"])
+
+        # a file that nothing used
+        rv = deps.affected(["/test/Bundler/baz.xml"], plugins)
+        self.assertEqual(rv, dict())
+
+        # a file that binds an entry a client has
+        cfg.get_affected_entries.side_effect = \
+            lambda p, e: [x for x in e if x == ("Path", "/etc/baz.conf")]
+        deps.clients["bar.example.com"][1].add(("Path", "/etc/baz.conf"))
+        rv = deps.affected(["/test/Cfg/etc/baz.conf/baz.conf"], plugins)
+        self.assertItemsEqual(rv.keys(), ["bar.example.com"])
+
+        # a plugin that can't tell what a file binds
+        rv = deps.affected(["/test/Metadata/groups.xml"], plugins)
+        self.assertItemsEqual(rv.keys(),
+                              ["foo.example.com", "bar.example.com"])
+
+        # a file that isn't in any plugin directory
+        rv = deps.affected(["/test/etc/bcfg2.conf"], plugins)
+        self.assertItemsEqual(rv.keys(),
+                              ["foo.example.com", "bar.example.com"])
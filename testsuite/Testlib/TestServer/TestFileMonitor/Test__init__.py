@@ -0,0 +1,293 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.FileMonitor import *
+from Bcfg2.Server.FileMonitor.Pseudo import Pseudo
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestFileMonitor(Bcfg2TestCase):
+    test_obj = FileMonitor
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for fname in ["foo", "bar"]:
+            open(os.path.join(self.tmpdir, fname), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        fm = Pseudo()
+        fm.coalesce_window = 0
+        return fm
+
+    def get_handler(self):
+        handler = Mock()
+        handler.events = []
+        handler.HandleEvent.side_effect = \
+            lambda e: handler.events.append((e.filename, e.code2str()))
+        return handler
+
+    def test_initial_load_complete(self):
+        fm = self.get_obj()
+        self.assertTrue(fm.initial_load_complete())
+
+        handler = self.get_handler()
+        handle = fm.AddMonitor(self.tmpdir, handler)
+        self.assertFalse(fm.initial_load_complete())
+
+        # handling some of the 'exists' events isn't enough
+        fm.handle_one_event(fm.get_event())
+        fm.handle_one_event(fm.get_event())
+        self.assertFalse(fm.initial_load_complete())
+
+        fm.handle_event_set()
+        self.assertTrue(fm.initial_load_complete())
+        self.assertItemsEqual(handler.events,
+                              [(self.tmpdir, "exists"), ("foo", "exists"),
+                               ("bar", "exists"), (self.tmpdir, "endExist")])
+
+        # events that arrive later don't affect the initial load, but
+        # it isn't complete while they are pending
+        fm.events.append(Event(handle, "baz", "created"))
+        self.assertFalse(fm.initial_load_complete())
+        fm.handle_event_set()
+        self.assertTrue(fm.initial_load_complete())
+
+    def test_initial_load_complete_ignored(self):
+        # the end of the initial load is noticed even if the endExist
+        # event is ignored
+        fm = Pseudo(ignore=[self.tmpdir])
+        fm.AddMonitor(self.tmpdir, self.get_handler())
+        fm.handle_event_set()
+        self.assertTrue(fm.initial_load_complete())
+
+    def test_wait_for_initial_load(self):
+        fm = self.get_obj()
+        handlers = []
+        for i in range(3):
+            handlers.append(self.get_handler())
+            fm.AddMonitor(self.tmpdir, handlers[-1])
+        lock = Mock()
+        self.assertTrue(fm.wait_for_initial_load(timeout=5, lock=lock))
+        self.assertTrue(fm.initial_load_complete())
+        self.assertTrue(lock.acquire.called)
+        self.assertEqual(lock.acquire.call_count, lock.release.call_count)
+        for handler in handlers:
+            self.assertEqual(len(handler.events), 4)
+
+        # monitors added while handling events (e.g., for
+        # subdirectories) are waited for too
+        subdir = os.path.join(self.tmpdir, "subdir")
+        os.mkdir(subdir)
+        open(os.path.join(subdir, "baz"), "w").close()
+        sub_handler = self.get_handler()
+        handler = self.get_handler()
+
+        def handle_event(event):
+            handler.events.append((event.filename, event.code2str()))
+            if event.filename == "subdir":
+                fm.AddMonitor(subdir, sub_handler)
+
+        handler.HandleEvent.side_effect = handle_event
+        fm.AddMonitor(self.tmpdir, handler)
+        self.assertTrue(fm.wait_for_initial_load(timeout=5))
+        self.assertIn(("baz", "exists"), sub_handler.events)
+
+    def test_wait_for_initial_load_timeout(self):
+        fm = self.get_obj()
+        # a monitor whose endExist event never arrives
+        fm.loading.add(0)
+        self.assertFalse(fm.wait_for_initial_load(timeout=0.1))
+
+        # it completes once the endExist event arrives from another
+        # thread
+        fm.handles[0] = self.get_handler()
+
+        def end():
+            fm.events.append(Event(0, self.tmpdir, "endExist"))
+
+        timer = threading.Timer(0.1, end)
+        timer.start()
+        self.assertTrue(fm.wait_for_initial_load(timeout=5))
+        timer.join()
+
+    @patch("Bcfg2.Server.FileMonitor.logger")
+    def test_handle_event_set_error(self, mock_logger):
+        fm = self.get_obj()
+        handler = self.get_handler()
+        handle = fm.AddMonitor(self.tmpdir, handler)
+        fm.handle_event_set()
+        handler.events = []
+        for fname in ["foo", "bar", "baz"]:
+            fm.events.append(Event(handle, fname, "changed"))
+
+        # errors in handlers are logged, and don't stop the rest of
+        # the events from being handled
+        def handle_event(event):
+            if event.filename == "foo":
+                raise OSError
+            handler.events.append((event.filename, event.code2str()))
+
+        handler.HandleEvent.side_effect = handle_event
+        fm.handle_event_set()
+        self.assertEqual(handler.events, [("bar", "changed"),
+                                          ("baz", "changed")])
+        self.assertFalse(fm.pending())
+
+        # if handling the events fails, the events that weren't
+        # handled are requeued
+        handler.events = []
+        handler.HandleEvent.side_effect = \
+            lambda e: handler.events.append((e.filename, e.code2str()))
+        for fname in ["foo", "bar", "baz"]:
+            fm.events.append(Event(handle, fname, "changed"))
+        lock = Mock()
+        lock.acquire.side_effect = [None, RuntimeError]
+        handle_one_event = fm.handle_one_event
+
+        def handle_one(event):
+            handle_one_event(event)
+            if event.filename == "foo":
+                # a new event arrives while the first is handled;
+                # taking the lock for it fails
+                fm.events.append(Event(handle, "quux", "created"))
+
+        fm.handle_one_event = Mock(side_effect=handle_one)
+        fm.handle_event_set(lock)
+        self.assertTrue(mock_logger.error.called)
+        self.assertEqual(handler.events, [("foo", "changed"),
+                                          ("bar", "changed"),
+                                          ("baz", "changed")])
+        self.assertEqual([(e.filename, e.code2str()) for e in fm.events],
+                         [("quux", "created")])
+        lock.acquire.side_effect = None
+        fm.handle_event_set(lock)
+        self.assertFalse(fm.pending())
+        self.assertEqual(handler.events[-1], ("quux", "created"))
+
+    @patch("Bcfg2.Server.FileMonitor.logger")
+    def test_handle_event_set_get_error(self, mock_logger):
+        fm = self.get_obj()
+        handler = self.get_handler()
+        handle = fm.AddMonitor(self.tmpdir, handler)
+        fm.handle_event_set()
+        handler.events = []
+        for fname in ["foo", "bar", "baz"]:
+            fm.events.append(Event(handle, fname, "changed"))
+
+        # getting an event from the monitor fails after two events
+        # have been taken from the queue
+        get_event = fm.get_event
+        fm.get_event = Mock()
+        fm.get_event.side_effect = [get_event(), get_event(), IOError]
+        fm.handle_event_set()
+        self.assertTrue(mock_logger.error.called)
+        self.assertEqual(handler.events, [])
+        self.assertEqual([(e.filename, e.code2str()) for e in fm.events],
+                         [("foo", "changed"), ("bar", "changed"),
+                          ("baz", "changed")])
+
+    def events(self, *events):
+        return [Event(handle, fname, action)
+                for (handle, fname, action) in events]
+
+    def summary(self, events):
+        return [(e.requestID, e.filename, e.code2str()) for e in events]
+
+    def test_coalesce(self):
+        fm = self.get_obj()
+        # a change that follows a creation is redundant
+        self.assertEqual(
+            self.summary(fm.coalesce(self.events((0, "foo", "created"),
+                                                 (0, "foo", "changed"),
+                                                 (0, "foo", "changed")))),
+            [(0, "foo", "created")])
+
+        # duplicate changes are redundant
+        self.assertEqual(
+            self.summary(fm.coalesce(self.events((0, "foo", "changed"),
+                                                 (0, "bar", "changed"),
+                                                 (0, "foo", "changed"),
+                                                 (1, "foo", "changed"),
+                                                 (0, "bar", "changed")))),
+            [(0, "foo", "changed"), (0, "bar", "changed"),
+             (1, "foo", "changed")])
+
+        # a file that is deleted and created again must be seen to be
+        # deleted and created, in that order
+        events = self.events((0, "foo", "created"),
+                             (0, "foo", "deleted"),
+                             (0, "foo", "created"),
+                             (0, "foo", "changed"))
+        self.assertEqual(self.summary(fm.coalesce(events)),
+                         self.summary(events[:3]))
+        events = self.events((0, "foo", "changed"),
+                             (0, "foo", "deleted"),
+                             (0, "foo", "created"),
+                             (0, "foo", "deleted"))
+        self.assertEqual(self.summary(fm.coalesce(events)),
+                         self.summary(events))
+
+        # events other than created, changed and deleted are never
+        # coalesced
+        events = self.events((0, "foo", "exists"),
+                             (0, "foo", "exists"),
+                             (0, "foo", "changed"),
+                             (0, "/", "endExist"),
+                             (0, "/", "endExist"))
+        self.assertEqual(self.summary(fm.coalesce(events)),
+                         self.summary(events))
+
+    def test_handle_event_set_coalesce(self):
+        fm = self.get_obj()
+        fm.stats = Mock()
+        handler = self.get_handler()
+        handle = fm.AddMonitor(self.tmpdir, handler)
+        fm.handle_event_set()
+        handler.events = []
+        fm.stats.reset_mock()
+
+        for action in ["created", "changed", "changed", "deleted", "created"]:
+            fm.events.append(Event(handle, "baz", action))
+        fm.handle_event_set()
+        self.assertEqual(handler.events, [("baz", "created"),
+                                          ("baz", "deleted"),
+                                          ("baz", "created")])
+        fm.stats.add_value.assert_any_call("FileMonitor:dispatched", 3)
+        fm.stats.add_value.assert_any_call("FileMonitor:coalesced", 2)
+
+    def test_handle_event_set_window(self):
+        fm = self.get_obj()
+        fm.coalesce_window = 0.2
+        handler = self.get_handler()
+        handle = fm.AddMonitor(self.tmpdir, handler)
+        fm.handle_event_set()
+        handler.events = []
+
+        # events that arrive during the coalescing window are handled
+        # together with the first one
+        fm.events.append(Event(handle, "foo", "changed"))
+        timer = threading.Timer(
+            0.05, lambda: fm.events.append(Event(handle, "foo", "changed")))
+        timer.start()
+        fm.handle_event_set()
+        timer.join()
+        self.assertEqual(handler.events, [("foo", "changed")])
+        self.assertFalse(fm.pending())
@@ -2,11 +2,14 @@ import os
 import re
 import sys
 import copy
+import shutil
 import logging
+import tempfile
+import threading
 import lxml.etree
 import Bcfg2.Server
 from Bcfg2.Compat import reduce
-from mock import Mock, MagicMock, patch
+from mock import Mock, MagicMock, patch, ANY
 from Bcfg2.Server.Plugin import *
 
 # add all parent testsuite directories to sys.path to allow (most)
@@ -267,126 +270,170 @@ class TestThreadedStatistics(TestStatistics):
         ts = self.get_obj(core)
         mock_start.assert_any_call()
 
-    @patch("%s.open" % builtins)
-    @patch("%s.dump" % cPickle.__name__)
-    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.run", Mock())
-    def test_save(self, mock_dump, mock_open):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self, core=None):
+        # don't read or remove a pending file in the real datastore
+        @patch("Bcfg2.Server.Plugin.ThreadedStatistics._recover_journal",
+               Mock(return_value=[]))
+        def inner():
+            return TestStatistics.get_obj(self, core)
+
+        return inner()
+
+    @patch("threading.Thread.start", Mock())
+    def get_journaled_obj(self, core):
+        """ get an object whose pending file is in a temporary
+        directory """
+        etc = os.path.join(self.tmpdir, "etc")
+        if not os.path.exists(etc):
+            os.makedirs(etc)
+        return self.test_obj(core, self.tmpdir)
+
+    def test_journal(self):
         core = Mock()
-        ts = self.get_obj(core)
-        queue = Mock()
-        queue.empty = Mock(side_effect=Empty)
-        ts.work_queue = queue
-
-        mock_open.side_effect = OSError
-        # test that save does _not_ raise an exception even when
-        # everything goes pear-shaped
-        ts.save()
-        queue.empty.assert_any_call()
-        mock_open.assert_called_with(ts.pending_file, 'w')
-
-        queue.reset_mock()
-        mock_open.reset_mock()
+        ts = self.get_journaled_obj(core)
+        self.assertEqual(ts.pending, [])
+        ts.work_queue = Mock()
 
-        queue.data = []
         for hostname, xml in self.data:
             md = Mock()
             md.hostname = hostname
-            queue.data.append((md, lxml.etree.XML(xml)))
-        queue.empty.side_effect = lambda: len(queue.data) == 0
-        queue.get_nowait = Mock(side_effect=lambda: queue.data.pop())
-        mock_open.side_effect = None
-
-        ts.save()
-        queue.empty.assert_any_call()
-        queue.get_nowait.assert_any_call()
-        mock_open.assert_called_with(ts.pending_file, 'w')
-        mock_open.return_value.close.assert_any_call()
-        # the order of the queue data gets changed, so we have to
-        # verify this call in an ugly way
-        self.assertItemsEqual(mock_dump.call_args[0][0], self.data)
-        self.assertEqual(mock_dump.call_args[0][1], mock_open.return_value)
-        
-    @patch("os.unlink")
-    @patch("os.path.exists")
-    @patch("%s.open" % builtins)
-    @patch("lxml.etree.XML")
-    @patch("%s.load" % cPickle.__name__)
-    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.run", Mock())
-    def test_load(self, mock_load, mock_XML, mock_open, mock_exists,
-                  mock_unlink):
+            ts.process_statistics(md, lxml.etree.XML(xml))
+        self.assertEqual(len(ts.outstanding), 2)
+        self.assertItemsEqual([(c[0][0][0].hostname, c[0][0][1])
+                               for c in ts.work_queue.put_nowait.call_args_list],
+                              self.data)
+
+        # the first interaction is handled, and the server dies
+        ts._journal_done([ts.work_queue.put_nowait.call_args_list[0][0][0][2]])
+        ts._journal_close()
+        # add an incomplete record to the end of the file
+        open(ts.pending_file, 'ab').write(cPickle.dumps(('add', 5, 'baz'))[:-3])
+
+        self.assertEqual(ts._read_journal(), [self.data[1]])
+        # the pending interaction is recovered when the plugin starts
+        ts2 = self.get_journaled_obj(core)
+        self.assertEqual(ts2.pending, [(1,) + self.data[1]])
+        self.assertEqual(len(ts2.outstanding), 1)
+        self.assertEqual(ts2._read_journal(), [self.data[1]])
+
+        # once everything is handled the file is removed
+        ts2._journal_done([1])
+        self.assertFalse(os.path.exists(ts.pending_file))
+
+        # pending data from older versions is loaded
+        open(ts.pending_file, 'wb').write(cPickle.dumps(self.data))
+        self.assertItemsEqual(ts2._read_journal(), self.data)
+
+    def test_journal_compact(self):
+        core = Mock()
+        ts = self.get_journaled_obj(core)
+        ts.__journal_compact__ = 3
+        ts.work_queue = Mock()
+        for i in range(10):
+            md = Mock()
+            md.hostname = "client%d" % i
+            ts.process_statistics(md, lxml.etree.XML("<foo/>"))
+        serials = [c[0][0][2] for c in ts.work_queue.put_nowait.call_args_list]
+
+        # the pending file is rewritten after every third handled
+        # interaction, even though the queue never empties
+        size = os.stat(ts.pending_file).st_size
+        ts._journal_done(serials[:2])
+        self.assertTrue(os.stat(ts.pending_file).st_size > size)
+        ts._journal_done(serials[2:3])
+        self.assertTrue(os.stat(ts.pending_file).st_size < size)
+        self.assertEqual(ts.handled, 0)
+        records = []
+        journal = open(ts.pending_file, 'rb')
+        while True:
+            try:
+                records.append(cPickle.load(journal))
+            except EOFError:
+                break
+        journal.close()
+        self.assertEqual([r[0] for r in records], ['add'] * 7)
+        self.assertEqual([r[1] for r in records], serials[3:])
+
+        # records added after the rewrite are in the new file
+        ts._journal_done(serials[3:4])
+        md = Mock()
+        md.hostname = "client10"
+        ts.process_statistics(md, lxml.etree.XML("<bar/>"))
+        ts._journal_close()
+        ts2 = self.get_journaled_obj(core)
+        self.assertEqual(ts2._read_journal(),
+                         [("client%d" % i, "<foo/>") for i in range(4, 10)] +
+                         [("client10", "<bar/>")])
+
+        ts._journal_done(serials[4:] + [ts.serial])
+        self.assertFalse(os.path.exists(ts.pending_file))
+
+    def test_process_statistics_full(self):
+        core = Mock()
+        ts = self.get_journaled_obj(core)
+        ts.work_queue = Mock()
+        ts.work_queue.put_nowait.side_effect = Full
+        md = Mock()
+        md.hostname = self.data[0][0]
+        # test that no exception is thrown
+        ts.process_statistics(md, lxml.etree.XML(self.data[0][1]))
+        self.assertEqual(ts.outstanding, dict())
+        self.assertEqual(ts._read_journal(), [])
+
+    @patch("Bcfg2.Server.Plugin.ThreadedStatistics._journal_done")
+    @patch("threading.Thread.start", Mock())
+    def test_load(self, mock_journal_done):
         core = Mock()
         core.terminate.isSet.return_value = False
         ts = self.get_obj(core)
-        
         ts.work_queue = Mock()
-        ts.work_queue.data = []
-        def reset():
-            core.reset_mock()
-            mock_open.reset_mock()
-            mock_exists.reset_mock()
-            mock_unlink.reset_mock()
-            mock_load.reset_mock()
-            mock_XML.reset_mock()
-            ts.work_queue.reset_mock()
-            ts.work_queue.data = []
 
-        mock_exists.return_value = False
         self.assertTrue(ts.load())
-        mock_exists.assert_called_with(ts.pending_file)
+        self.assertFalse(ts.work_queue.put_nowait.called)
 
-        reset()
-        mock_exists.return_value = True
-        mock_open.side_effect = OSError
-        self.assertFalse(ts.load())
-        mock_exists.assert_called_with(ts.pending_file)
-        mock_open.assert_called_with(ts.pending_file, 'r')
-
-        reset()
-        mock_open.side_effect = None
-        mock_load.return_value = self.data
+        ts.pending = [(1, "foo.example.com", "<foo/>"),
+                      (2, "bar.example.com", "<bar/>")]
         ts.work_queue.put_nowait.side_effect = Full
         self.assertTrue(ts.load())
-        mock_exists.assert_called_with(ts.pending_file)
-        mock_open.assert_called_with(ts.pending_file, 'r')
-        mock_open.return_value.close.assert_any_call()
-        mock_load.assert_called_with(mock_open.return_value)
+        mock_journal_done.assert_called_with([1, 2])
+        self.assertEqual(ts.pending, [])
 
-        reset()
+        mock_journal_done.reset_mock()
+        ts.work_queue.reset_mock()
+        ts.pending = [(1, "foo.example.com", "<foo/>"),
+                      (2, "bar.example.com", "<bar/>")]
         core.build_metadata.side_effect = lambda x: x
-        mock_XML.side_effect = lambda x, parser=None: x
         ts.work_queue.put_nowait.side_effect = None
         self.assertTrue(ts.load())
-        mock_exists.assert_called_with(ts.pending_file)
-        mock_open.assert_called_with(ts.pending_file, 'r')
-        mock_open.return_value.close.assert_any_call()
-        mock_load.assert_called_with(mock_open.return_value)
-        self.assertItemsEqual(mock_XML.call_args_list,
-                              [call(x, parser=Bcfg2.Server.XMLParser)
-                               for h, x in self.data])
         self.assertItemsEqual(ts.work_queue.put_nowait.call_args_list,
-                              [call((h, x)) for h, x in self.data])
-        mock_unlink.assert_called_with(ts.pending_file)
+                              [call((h, x, s)) for s, h, x in
+                               [(1, "foo.example.com", "<foo/>"),
+                                (2, "bar.example.com", "<bar/>")]])
+        mock_journal_done.assert_called_with([])
 
     @patch("threading.Thread.start", Mock())
     @patch("Bcfg2.Server.Plugin.ThreadedStatistics.load")
-    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.save")
+    @patch("Bcfg2.Server.Plugin.ThreadedStatistics._journal_done")
     @patch("Bcfg2.Server.Plugin.ThreadedStatistics.handle_statistic")
-    def test_run(self, mock_handle, mock_save, mock_load):
+    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.handle_idle")
+    def test_run(self, mock_idle, mock_handle, mock_journal_done, mock_load):
         core = Mock()
         ts = self.get_obj(core)
+        ts.__batch_delay__ = 0.1
         mock_load.return_value = True
         ts.work_queue = Mock()
-
-        def reset():
-            mock_handle.reset_mock()
-            mock_save.reset_mock()
-            mock_load.reset_mock()
-            core.reset_mock()
-            ts.work_queue.reset_mock()
-            ts.work_queue.data = self.data[:]
-            ts.work_queue.get_calls = 0
-
-        reset()
+        ts.work_queue.data = []
+        for i in range(len(self.data)):
+            md = Mock()
+            md.hostname = self.data[i][0]
+            ts.work_queue.data.append((md, self.data[i][1], i + 1))
+        ts.work_queue.get_calls = 0
 
         def get_rv(**kwargs):
             ts.work_queue.get_calls += 1
@@ -401,30 +448,33 @@ class TestThreadedStatistics(TestStatistics):
             return ts.work_queue.get_calls > 3
         core.terminate.isSet.side_effect = terminate_isset
 
-        ts.work_queue.empty.return_value = False
         ts.run()
         mock_load.assert_any_call()
-        self.assertGreaterEqual(ts.work_queue.get.call_count, len(self.data))
+        self.assertEqual(mock_handle.call_count, len(self.data))
+        self.assertItemsEqual([(c[0][0].hostname,
+                                lxml.etree.tostring(c[0][1]).decode('UTF-8'))
+                               for c in mock_handle.call_args_list],
+                              self.data)
+        # both interactions were handled in a single batch
+        self.assertItemsEqual(mock_journal_done.call_args[0][0], [1, 2])
+        # the idle hook runs while the queue is empty
+        self.assertTrue(mock_idle.called)
+
+    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.handle_statistic")
+    @patch("threading.Thread.start", Mock())
+    def test_handle_statistics_batch(self, mock_handle):
+        ts = self.get_obj()
+        mock_handle.side_effect = [Exception, None]
+        batch = [(Mock(), Mock()), (Mock(), Mock())]
+        # an error handling one interaction doesn't stop the rest
+        ts.handle_statistics_batch(batch)
         self.assertItemsEqual(mock_handle.call_args_list,
-                              [call(h, x) for h, x in self.data])
-        mock_save.assert_any_call()
+                              [call(m, d) for m, d in batch])
 
-    @patch("copy.copy", Mock(side_effect=lambda x: x))
-    @patch("Bcfg2.Server.Plugin.ThreadedStatistics.run", Mock())
+    @patch("threading.Thread.start", Mock())
     def test_process_statistics(self):
         TestStatistics.test_process_statistics(self)
 
-        core = Mock()
-        ts = self.get_obj(core)
-        ts.work_queue = Mock()
-        ts.process_statistics(*self.data[0])
-        ts.work_queue.put_nowait.assert_called_with(self.data[0])
-
-        ts.work_queue.reset_mock()
-        ts.work_queue.put_nowait.side_effect = Full
-        # test that no exception is thrown
-        ts.process_statistics(*self.data[0])
-        
 
 class TestPullSource(Bcfg2TestCase):
     def test_GetCurrentEntry(self):
@@ -470,8 +520,90 @@ class TestGoalValidator(Bcfg2TestCase):
 
 
 class TestVersion(Bcfg2TestCase):
-    """ placeholder for future tests """
-    pass
+    test_obj = Version
+
+    def get_obj(self):
+        class MockVersion(self.test_obj):
+            name = "MockVersion"
+
+        rv = MockVersion()
+        rv.core = Mock()
+        rv.core.datastore = datastore
+        rv.logger = Mock()
+        rv.get_revision = Mock()
+        rv.get_revision.return_value = "1"
+        return rv
+
+    def test_current_revision_unmonitored(self):
+        version = self.get_obj()
+        self.assertEqual(version.current_revision(), "1")
+        self.assertEqual(version.current_revision(), "1")
+        self.assertEqual(version.get_revision.call_count, 2)
+        self.assertFalse(version.core.fam.AddMonitor.called)
+
+    @patch("os.path.exists")
+    def test_current_revision_monitored(self, mock_exists):
+        mock_exists.return_value = True
+        version = self.get_obj()
+        version.__vcs_metadata__ = [".vcs"]
+        self.assertEqual(version.current_revision(), "1")
+        self.assertEqual(version.current_revision(), "1")
+        self.assertEqual(version.get_revision.call_count, 1)
+        version.core.fam.AddMonitor.assert_called_with(
+            os.path.join(datastore, ".vcs"), ANY)
+        self.assertFalse(version.core.stats.add_value.called)
+
+        # an event on the VCS metadata makes the revision stale
+        monitor = version.core.fam.AddMonitor.call_args[0][1]
+        version.get_revision.return_value = "2"
+        monitor.HandleEvent(Mock())
+        self.assertEqual(version.current_revision(), "2")
+        self.assertEqual(version.get_revision.call_count, 2)
+        version.core.stats.add_value.assert_called_with(
+            "MockVersion:revision_changed", 1)
+
+    def test_current_revision_recursive(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            heads = os.path.join(tmpdir, ".vcs", "heads")
+            os.makedirs(os.path.join(heads, "feature"))
+            open(os.path.join(tmpdir, ".vcs", "HEAD"), "w").close()
+            version = self.get_obj()
+            version.core.datastore = tmpdir
+            version.__vcs_metadata__ = [".vcs", ".vcs/HEAD", ".vcs/packed"]
+            version.__vcs_metadata_recursive__ = [".vcs/heads"]
+            self.assertEqual(version.current_revision(), "1")
+            # paths that don't exist aren't watched, and
+            # subdirectories of recursive paths are
+            self.assertItemsEqual(
+                [c[0][0] for c in version.core.fam.AddMonitor.call_args_list],
+                [os.path.join(tmpdir, ".vcs"),
+                 os.path.join(tmpdir, ".vcs", "HEAD"),
+                 heads,
+                 os.path.join(heads, "feature")])
+            monitors = dict([(c[0][0], c[0][1]) for c in
+                             version.core.fam.AddMonitor.call_args_list])
+
+            # a new subdirectory of a recursive path is watched too
+            version.core.fam.AddMonitor.reset_mock()
+            os.makedirs(os.path.join(heads, "feature", "nested"))
+            event = Mock()
+            event.code2str.return_value = "created"
+            event.filename = "nested"
+            version.get_revision.return_value = "2"
+            monitors[os.path.join(heads, "feature")].HandleEvent(event)
+            version.core.fam.AddMonitor.assert_called_once_with(
+                os.path.join(heads, "feature", "nested"), ANY)
+            self.assertEqual(version.current_revision(), "2")
+
+            # but not for paths that aren't recursive
+            version.core.fam.AddMonitor.reset_mock()
+            event.filename = "refs"
+            os.makedirs(os.path.join(tmpdir, ".vcs", "refs"))
+            monitors[os.path.join(tmpdir, ".vcs")].HandleEvent(event)
+            self.assertFalse(version.core.fam.AddMonitor.called)
+        finally:
+            shutil.rmtree(tmpdir)
 
 
 class TestClientRunHooks(Bcfg2TestCase):
@@ -479,6 +611,221 @@ class TestClientRunHooks(Bcfg2TestCase):
     pass
 
 
+class TestRepositoryPreloader(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "Rules"))
+        os.mkdir(os.path.join(self.tmpdir, "Rules", ".svn"))
+        self.files = dict()
+        for name, data in [("Rules/test.xml", "<Rules/>"),
+                           ("Rules/bad.xml", "<Rules>"),
+                           ("Rules/test.txt", "test"),
+                           ("Rules/test.xml~", "<Rules/>"),
+                           ("Rules/.svn/entries", "svn")]:
+            path = os.path.join(self.tmpdir, name)
+            open(path, "w").write(data)
+            self.files[name] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        return RepositoryPreloader(ignore=["*~", ".svn"])
+
+    def test_preload(self):
+        preloader = self.get_obj()
+        preloader.preload([os.path.join(self.tmpdir, "Rules")], 2)
+        self.assertItemsEqual(preloader.files.keys(),
+                              [self.files["Rules/test.xml"],
+                               self.files["Rules/bad.xml"],
+                               self.files["Rules/test.txt"]])
+        # only well-formed XML files are parsed
+        self.assertItemsEqual(preloader.xml.keys(),
+                              [self.files["Rules/test.xml"]])
+
+        path = self.files["Rules/test.xml"]
+        data = preloader.read(path)
+        self.assertEqual(data, "<Rules/>")
+        self.assertEqual(preloader.parse(path, data).tag, "Rules")
+        # preloaded data is only used once
+        self.assertIsNone(preloader.read(path))
+        self.assertIsNone(preloader.parse(path, data))
+
+        self.assertEqual(preloader.read(self.files["Rules/test.txt"]),
+                         "test")
+        preloader.clear()
+        self.assertEqual(preloader.files, dict())
+        self.assertEqual(preloader.xml, dict())
+
+    def test_preload_max_size(self):
+        preloader = self.get_obj()
+        preloader.__max_size__ = 5
+        preloader.preload([os.path.join(self.tmpdir, "Rules")], 1)
+        self.assertItemsEqual(preloader.files.keys(),
+                              [self.files["Rules/test.txt"]])
+
+    def test_changed(self):
+        path = self.files["Rules/test.xml"]
+
+        # a file whose size changed after it was preloaded
+        preloader = self.get_obj()
+        preloader.load(path)
+        open(path, "w").write("<Rules><Path name='/foo'/></Rules>")
+        self.assertIsNone(preloader.read(path))
+        self.assertNotIn(path, preloader.xml)
+
+        # a file whose mtime changed after it was preloaded
+        preloader.load(path)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime - 10))
+        self.assertIsNone(preloader.read(path))
+        self.assertNotIn(path, preloader.xml)
+
+        # XML that was parsed from different data
+        preloader.load(path)
+        self.assertIsNone(preloader.parse(path, "<Rules/>"))
+
+    def test_read_file(self):
+        path = self.files["Rules/test.xml"]
+        preloader = self.get_obj()
+        preloader.load(path)
+
+        @patch("Bcfg2.Server.Plugin.preloader", preloader)
+        def inner():
+            # unchanged files are read from the preloader
+            xdata = preloader.xml[path][1]
+            data = read_file(path)
+            self.assertIs(parse_xml(data, path), xdata)
+
+            # changed files are read from disk
+            preloader.load(path)
+            open(path, "w").write("<Rules><Path name='/foo'/></Rules>")
+            data = read_file(path)
+            self.assertEqual(data, "<Rules><Path name='/foo'/></Rules>")
+            self.assertEqual(len(parse_xml(data, path)), 1)
+
+        inner()
+
+
+class TestRepositorySnapshot(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot(self):
+        spath = os.path.join(self.tmpdir, "cache", "repository.snapshot")
+        fpath = os.path.join(self.tmpdir, "test.xml")
+        open(fpath, "w").write("<Test/>")
+
+        snapshot = RepositorySnapshot(spath)
+        self.assertFalse(snapshot.load())
+        self.assertFalse(snapshot.unchanged(fpath))
+        self.assertIsNone(snapshot.get_state(fpath, "key"))
+        snapshot.set_state(fpath, os.stat(fpath), "key", dict(foo="bar"))
+        self.assertTrue(snapshot.save())
+        self.assertTrue(os.path.exists(spath))
+
+        snapshot = RepositorySnapshot(spath)
+        self.assertTrue(snapshot.load())
+        self.assertTrue(snapshot.unchanged(fpath))
+        self.assertEqual(snapshot.get_state(fpath, "key"), dict(foo="bar"))
+        self.assertIsNone(snapshot.get_state(fpath, "other"))
+        self.assertEqual((snapshot.hits, snapshot.misses), (1, 1))
+        # the contents of files aren't kept
+        self.assertNotIn("<Test/>", snapshot.files[fpath])
+
+        # a file whose mtime or size changed isn't restored
+        stat = os.stat(fpath)
+        os.utime(fpath, (stat.st_atime, stat.st_mtime - 10))
+        self.assertFalse(snapshot.unchanged(fpath))
+        self.assertIsNone(snapshot.get_state(fpath, "key"))
+        snapshot.set_state(fpath, os.stat(fpath), "key", dict(foo="bar"))
+        open(fpath, "w").write("<Test2/>")
+        self.assertIsNone(snapshot.get_state(fpath, "key"))
+
+        # a file that changes while it is read isn't restored
+        ondisk = os.stat(fpath)
+        open(fpath, "w").write("<Test3/>")
+        snapshot.set_state(fpath, ondisk, "key", dict(foo="bar"))
+        self.assertIsNone(snapshot.get_state(fpath, "key"))
+
+        # state that can't be pickled isn't saved
+        snapshot.set_state(fpath, os.stat(fpath), "key", lambda: None)
+        self.assertTrue(snapshot.save())
+        snapshot = RepositorySnapshot(spath)
+        self.assertTrue(snapshot.load())
+        self.assertEqual(snapshot.files, dict())
+
+        # corrupt snapshots are ignored
+        data = open(spath, "rb").read()
+        open(spath, "wb").write(data[:-1])
+        self.assertFalse(RepositorySnapshot(spath).load())
+
+    def test_preload(self):
+        spath = os.path.join(self.tmpdir, "repository.snapshot")
+        fpath = os.path.join(self.tmpdir, "test.xml")
+        open(fpath, "w").write("<Test/>")
+        snapshot = RepositorySnapshot(spath)
+        snapshot.set_state(fpath, os.stat(fpath), "key", dict(foo="bar"))
+
+        @patch("Bcfg2.Server.Plugin.snapshot", snapshot)
+        def inner():
+            # files whose state will be restored aren't read by the
+            # preloader
+            preloader = RepositoryPreloader()
+            preloader.load(fpath)
+            self.assertNotIn(fpath, preloader.files)
+            self.assertNotIn(fpath, preloader.xml)
+            stat = os.stat(fpath)
+            os.utime(fpath, (stat.st_atime, stat.st_mtime - 10))
+            preloader.load(fpath)
+            self.assertIn(fpath, preloader.files)
+            self.assertIn(fpath, preloader.xml)
+
+        inner()
+
+
+class TestPathDict(Bcfg2TestCase):
+    def test_subtree(self):
+        pdict = PathDict({"foo": 1, "foo/bar": 2, "foo.bak": 3})
+        pdict["foo/bar/baz"] = 4
+        pdict.setdefault("quux/foo", 5)
+        pdict.update({"foo/quux": 6})
+        self.assertItemsEqual(pdict.subtree("foo"),
+                              ["foo", "foo/bar", "foo/bar/baz", "foo/quux"])
+        self.assertItemsEqual(pdict.subtree("foo/bar/"),
+                              ["foo/bar", "foo/bar/baz"])
+        self.assertItemsEqual(pdict.subtree(""), pdict.keys())
+        self.assertEqual(pdict.subtree("fo"), [])
+
+        del pdict["foo/bar"]
+        self.assertEqual(pdict.pop("foo/quux"), 6)
+        self.assertEqual(pdict.pop("foo/quux", None), None)
+        self.assertItemsEqual(pdict.subtree("foo"), ["foo", "foo/bar/baz"])
+        pdict.clear()
+        self.assertEqual(pdict.subtree(""), [])
+
+
+class TestReverseDict(Bcfg2TestCase):
+    def test_reverse(self):
+        rdict = ReverseDict({1: "foo", 2: "bar"})
+        rdict[3] = "foo"
+        self.assertTrue(rdict.has_value("foo"))
+        self.assertItemsEqual(rdict.keys_for("foo"), [1, 3])
+        self.assertEqual(rdict.keys_for("baz"), [])
+
+        rdict[1] = "baz"
+        self.assertEqual(rdict.keys_for("foo"), [3])
+        self.assertEqual(rdict.keys_for("baz"), [1])
+        del rdict[3]
+        self.assertFalse(rdict.has_value("foo"))
+        self.assertEqual(rdict.pop(2), "bar")
+        self.assertFalse(rdict.has_value("bar"))
+        self.assertEqual(rdict, {1: "baz"})
+
+
 class TestFileBacked(Bcfg2TestCase):
     test_obj = FileBacked
     path = os.path.join(datastore, "test")
@@ -624,6 +971,25 @@ class TestDirectoryBacked(Bcfg2TestCase):
             self.assertEqual(db.entries[path].fam, db.fam)
             db.entries[path].HandleEvent.assert_called_with(event)
 
+    @patch("Bcfg2.Server.Plugin.prepare_file")
+    def test_PrepareEvent(self, mock_prepare_file):
+        db = self.get_obj()
+        db.handles = dict(self.testpaths)
+        for fname in self.testfiles:
+            mock_prepare_file.reset_mock()
+            db.PrepareEvent(Mock(requestID=5, filename=fname))
+            mock_prepare_file.assert_called_with(os.path.join(db.data,
+                                                              "quux", fname))
+
+        mock_prepare_file.reset_mock()
+        # events for the data directory itself and for unknown
+        # handles are not prepared
+        db.PrepareEvent(Mock(requestID=1, filename=db.data))
+        db.PrepareEvent(Mock(requestID=8, filename=self.testfiles[0]))
+        for fname in getattr(self, "badpaths", []):
+            db.PrepareEvent(Mock(requestID=5, filename=fname))
+        self.assertFalse(mock_prepare_file.called)
+
     @patch("os.path.isdir")
     @patch("Bcfg2.Server.Plugin.%s.add_entry" % test_obj.__name__)
     @patch("Bcfg2.Server.Plugin.%s.add_directory_monitor" % test_obj.__name__)
@@ -1473,6 +1839,64 @@ class TestXMLSrc(TestXMLFileBacked):
         self.assertEqual(xsrc.pnode, xsrc.__node__.return_value)
         self.assertEqual(xsrc.cache, None)
         
+    def test_HandleEvent_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(tmpdir, "foo.xml")
+            xdata = lxml.etree.Element("Test", priority="10")
+            lxml.etree.SubElement(xdata, "Package", name="foo")
+            open(fpath, "w").write(tostring(xdata))
+            spath = os.path.join(tmpdir, "repository.snapshot")
+            snapshot = RepositorySnapshot(spath)
+
+            @patch("Bcfg2.Server.Plugin.snapshot", snapshot)
+            def inner():
+                xsrc = self.get_obj(fpath)
+                xsrc.HandleEvent(Mock())
+                items = xsrc.items
+                self.assertEqual(items, dict(Package=["foo"]))
+                self.assertEqual((snapshot.hits, snapshot.misses), (0, 1))
+                self.assertTrue(snapshot.save())
+
+                # a new source (i.e., after a restart) restores the
+                # items and priority from the snapshot, and only
+                # reads and parses the file once the node tree is
+                # used
+                snapshot.files.clear()
+                self.assertTrue(snapshot.load())
+                xsrc = self.get_obj(fpath)
+                xsrc.__node__ = Mock(side_effect=xsrc.__node__)
+
+                @patch("Bcfg2.Server.Plugin.read_file")
+                def restore(mock_read_file):
+                    mock_read_file.side_effect = read_file
+                    xsrc.HandleEvent(Mock())
+                    self.assertFalse(mock_read_file.called)
+                    self.assertEqual(snapshot.hits, 1)
+                    self.assertEqual(xsrc.items, items)
+                    self.assertEqual(xsrc.priority, 10)
+                    self.assertFalse(xsrc.__node__.called)
+                    pnode = xsrc.pnode
+                    self.assertIsNotNone(pnode)
+                    mock_read_file.assert_called_once_with(fpath)
+                    self.assertEqual(xsrc.__node__.call_count, 1)
+                    self.assertIs(xsrc.pnode, pnode)
+                    self.assertEqual(xsrc.__node__.call_count, 1)
+
+                restore()
+
+                # a changed file is parsed again
+                xdata.set("priority", "200")
+                open(fpath, "w").write(tostring(xdata))
+                xsrc.HandleEvent(Mock())
+                self.assertEqual(xsrc.priority, 200)
+                self.assertEqual(xsrc.__node__.call_count, 2)
+                self.assertEqual(snapshot.misses, 2)
+
+            inner()
+        finally:
+            shutil.rmtree(tmpdir)
+
     @patch("Bcfg2.Server.Plugin.XMLSrc.HandleEvent")
     def test_Cache(self, mock_HandleEvent):
         xsrc = self.get_obj("/test/foo.xml")
@@ -1539,6 +1963,87 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
         
         inner()
 
+    @patch("Bcfg2.Server.Plugin.XMLDirectoryBacked.HandleEvent", Mock())
+    def test_Entries(self):
+        pd = self.get_obj()
+        test1 = Mock()
+        test1.items.items.return_value = [("Path", ["/etc/foo.conf"])]
+        pd.entries = {"/test1.xml": test1}
+        pd.BindEntry = Mock()
+
+        # the entries are only rebuilt when they are used after
+        # events have been handled
+        for i in range(3):
+            pd.HandleEvent(Mock())
+        self.assertFalse(test1.items.items.called)
+        self.assertEqual(pd.Entries, dict(Path={"/etc/foo.conf":
+                                                pd.BindEntry}))
+        self.assertEqual(pd.Entries, dict(Path={"/etc/foo.conf":
+                                                pd.BindEntry}))
+        self.assertEqual(test1.items.items.call_count, 1)
+
+        test2 = Mock()
+        test2.items = dict(Package=["quux"])
+        pd.entries["/test2.xml"] = test2
+        pd.HandleEvent(Mock())
+        self.assertItemsEqual(pd.Entries.keys(), ["Path", "Package"])
+
+    @patch("Bcfg2.Server.Plugin.XMLDirectoryBacked.HandleEvent", Mock())
+    def test_Entries_concurrent(self):
+        pd = self.get_obj()
+        pd.Entries = dict(Path={"/etc/old.conf": pd.BindEntry})
+        started = threading.Event()
+        release = threading.Event()
+
+        def items():
+            started.set()
+            release.wait(5)
+            return [("Path", ["/etc/foo.conf"])]
+
+        test1 = Mock()
+        test1.items.items.side_effect = items
+        pd.entries = {"/test1.xml": test1}
+        pd.HandleEvent(Mock())
+
+        # a build that uses the table while another is rebuilding it
+        # waits for the new table, rather than getting the old one
+        results = []
+
+        def get_entries():
+            results.append(pd.Entries)
+
+        first = threading.Thread(target=get_entries)
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=get_entries)
+        second.start()
+        second.join(0.1)
+        self.assertEqual(results, [])
+        release.set()
+        first.join(5)
+        second.join(5)
+        expected = dict(Path={"/etc/foo.conf": pd.BindEntry})
+        self.assertEqual(results, [expected, expected])
+        self.assertEqual(test1.items.items.call_count, 1)
+
+    def test_get_affected_entries(self):
+        pd = self.get_obj()
+        src = Mock()
+        src.items = dict(Path={"/etc/foo.conf": dict()},
+                         Package={"quux": dict()})
+        pd.entries = {"test1.xml": src}
+        entries = [("Path", "/etc/foo.conf"), ("Path", "/etc/bar.conf"),
+                   ("Package", "quux"), ("Service", "quux")]
+        self.assertItemsEqual(
+            pd.get_affected_entries(os.path.join(pd.data, "test1.xml"),
+                                    entries),
+            [("Path", "/etc/foo.conf"), ("Package", "quux")])
+        # deleted files can't bind anything
+        self.assertEqual(
+            pd.get_affected_entries(os.path.join(pd.data, "test2.xml"),
+                                    entries),
+            [])
+
     def test__matches(self):
         pd = self.get_obj()
         self.assertTrue(pd._matches(lxml.etree.Element("Test",
@@ -2216,6 +2721,25 @@ class TestGroupSpool(TestPlugin, TestGenerator):
                              gs.handles[event.requestID].rstrip('/'))
             mock_isdir.assert_called_with(mock_event_path.return_value)
 
+    def test_get_affected_entries(self):
+        gs = self.get_obj()
+        entries = [(gs.entry_type, "/etc/foo.conf"),
+                   (gs.entry_type, "/etc/bar.conf"),
+                   ("Service", "/etc/foo.conf")]
+        # a file in an entry set
+        self.assertItemsEqual(
+            gs.get_affected_entries(gs.data + "/etc/foo.conf/foo.conf.H_foo",
+                                    entries),
+            [(gs.entry_type, "/etc/foo.conf")])
+        # an entry set directory
+        self.assertItemsEqual(
+            gs.get_affected_entries(gs.data + "/etc/foo.conf", entries),
+            [(gs.entry_type, "/etc/foo.conf")])
+        self.assertEqual(
+            gs.get_affected_entries(gs.data + "/etc/baz.conf/baz.conf",
+                                    entries),
+            [])
+
     def test_toggle_debug(self):
         gs = self.get_obj()
         gs.entries = {"/foo": Mock(),
@@ -2235,10 +2759,10 @@ class TestGroupSpool(TestPlugin, TestGenerator):
 
     def test_HandleEvent(self):
         gs = self.get_obj()
-        gs.entries = {"/foo": Mock(),
-                      "/bar": Mock(),
-                      "/baz": Mock(),
-                      "/baz/quux": Mock()}
+        gs.entries = PathDict({"/foo": Mock(),
+                               "/bar": Mock(),
+                               "/baz": Mock(),
+                               "/baz/quux": Mock()})
         for path in gs.entries.keys():
             gs.Entries[gs.entry_type] = {path: Mock()}
         gs.handles = {1: "/foo/",
@@ -2282,6 +2806,7 @@ class TestGroupSpool(TestPlugin, TestGenerator):
 
         # test deleting directory
         reset()
+        gs.entries["/baz/quux/xyzzy"] = Mock()
         event = Mock()
         event.filename = "quux"
         event.requestID = 3
@@ -2291,6 +2816,8 @@ class TestGroupSpool(TestPlugin, TestGenerator):
         gs.event_id.assert_called_with(event)
         self.assertNotIn("/baz/quux", gs.entries)
         self.assertNotIn("/baz/quux", gs.Entries[gs.entry_type])
+        self.assertNotIn("/baz/quux/xyzzy", gs.entries)
+        self.assertIn("/baz", gs.entries)
 
 
 
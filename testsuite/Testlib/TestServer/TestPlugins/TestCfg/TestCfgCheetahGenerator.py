@@ -0,0 +1,115 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch
+import Bcfg2.Server.Plugins.Cfg
+import Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator
+from Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+def compile_template(source, returnAClass=True, moduleName=None,
+                     className=None, compilerSettings=None):
+    """ stand-in for Template.compile that returns the source of a
+    module with a template class that returns the template source """
+    return "class %s(object):\n    def respond(self):\n        return %r\n" % \
+        (className, source)
+
+
+class TestCfgCheetahGenerator(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        Bcfg2.Server.Plugins.Cfg.SETUP = dict(cheetah_cache=self.cachedir)
+        Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator._cached_modules.clear()
+        Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator._pruned.clear()
+
+    def tearDown(self):
+        Bcfg2.Server.Plugins.Cfg.SETUP = None
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self, name="foo.cheetah", source="foo"):
+        fname = os.path.join(self.tmpdir, name)
+        self.write(fname, source)
+        cgg = CfgCheetahGenerator(fname, None, "UTF-8")
+        cgg.handle_event(Mock())
+        return cgg
+
+    def write(self, fname, data):
+        fd = open(fname, "w")
+        fd.write(data)
+        fd.close()
+
+    def cached(self):
+        return sorted([f for f in os.listdir(self.cachedir)
+                       if f.endswith(".py")])
+
+    @skipUnless(have_cheetah, "Cheetah not found, skipping")
+    @patchIf(have_cheetah, "Cheetah.Template.Template.compile")
+    def test_template_cache(self, mock_compile):
+        mock_compile.side_effect = compile_template
+        cgg = self.get_obj()
+        self.assertEqual(cgg.get_template_cls()().respond(), "foo")
+        self.assertEqual(mock_compile.call_count, 1)
+        self.assertEqual(len(self.cached()), 1)
+
+        # the class is only compiled once
+        cgg.get_template_cls()
+        self.assertEqual(mock_compile.call_count, 1)
+
+        # a new generator (e.g., after a restart) loads the module
+        # from the cache
+        cgg = self.get_obj()
+        self.assertEqual(cgg.get_template_cls()().respond(), "foo")
+        self.assertEqual(mock_compile.call_count, 1)
+
+        # a template with the same source shares the cached module
+        bar = self.get_obj("bar.cheetah", "foo")
+        bar.get_template_cls()
+        self.assertEqual(mock_compile.call_count, 1)
+
+        # changing a template compiles it again, and removes the
+        # cached module of the old version once nothing uses it
+        self.write(cgg.name, "foo2")
+        cgg.handle_event(Mock())
+        self.assertEqual(cgg.get_template_cls()().respond(), "foo2")
+        self.assertEqual(mock_compile.call_count, 2)
+        self.assertEqual(len(self.cached()), 2)
+
+        self.write(bar.name, "bar")
+        bar.handle_event(Mock())
+        self.assertEqual(len(self.cached()), 1)
+        bar.get_template_cls()
+        self.assertEqual(mock_compile.call_count, 3)
+        self.assertEqual(len(self.cached()), 2)
+
+    @skipUnless(have_cheetah, "Cheetah not found, skipping")
+    @patchIf(have_cheetah, "Cheetah.Template.Template.compile")
+    def test_prune_cache(self, mock_compile):
+        mock_compile.side_effect = compile_template
+        cgg = self.get_obj()
+        cgg.get_template_cls()
+        cached = self.cached()
+
+        # modules of templates that changed while the server was
+        # down are removed the first time a template is loaded
+        self.write(os.path.join(self.cachedir, "cheetah_stale.py"), "")
+        Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator._cached_modules.clear()
+        Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator._pruned.clear()
+        cgg = self.get_obj()
+        cgg.get_template_cls()
+        self.assertEqual(self.cached(), cached)
+        self.assertEqual(mock_compile.call_count, 1)
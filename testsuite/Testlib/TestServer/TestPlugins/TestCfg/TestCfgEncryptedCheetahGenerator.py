@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch
+import Bcfg2.Server.Plugins.Cfg
+from Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator import have_cheetah
+from Bcfg2.Server.Plugins.Cfg.CfgEncryptedCheetahGenerator import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+from TestCfgCheetahGenerator import compile_template
+
+
+def compile_class(source, className=None, compilerSettings=None):
+    """ stand-in for Template.compile that returns a template class
+    that returns the template source """
+    namespace = dict()
+    exec(compile_template(source, className=className), namespace)
+    return namespace[className]
+
+
+class TestCfgEncryptedCheetahGenerator(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        Bcfg2.Server.Plugins.Cfg.SETUP = dict(cheetah_cache=self.cachedir)
+
+    def tearDown(self):
+        Bcfg2.Server.Plugins.Cfg.SETUP = None
+        shutil.rmtree(self.tmpdir)
+
+    @skipUnless(have_cheetah, "Cheetah not found, skipping")
+    @patchIf(have_cheetah, "Cheetah.Template.Template.compile")
+    @patch("Bcfg2.Server.Plugins.Cfg.CfgEncryptedGenerator.have_crypto",
+           True)
+    @patch("Bcfg2.Server.Plugins.Cfg.CfgEncryptedGenerator.decrypt")
+    def test_template_cache(self, mock_decrypt, mock_compile):
+        mock_compile.side_effect = compile_class
+        mock_decrypt.return_value = "secret".encode("UTF-8")
+        fname = os.path.join(self.tmpdir, "foo.cheetah.crypt")
+        open(fname, "w").write("crypted")
+        cecg = CfgEncryptedCheetahGenerator(fname, None, "UTF-8")
+        cecg.handle_event(Mock())
+        self.assertEqual(cecg.get_data(Mock(), Mock()), "secret")
+        cecg.get_data(Mock(), Mock())
+        self.assertEqual(mock_compile.call_count, 1)
+
+        # the decrypted template is never written to the cache
+        self.assertFalse(os.path.exists(self.cachedir) and
+                         os.listdir(self.cachedir))
+        self.assertNotIn(
+            fname,
+            Bcfg2.Server.Plugins.Cfg.CfgCheetahGenerator._cached_modules)
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.Plugins.Cfg import CfgVerificationError
+from Bcfg2.Server.Plugins.Cfg.CfgExternalCommandVerifier import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestCfgExternalCommandVerifier(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        fname = os.path.join(self.tmpdir, ":test")
+        open(fname, "w").write("#!/bin/sh\ncat >/dev/null\n")
+        os.chmod(fname, 493)  # 0755
+        ecv = CfgExternalCommandVerifier(fname, None, "UTF-8")
+        ecv.handle_event(Mock())
+        return ecv
+
+    def test_verify_entry(self):
+        ecv = self.get_obj()
+        self.assertEqual(ecv.cmd, [ecv.name])
+        ecv._run = Mock()
+        ecv._run.side_effect = lambda data: (int(data == "bad"), "error")
+        entry = Mock()
+        metadata = Mock()
+
+        ecv.verify_entry(entry, metadata, "good")
+        ecv.verify_entry(entry, metadata, "good")
+        ecv._run.assert_called_once_with("good")
+
+        # failures are remembered too
+        ecv._run.reset_mock()
+        self.assertRaises(CfgVerificationError,
+                          ecv.verify_entry, entry, metadata, "bad")
+        self.assertRaises(CfgVerificationError,
+                          ecv.verify_entry, entry, metadata, "bad")
+        ecv._run.assert_called_once_with("bad")
+
+        # changing the :test file forgets the results of the old one
+        ecv._run.reset_mock()
+        ecv.handle_event(Mock())
+        ecv.verify_entry(entry, metadata, "good")
+        ecv._run.assert_called_once_with("good")
+
+    def test_run(self):
+        ecv = self.get_obj()
+        self.assertEqual(ecv._run("foo"), (0, ""))
+
+    def test_verify_entry_concurrent(self):
+        ecv = self.get_obj()
+        release = threading.Event()
+
+        def run(data):
+            release.wait(5)
+            return (0, "")
+
+        ecv._run = Mock()
+        ecv._run.side_effect = run
+        threads = [threading.Thread(target=ecv.verify_entry,
+                                    args=(Mock(), Mock(), "data"))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        # give the threads a chance to start verifying before the
+        # first verification finishes
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # identical concurrent verifications run the command only once
+        ecv._run.assert_called_once_with("data")
+        self.assertEqual(ecv.running, dict())
@@ -0,0 +1,92 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.Plugins.Ohai import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestOhaiCache(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        cache = OhaiCache(self.tmpdir, size=1)
+        self.assertNotIn("foo", cache)
+        self.assertRaises(KeyError, cache.__getitem__, "foo")
+
+        cache["foo"] = '{"platform": "centos"}'
+        cache["bar"] = '{"platform": "debian"}'
+        self.assertItemsEqual(list(cache), ["foo", "bar"])
+        self.assertEqual(cache["foo"], dict(platform="centos"))
+        self.assertEqual(cache["bar"], dict(platform="debian"))
+
+        # uploads aren't parsed into the cache; data is only parsed
+        # when it is used
+        cache["baz"] = '{"platform": "gentoo"}'
+        self.assertItemsEqual(cache.cache.keys(), ["bar"])
+        self.assertEqual(cache["baz"], dict(platform="gentoo"))
+
+        # an unchanged upload isn't parsed at all, and a changed one
+        # replaces the parsed data
+        @patch("Bcfg2.Server.Plugins.Ohai.json.loads")
+        def inner(mock_loads):
+            cache["baz"] = '{"platform": "gentoo"}'
+            self.assertFalse(mock_loads.called)
+
+        inner()
+        cache["baz"] = '{"platform": "arch"}'
+        self.assertNotIn("baz", cache.cache)
+        self.assertEqual(cache["baz"], dict(platform="arch"))
+
+        # data on disk is found by a new cache
+        cache = OhaiCache(self.tmpdir)
+        self.assertEqual(cache["foo"], dict(platform="centos"))
+
+    @patch("Bcfg2.Server.Plugins.Ohai.logger", Mock())
+    def test_invalid_json(self):
+        cache = OhaiCache(self.tmpdir)
+        cache["foo"] = '{"platform": "centos"}'
+
+        # bad data from the client doesn't replace the last good data
+        cache["foo"] = '{"platform": '
+        self.assertEqual(cache["foo"], dict(platform="centos"))
+        self.assertEqual(open(os.path.join(self.tmpdir, "foo.json")).read(),
+                         '{"platform": "centos"}')
+        cache = OhaiCache(self.tmpdir)
+        self.assertEqual(cache["foo"], dict(platform="centos"))
+
+        # bad data on disk is treated like no data at all
+        open(os.path.join(self.tmpdir, "bar.json"), "w").write("{")
+        cache = OhaiCache(self.tmpdir)
+        self.assertIn("bar", cache)
+        self.assertRaises(KeyError, cache.__getitem__, "bar")
+        self.assertEqual(dict(OhaiData(cache, "bar")), dict())
+
+
+class TestOhaiData(Bcfg2TestCase):
+    def test_lazy(self):
+        cache = MagicMock()
+        cache.__getitem__.return_value = dict(platform="centos")
+        data = OhaiData(cache, "foo")
+        self.assertFalse(cache.__getitem__.called)
+        self.assertEqual(data["platform"], "centos")
+        self.assertIn("platform", data)
+        self.assertEqual(len(data), 1)
+        cache.__getitem__.assert_called_once_with("foo")
@@ -0,0 +1,147 @@
+import os
+import sys
+import lxml.etree
+import Bcfg2.Server.Plugin
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.Plugins.Properties import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+def get_metadata(hostname, groups):
+    metadata = Mock()
+    metadata.hostname = hostname
+    metadata.groups = set(groups)
+    return metadata
+
+
+class TestPropertyFile(Bcfg2TestCase):
+    test_obj = PropertyFile
+    path = os.path.join(datastore, "test.xml")
+
+    def get_obj(self, data):
+        pf = self.test_obj(self.path)
+        pf.data = data
+        pf.Index()
+        return pf
+
+    @patch("Bcfg2.Server.Plugin.StructFile.XMLMatch")
+    def test_XMLMatch(self, mock_XMLMatch):
+        mock_XMLMatch.side_effect = \
+            lambda pf, metadata: lxml.etree.Element("Test",
+                                                    client=metadata.hostname)
+        pf = self.get_obj("""<Properties>
+  <Group name="group1"><Foo/></Group>
+  <Client name="foo.example.com"><Bar/></Client>
+</Properties>""")
+        self.assertItemsEqual(pf.groups, ["group1"])
+        self.assertItemsEqual(pf.clients, ["foo.example.com"])
+
+        # clients that only differ in groups and names that the file
+        # doesn't use share a filtered view
+        rv1 = pf.XMLMatch(get_metadata("bar.example.com",
+                                       ["group1", "group2"]))
+        rv2 = pf.XMLMatch(get_metadata("baz.example.com",
+                                       ["group1", "group3"]))
+        self.assertEqual(mock_XMLMatch.call_count, 1)
+        self.assertEqual(rv1.get("client"), "bar.example.com")
+        self.assertEqual(rv2.get("client"), "bar.example.com")
+        # each caller gets its own copy of the view
+        self.assertIsNot(rv1, rv2)
+        rv1.set("client", "modified")
+        self.assertEqual(pf.XMLMatch(get_metadata("baz.example.com",
+                                                  ["group1"])).get("client"),
+                         "bar.example.com")
+
+        # different relevant groups or a client named in the file get
+        # different views
+        pf.XMLMatch(get_metadata("bar.example.com", ["group2"]))
+        self.assertEqual(mock_XMLMatch.call_count, 2)
+        rv = pf.XMLMatch(get_metadata("foo.example.com", ["group1"]))
+        self.assertEqual(rv.get("client"), "foo.example.com")
+        self.assertEqual(mock_XMLMatch.call_count, 3)
+
+        # the views are discarded when the file changes
+        pf.data = \
+            "<Properties><Group name='group1'><Foo/></Group></Properties>"
+        pf.Index()
+        self.assertItemsEqual(pf.clients, [])
+        rv = pf.XMLMatch(get_metadata("baz.example.com", ["group1"]))
+        self.assertEqual(rv.get("client"), "baz.example.com")
+        self.assertEqual(mock_XMLMatch.call_count, 4)
+
+    def test_XMLMatch_content(self):
+        pf = self.get_obj("""<Properties>
+  <Group name="group1"><Foo/></Group>
+  <Group name="group1" negate="true"><Bar/></Group>
+</Properties>""")
+        rv = pf.XMLMatch(get_metadata("foo.example.com", ["group1"]))
+        self.assertEqual([c.tag for c in rv], ["Foo"])
+        pf.data = \
+            "<Properties><Group name='group1'><Baz/></Group></Properties>"
+        pf.Index()
+        rv = pf.XMLMatch(get_metadata("foo.example.com", ["group1"]))
+        self.assertEqual([c.tag for c in rv], ["Baz"])
+
+
+class TestLazyProperties(Bcfg2TestCase):
+    @patch("Bcfg2.Server.Dependencies.record_path")
+    def test_lazy(self, mock_record_path):
+        metadata = Mock()
+        auto = Mock()
+        plain = Mock()
+        lp = LazyProperties(metadata, data="/test/Properties")
+        lp.add_match("auto.xml", auto)
+        lp["plain.xml"] = plain
+
+        self.assertItemsEqual(lp.keys(), ["auto.xml", "plain.xml"])
+        self.assertEqual(len(lp), 2)
+        self.assertIn("auto.xml", lp)
+        # views aren't built until they're accessed
+        self.assertFalse(auto.XMLMatch.called)
+
+        self.assertEqual(lp["auto.xml"], auto.XMLMatch.return_value)
+        self.assertEqual(lp["auto.xml"], auto.XMLMatch.return_value)
+        auto.XMLMatch.assert_called_once_with(metadata)
+        self.assertEqual(lp["plain.xml"], plain)
+        mock_record_path.assert_called_with("/test/Properties/plain.xml")
+        self.assertRaises(KeyError, lp.__getitem__, "bogus.xml")
+
+        del lp["auto.xml"]
+        self.assertNotIn("auto.xml", lp)
+        self.assertEqual(len(lp), 1)
+
+
+class TestProperties(Bcfg2TestCase):
+    def test_get_additional_data(self):
+        core = Mock()
+        core.setup.cfp.getboolean.return_value = False
+        auto = Mock()
+        auto.xdata = lxml.etree.Element("Properties", automatch="true")
+        plain = Mock()
+        plain.xdata = lxml.etree.Element("Properties")
+
+        @patch("Bcfg2.Server.Plugins.Properties.PropDirectoryBacked")
+        def inner(mock_PropDirectoryBacked):
+            return Properties(core, datastore)
+
+        props = inner()
+        props.store.entries = {"auto.xml": auto, "plain.xml": plain}
+        metadata = Mock()
+        rv = props.get_additional_data(metadata)
+        self.assertItemsEqual(rv.keys(), ["auto.xml", "plain.xml"])
+        self.assertFalse(auto.XMLMatch.called)
+        rv["auto.xml"]
+        auto.XMLMatch.assert_called_once_with(metadata)
+        self.assertFalse(plain.XMLMatch.called)
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import Bcfg2.Server.Plugin
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+try:
+    from Bcfg2.Server.Plugins.PuppetENC import *
+    has_yaml = True
+except ImportError:
+    has_yaml = False
+
+
+class TestPuppetENC(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self, ttl="60", encs=None):
+        if encs is None:
+            encs = ["enc1"]
+        core = Mock()
+        core.setup.cfp.get.return_value = ttl
+
+        @patch("Bcfg2.Server.Plugin.DirectoryBacked.__init__", Mock())
+        def inner():
+            return PuppetENC(core, datastore)
+
+        penc = inner()
+        penc.data = self.tmpdir
+        penc.entries = dict()
+        for enc in encs:
+            open(os.path.join(self.tmpdir, enc), "w").close()
+            penc.entries[enc] = Mock()
+        penc._run_enc = Mock()
+        penc._run_enc.side_effect = \
+            lambda enc, hostname: dict(groups=["%s-%s" % (enc, hostname)])
+        return penc
+
+    def wait_for_refresh(self, penc):
+        for i in range(50):
+            if not penc.refreshing:
+                return
+            time.sleep(0.1)
+
+    @skipUnless(has_yaml, "YAML libraries not found, skipping")
+    def test__get_enc(self):
+        penc = self.get_obj()
+        self.assertEqual(penc._get_enc("enc1", "foo"),
+                         dict(groups=["enc1-foo"]))
+        self.assertEqual(penc._get_enc("enc1", "foo"),
+                         dict(groups=["enc1-foo"]))
+        penc._run_enc.assert_called_once_with("enc1", "foo")
+        self.assertEqual(penc.refreshing, set())
+
+        # results are cached per client
+        penc._get_enc("enc1", "bar")
+        self.assertEqual(penc._run_enc.call_count, 2)
+
+        # changing the ENC invalidates its results
+        penc._run_enc.reset_mock()
+        os.utime(os.path.join(self.tmpdir, "enc1"),
+                 (time.time() + 10, time.time() + 10))
+        penc._get_enc("enc1", "foo")
+        penc._run_enc.assert_called_once_with("enc1", "foo")
+
+        # expired results are refreshed before they are returned
+        penc._run_enc.reset_mock()
+        mtime, _, yaml = penc.results[("enc1", "foo")]
+        penc.results[("enc1", "foo")] = (mtime, time.time() - 120, yaml)
+        penc._get_enc("enc1", "foo")
+        penc._run_enc.assert_called_once_with("enc1", "foo")
+
+    @skipUnless(has_yaml, "YAML libraries not found, skipping")
+    def test__get_enc_no_cache(self):
+        penc = self.get_obj(ttl="0")
+        penc._get_enc("enc1", "foo")
+        penc._get_enc("enc1", "foo")
+        self.assertEqual(penc._run_enc.call_count, 2)
+        self.assertEqual(len(penc.results), 0)
+
+    @skipUnless(has_yaml, "YAML libraries not found, skipping")
+    def test__get_enc_background_refresh(self):
+        penc = self.get_obj()
+        penc._get_enc("enc1", "foo")
+        mtime = penc.results[("enc1", "foo")][0]
+
+        # a result that is nearly expired is returned from the cache,
+        # and refreshed in the background
+        penc.results[("enc1", "foo")] = (mtime, time.time() - 50,
+                                         dict(groups=["old"]))
+        self.assertEqual(penc._get_enc("enc1", "foo"), dict(groups=["old"]))
+        self.wait_for_refresh(penc)
+        self.assertEqual(penc._run_enc.call_count, 2)
+        self.assertEqual(penc.results[("enc1", "foo")][2],
+                         dict(groups=["enc1-foo"]))
+        self.assertEqual(penc._get_enc("enc1", "foo"),
+                         dict(groups=["enc1-foo"]))
+        self.assertEqual(penc._run_enc.call_count, 2)
+
+        # if the background refresh fails, the stale result is kept
+        # until it expires
+        penc._run_enc.side_effect = \
+            Bcfg2.Server.Plugin.PluginExecutionError
+        penc.results[("enc1", "foo")] = (mtime, time.time() - 50,
+                                         dict(groups=["old"]))
+        self.assertEqual(penc._get_enc("enc1", "foo"), dict(groups=["old"]))
+        self.wait_for_refresh(penc)
+        self.assertEqual(penc._run_enc.call_count, 3)
+        self.assertEqual(penc._get_enc("enc1", "foo"), dict(groups=["old"]))
+        self.wait_for_refresh(penc)
+
+        # once it has expired, the failure is raised
+        penc.results[("enc1", "foo")] = (mtime, time.time() - 120,
+                                         dict(groups=["old"]))
+        self.assertRaises(Bcfg2.Server.Plugin.PluginExecutionError,
+                          penc._get_enc, "enc1", "foo")
+        self.assertEqual(penc.refreshing, set())
+
+    @skipUnless(has_yaml, "YAML libraries not found, skipping")
+    def test__run_encs(self):
+        penc = self.get_obj(encs=["enc1", "enc2"])
+        metadata = Mock()
+        metadata.hostname = "foo"
+        self.assertItemsEqual(penc.get_additional_groups(metadata),
+                              ["enc1-foo", "enc2-foo"])
+        self.assertEqual(penc.get_additional_data(metadata), dict())
+        self.assertEqual(penc._run_enc.call_count, 2)
+
+        # the per-run cache is cleared at the end of the run, but the
+        # ENC results are kept
+        penc.end_client_run(metadata)
+        penc.get_additional_groups(metadata)
+        self.assertEqual(penc._run_enc.call_count, 2)
+
+        # an ENC failing fails the client run
+        penc.end_client_run(metadata)
+        penc.results.clear()
+        penc._run_enc.side_effect = \
+            Bcfg2.Server.Plugin.PluginExecutionError
+        self.assertRaises(Bcfg2.Server.Plugin.PluginExecutionError,
+                          penc.get_additional_groups, metadata)
@@ -0,0 +1,131 @@
+import os
+import sys
+import lxml.etree
+import Bcfg2.Server.Plugin
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.Plugins.Rules import *
+from Bcfg2.Server.Plugins.Defaults import Defaults
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestRules(Bcfg2TestCase):
+    test_obj = Rules
+
+    def get_obj(self, regex=False, rules=None):
+        core = Mock()
+        core.setup.cfp.getboolean.return_value = regex
+
+        @patch("Bcfg2.Server.Plugin.PrioDir.add_directory_monitor", Mock())
+        def inner():
+            return self.test_obj(core, datastore)
+
+        rv = inner()
+        if rules is not None:
+            self.set_rules(rv, rules)
+        return rv
+
+    def set_rules(self, rules, items):
+        src = Mock()
+        src.items = items
+        rules.entries = {"rules.xml": src}
+        rules._reset_index()
+
+    def test__matching_rules(self):
+        rules = self.get_obj(rules=dict(Path=["/etc/foo.conf", "/etc/bar/",
+                                              "/etc/baz.*"],
+                                        Service=["foo"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/foo.conf"),
+                         set(["/etc/foo.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/bar"),
+                         set(["/etc/bar/"]))
+        self.assertEqual(rules._matching_rules("Service", "foo"),
+                         set(["foo"]))
+        self.assertEqual(rules._matching_rules("Package", "foo"), set())
+
+        # regex matching is off unless it is enabled in the config
+        self.assertEqual(rules._matching_rules("Path", "/etc/baz.conf"),
+                         set())
+        rules.core.setup.cfp.getboolean.assert_called_with("rules", "regex",
+                                                           default=False)
+
+        # the index is rebuilt after the rules change
+        self.set_rules(rules, dict(Path=["/etc/baz.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/baz.conf"),
+                         set(["/etc/baz.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/foo.conf"),
+                         set())
+
+    def test__matching_rules_regex(self):
+        names = ["/etc/foo%d\\.conf" % i for i in range(120)]
+        names.extend(["/etc/bar.*",
+                      # backreferences
+                      "/etc/(\\w+)/\\1\\.conf",
+                      "/srv/(\\w+)/\\1\\.conf",
+                      "/var/(?P<dir>\\w+)/(?P=dir)\\.log",
+                      # an invalid regex
+                      "/etc/[baz"])
+        rules = self.get_obj(regex=True, rules=dict(Path=names))
+        rules.logger = Mock()
+        self.assertEqual(rules._matching_rules("Path", "/etc/foo7.conf"),
+                         set(["/etc/foo7\\.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/foo119.conf"),
+                         set(["/etc/foo119\\.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/bar.conf"),
+                         set(["/etc/bar.*"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/sudo/sudo.conf"),
+                         set(["/etc/(\\w+)/\\1\\.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/sudo/ssh.conf"),
+                         set())
+        self.assertEqual(rules._matching_rules("Path", "/srv/www/www.conf"),
+                         set(["/srv/(\\w+)/\\1\\.conf"]))
+        self.assertEqual(rules._matching_rules("Path", "/var/log/log.log"),
+                         set(["/var/(?P<dir>\\w+)/(?P=dir)\\.log"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/foo.conf"),
+                         set())
+        self.assertTrue(rules.logger.error.called)
+
+        # rules without groups are combined into chunks, and rules
+        # with groups are tested alone
+        chunks = rules._build_index()["Path"][1]
+        self.assertEqual(len([c for c in chunks if len(c[1]) > 1]), 3)
+        self.assertItemsEqual([c[1][0] for c in chunks if len(c[1]) == 1],
+                              ["/etc/(\\w+)/\\1\\.conf",
+                               "/srv/(\\w+)/\\1\\.conf",
+                               "/var/(?P<dir>\\w+)/(?P=dir)\\.log"])
+
+    def test_HandlesEntry(self):
+        rules = self.get_obj(rules=dict(Path=["/etc/foo.conf"]))
+        rules.Entries = dict(Path=dict())
+        self.assertTrue(rules.HandlesEntry(
+            lxml.etree.Element("Path", name="/etc/foo.conf"), Mock()))
+        self.assertFalse(rules.HandlesEntry(
+            lxml.etree.Element("Path", name="/etc/bar.conf"), Mock()))
+        self.assertFalse(rules.HandlesEntry(
+            lxml.etree.Element("Service", name="/etc/foo.conf"), Mock()))
+
+
+class TestDefaults(TestRules):
+    test_obj = Defaults
+
+    def test__matching_rules(self):
+        # Defaults always uses regex matching
+        rules = self.get_obj(rules=dict(Path=["/etc/baz.*"]))
+        self.assertEqual(rules._matching_rules("Path", "/etc/baz.conf"),
+                         set(["/etc/baz.*"]))
+
+    def test_HandlesEntry(self):
+        rules = self.get_obj(rules=dict(Path=["/etc/foo.conf"]))
+        self.assertFalse(rules.HandlesEntry(
+            lxml.etree.Element("Path", name="/etc/foo.conf"), Mock()))
@@ -0,0 +1,153 @@
+import os
+import sys
+import shutil
+import tempfile
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Server.Plugins.Statistics import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestStatisticsStore(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "statistics.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self):
+        store = StatisticsStore(self.filename)
+        store.logger = Mock()
+        return store
+
+    def get_stats(self, state="clean"):
+        stats = lxml.etree.Element("Upload")
+        lxml.etree.SubElement(stats, "Statistics", state=state)
+        return stats
+
+    def count(self, store, client):
+        return len(store.nodes[client].findall("Statistics"))
+
+    def test_journal(self):
+        store = self.get_obj()
+        store.WriteBack(force=1)
+        store.updateStats(self.get_stats(), "foo")
+        store.updateStats(self.get_stats("dirty"), "bar")
+        store.updateStats(self.get_stats("dirty"), "foo")
+        # the statistics file isn't rewritten for every upload; the
+        # new statistics are in the journal instead
+        self.assertTrue(store.dirty)
+        self.assertTrue(os.path.exists(store.journal))
+        self.assertEqual(
+            lxml.etree.parse(self.filename).getroot().findall("Node"), [])
+
+        # a new store replays the journal, and writes the replayed
+        # statistics out
+        store = self.get_obj()
+        self.assertItemsEqual(store.nodes.keys(), ["foo", "bar"])
+        self.assertEqual(self.count(store, "foo"), 2)
+        self.assertEqual(self.count(store, "bar"), 1)
+        self.assertFalse(os.path.exists(store.journal))
+        self.assertEqual(
+            len(lxml.etree.parse(self.filename).getroot().findall("Node")), 2)
+
+        store = self.get_obj()
+        self.assertEqual(self.count(store, "foo"), 2)
+
+    def test_deferred_write(self):
+        store = self.get_obj()
+        store.WriteBack(force=1)
+        store.updateStats(self.get_stats(), "foo")
+        # nothing is written until the minimum write delay has passed
+        store.WriteBack()
+        self.assertTrue(store.dirty)
+        self.assertEqual(
+            lxml.etree.parse(self.filename).getroot().findall("Node"), [])
+
+        store.lastwrite -= store.__min_write_delay__
+        store.WriteBack()
+        self.assertFalse(store.dirty)
+        self.assertFalse(os.path.exists(store.journal))
+        self.assertEqual(
+            len(lxml.etree.parse(self.filename).getroot().findall("Node")), 1)
+
+    def test_journal_truncated(self):
+        store = self.get_obj()
+        store.WriteBack(force=1)
+        store.updateStats(self.get_stats(), "foo")
+        store.updateStats(self.get_stats(), "bar")
+        # the server died while writing the last entry
+        data = open(store.journal).read()
+        open(store.journal, "w").write(
+            data[:data.rindex("<Statistics") + 15])
+
+        store = self.get_obj()
+        self.assertItemsEqual(store.nodes.keys(), ["foo"])
+
+    def test_journal_checkpoint(self):
+        store = self.get_obj()
+        store.WriteBack(force=1)
+        store.updateStats(self.get_stats(), "foo")
+
+        # the server dies after writing the statistics file, but
+        # before the journal is removed
+        @patch("os.unlink")
+        def inner(mock_unlink):
+            mock_unlink.side_effect = OSError
+            store.WriteBack(force=1)
+
+        inner()
+        self.assertTrue(os.path.exists(store.journal))
+        store.updateStats(self.get_stats("dirty"), "foo")
+
+        # only the entry that wasn't written out is replayed
+        store = self.get_obj()
+        self.assertEqual(self.count(store, "foo"), 2)
+        self.assertFalse(os.path.exists(store.journal))
+
+        store.updateStats(self.get_stats(), "bar")
+        store = self.get_obj()
+        self.assertEqual(self.count(store, "foo"), 2)
+        self.assertEqual(self.count(store, "bar"), 1)
+
+    def test_nodes(self):
+        open(self.filename, "w").write(
+            "<ConfigStatistics><Node name='foo'/><Node name='bar'/>"
+            "<Node name='foo'/></ConfigStatistics>")
+        store = self.get_obj()
+        self.assertItemsEqual(store.nodes.keys(), ["foo", "bar"])
+        self.assertIs(store.nodes["foo"], store.element.findall("Node")[0])
+
+        store.updateStats(self.get_stats(), "baz")
+        self.assertIs(store.nodes["baz"], store.element.findall("Node")[-1])
+        self.assertEqual(self.count(store, "baz"), 1)
+        store.updateStats(self.get_stats(), "foo")
+        self.assertEqual(self.count(store, "foo"), 1)
+        self.assertEqual(len(store.element.findall("Node")), 4)
+
+
+class TestStatistics(Bcfg2TestCase):
+    @patch("threading.Thread.start", Mock())
+    @patch("Bcfg2.Server.Plugin.ThreadedStatistics._recover_journal",
+           Mock(return_value=[]))
+    @patch("Bcfg2.Server.Plugins.Statistics.StatisticsStore")
+    def test_handle_idle(self, mock_StatisticsStore):
+        core = Mock()
+        stats = Statistics(core, datastore)
+        # deferred statistics are written out while the server is
+        # idle, not only when the next client reports
+        stats.handle_idle()
+        stats.data_file.WriteBack.assert_called_with()
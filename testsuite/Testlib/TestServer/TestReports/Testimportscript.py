@@ -0,0 +1,230 @@
+import os
+import sys
+import lxml.etree
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+try:
+    from Bcfg2.Server.Reports import importscript
+    has_django = True
+except ImportError:
+    has_django = False
+
+
+def get_model(existing):
+    """ get a mock model whose table contains the given ids """
+    model = Mock()
+    model.__name__ = "Group"
+
+    def filter(id__in=None):
+        rv = Mock()
+        rv.values_list.return_value = [i for i in id__in if i in existing]
+        return rv
+
+    model.objects.filter.side_effect = filter
+    return model
+
+
+class TestCaches(Bcfg2TestCase):
+    @skipUnless(has_django, "Django not found, skipping")
+    def setUp(self):
+        importscript.clear_caches()
+
+    def tearDown(self):
+        if has_django:
+            importscript.clear_caches()
+
+    def test__verify_cache(self):
+        model = get_model([1, 3])
+        cache = dict(foo=1, bar=2, baz=3, quux=4)
+        importscript._verify_cache(model, cache, ["foo", "bar", "baz", "xyz"])
+        # only ids for the given keys are checked
+        self.assertEqual(cache, dict(foo=1, baz=3, quux=4))
+        self.assertEqual(model.objects.filter.call_count, 1)
+        self.assertItemsEqual(
+            model.objects.filter.call_args[1]['id__in'], [1, 2, 3])
+
+        # nothing is queried if none of the keys are cached
+        model.objects.filter.reset_mock()
+        importscript._verify_cache(model, cache, ["bar", "xyz"])
+        self.assertFalse(model.objects.filter.called)
+
+    def test__verify_cache_chunks(self):
+        model = get_model(range(0, 1200, 2))
+        cache = dict([(i, i) for i in range(1200)])
+        importscript._verify_cache(model, cache, list(cache.keys()))
+        self.assertEqual(model.objects.filter.call_count, 3)
+        self.assertItemsEqual(cache.keys(), range(0, 1200, 2))
+
+    def test__verify_cache_lru(self):
+        model = get_model([1])
+        cache = importscript.LRUCache(10)
+        cache["foo"] = 1
+        cache["bar"] = 2
+        importscript._verify_cache(model, cache, ["foo", "bar"])
+        self.assertItemsEqual(cache.keys(), ["foo"])
+
+    def test__fetch_named(self):
+        model = get_model([])
+        created = []
+
+        def get_or_create(name=None):
+            created.append(name)
+            obj = Mock()
+            obj.id = len(created)
+            return (obj, True)
+
+        model.objects.get_or_create.side_effect = get_or_create
+        cache = dict()
+        logger = Mock()
+        self.assertEqual(
+            importscript._fetch_named(model, cache, ["foo", "bar"], logger),
+            [1, 2])
+        self.assertEqual(cache, dict(foo=1, bar=2))
+
+        # cached names are only verified, not looked up again
+        model = get_model([1, 2])
+        model.objects.get_or_create.side_effect = get_or_create
+        self.assertEqual(
+            importscript._fetch_named(model, cache, ["bar", "foo"], logger),
+            [2, 1])
+        self.assertEqual(created, ["foo", "bar"])
+
+        # names whose rows were deleted are created again
+        model = get_model([2])
+        model.objects.get_or_create.side_effect = get_or_create
+        self.assertEqual(
+            importscript._fetch_named(model, cache, ["foo", "bar"], logger),
+            [3, 2])
+        self.assertEqual(created, ["foo", "bar", "foo"])
+
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript.Entries")
+    def test__fetch_entries(self, mock_Entries):
+        rows = [(1, "Path", "/foo"), (2, "Service", "/foo")]
+
+        def filter(name__in=None, id__in=None):
+            rv = Mock()
+            if id__in is not None:
+                ids = [r[0] for r in rows]
+                rv.values_list.return_value = [i for i in id__in
+                                               if i in ids]
+            else:
+                rv.values_list.return_value = [r for r in rows
+                                               if r[2] in name__in]
+            return rv
+
+        def get_or_create(kind=None, name=None):
+            entry = Mock()
+            entry.id = len(rows) + 1
+            rows.append((entry.id, kind, name))
+            return (entry, True)
+
+        mock_Entries.objects.filter.side_effect = filter
+        mock_Entries.objects.get_or_create.side_effect = get_or_create
+        self.assertEqual(
+            importscript._fetch_entries([("Path", "/foo"), ("Path", "/bar"),
+                                         ("Path", "/foo")]),
+            {("Path", "/foo"): 1, ("Path", "/bar"): 3})
+        mock_Entries.objects.get_or_create.assert_called_once_with(
+            kind="Path", name="/bar")
+        # other entries returned by the query are cached too
+        self.assertEqual(importscript._entry_ids[("Service", "/foo")], 2)
+
+        mock_Entries.reset_mock()
+        self.assertEqual(importscript._fetch_entries([("Service", "/foo")]),
+                         {("Service", "/foo"): 2})
+        self.assertFalse(mock_Entries.objects.get_or_create.called)
+
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript._fetch_reason")
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript.Reason")
+    def test__fetch_reasons(self, mock_Reason, mock_fetch_reason):
+        def fetch_reason(elem, kargs, logger):
+            rv = Mock()
+            rv.id = mock_fetch_reason.call_count
+            return rv
+
+        mock_fetch_reason.side_effect = fetch_reason
+        mock_Reason.objects.filter.side_effect = \
+            get_model([1, 2]).objects.filter.side_effect
+        elems = [lxml.etree.Element("Path", name="/foo", owner="root"),
+                 lxml.etree.Element("Path", name="/bar", owner="root"),
+                 lxml.etree.Element("Path", name="/baz", owner="bin")]
+        logger = Mock()
+        # identical reasons are only looked up once
+        self.assertEqual(importscript._fetch_reasons(elems, "UTF-8", logger),
+                         [1, 1, 2])
+        self.assertEqual(mock_fetch_reason.call_count, 2)
+        self.assertEqual(importscript._fetch_reasons(elems, "UTF-8", logger),
+                         [1, 1, 2])
+        self.assertEqual(mock_fetch_reason.call_count, 2)
+
+
+class TestLoadStats(Bcfg2TestCase):
+    def get_stats(self):
+        return [(name, lxml.etree.Element("Statistics"))
+                for name in ["foo", "bar", "baz"]]
+
+    @skipUnless(has_django, "Django not found, skipping")
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript.load_stat")
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript._load_stat_batch")
+    def test_load_stat_batch(self, mock_load_stat_batch, mock_load_stat):
+        stats = self.get_stats()
+        logger = Mock()
+        importscript.load_stat_batch(stats, "UTF-8", 0, logger, True, "")
+        mock_load_stat_batch.assert_called_with(stats, "UTF-8", 0, logger,
+                                                True, "")
+        self.assertFalse(mock_load_stat.called)
+
+        # if the batch fails, the caches are cleared and each
+        # interaction is imported individually
+        importscript._group_ids["foo"] = 1
+        mock_load_stat_batch.side_effect = ValueError
+
+        def load_stat(cobj, *args):
+            if cobj == "bar":
+                raise ValueError
+
+        mock_load_stat.side_effect = load_stat
+        importscript.load_stat_batch(stats, "UTF-8", 0, logger, True, "")
+        self.assertEqual(importscript._group_ids, dict())
+        self.assertEqual(mock_load_stat.call_args_list,
+                         [call(name, s, "UTF-8", 0, logger, True, "")
+                          for name, s in stats])
+        self.assertEqual(logger.error.call_count, 1)
+
+        # a fallback function imports them instead
+        mock_load_stat.reset_mock()
+        fallback = Mock()
+        importscript.load_stat_batch(stats, "UTF-8", 0, logger, True, "",
+                                     fallback=fallback)
+        self.assertFalse(mock_load_stat.called)
+        self.assertEqual(fallback.call_args_list,
+                         [call(name, s) for name, s in stats])
+
+    @skipUnless(has_django, "Django not found, skipping")
+    @patchIf(has_django, "Bcfg2.Server.Reports.importscript.load_stat_batch")
+    def test_load_stats(self, mock_load_stat_batch):
+        sdata = lxml.etree.Element("ConfigStatistics")
+        for i in range(3):
+            node = lxml.etree.SubElement(sdata, "Node", name="client%d" % i)
+            for j in range(70):
+                lxml.etree.SubElement(node, "Statistics")
+        logger = Mock()
+        importscript.load_stats(sdata, "UTF-8", 0, logger, location="here")
+        self.assertEqual(
+            [len(c[0][0]) for c in mock_load_stat_batch.call_args_list],
+            [100, 100, 10])
+        self.assertEqual(mock_load_stat_batch.call_args[0][1:],
+                         ("UTF-8", 0, logger, False, "here"))
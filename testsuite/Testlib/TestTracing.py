@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Tracing import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import XI_NAMESPACE, XI, inPy3k, call, builtins, u, can_skip, \
+    skip, skipIf, skipUnless, Bcfg2TestCase, DBModelTestCase, syncdb, \
+    patchIf, datastore
+
+
+class TestTracer(Bcfg2TestCase):
+    def trace(self, tracer, client="foo.example.com"):
+        """ record a trace of a request with two steps, the first of
+        which has a span of its own """
+        root = tracer.start_span("GetConfig", root=True, address="10.0.0.1")
+        tracer.annotate_request(client=client)
+        step = tracer.start_span("build_metadata")
+        tracer.end_span(tracer.start_span("Probes:get_additional_data"))
+        tracer.end_span(step)
+        step = tracer.start_span("Bind", entry="Path:/etc/foo.conf")
+        tracer.annotate(step, generator="Cfg")
+        tracer.end_span(step)
+        tracer.end_span(root)
+
+    def test_spans(self):
+        tracer = Tracer(threshold=0)
+        # nothing is traced outside of a request
+        self.assertEqual(tracer.start_span("Bind"), None)
+        tracer.end_span(None)
+        self.assertEqual(tracer.get_traces(), [])
+
+        self.trace(tracer)
+        traces = tracer.get_traces()
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]['name'], "GetConfig")
+        self.assertEqual(traces[0]['client'], "foo.example.com")
+        self.assertTrue(traces[0]['slow'])
+        self.assertEqual([s[0] for s in traces[0]['steps']],
+                         ["build_metadata", "Bind"])
+
+        trace = tracer.get_trace(traces[0]['id'])
+        spans = trace['spans']
+        self.assertEqual(spans['attrs'], dict(address="10.0.0.1",
+                                              client="foo.example.com"))
+        self.assertEqual(spans['children'][0]['children'][0]['name'],
+                         "Probes:get_additional_data")
+        self.assertEqual(spans['children'][1]['attrs'],
+                         dict(entry="Path:/etc/foo.conf", generator="Cfg"))
+        # traces can be sent over XML-RPC
+        xmlrpclib.dumps((trace, ), methodresponse=True)
+        xmlrpclib.dumps((traces, ), methodresponse=True)
+
+        # spans are traced per thread
+        thread = threading.Thread(target=self.trace,
+                                  args=(tracer, "bar.example.com"))
+        root = tracer.start_span("GetConfig", root=True)
+        thread.start()
+        thread.join()
+        tracer.end_span(root)
+        self.assertEqual([t['client'] for t in tracer.get_traces()],
+                         ["foo.example.com", "bar.example.com", ""])
+        self.assertEqual(
+            [t['client'] for t in tracer.get_traces(client="bar.example.com")],
+            ["bar.example.com"])
+
+    def test_threshold(self):
+        tracer = Tracer(threshold=3600)
+        self.trace(tracer)
+        self.assertEqual(tracer.get_traces(slow=True), [])
+        trace = tracer.get_trace(tracer.get_traces()[0]['id'])
+        self.assertFalse(trace['slow'])
+        # only the steps of fast requests are kept
+        self.assertEqual(len(trace['spans']['children']), 2)
+        self.assertEqual(trace['spans']['children'][0]['children'], [])
+
+    def test_ring_buffer(self):
+        tracer = Tracer(size=3)
+        for i in range(5):
+            self.trace(tracer)
+        self.assertEqual([t['id'] for t in tracer.get_traces()], [3, 4, 5])
+        self.assertEqual(tracer.get_trace(1), None)
+
+        tracer = Tracer(size=0)
+        self.trace(tracer)
+        self.assertEqual(tracer.get_traces(), [])